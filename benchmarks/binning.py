@@ -0,0 +1,105 @@
+"""Micro-benchmark of Space.from_image()/Space.bin_image().
+
+Compares the current binning engine with the previous implementation
+(reproduced below as legacy_bin_image) on synthetic detector frames and
+reports images per second for both.
+
+usage: python benchmarks/binning.py [--pixels 2048,1024] [--frames 10] [--mask]
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import binoculars.space  # noqa: E402
+
+
+def legacy_bin_image(space, coordinates, intensity, weights, variances, valids=None):
+    """Space.bin_image() as it was before the single-pass binning engine"""
+    intensity = np.nan_to_num(intensity).flatten()
+    weights = weights.flatten()
+    variances = np.nan_to_num(variances).flatten()
+    if valids is None:
+        valids = np.ones_like(intensity)
+    else:
+        valids = valids.flatten()
+
+    indices = np.array(tuple(ax.get_index(coord) for (ax, coord) in zip(space.axes, coordinates)))
+    for i in range(len(space.axes)):
+        for j in range(i+1, len(space.axes)):
+            indices[i, :] *= len(space.axes[j])
+    indices = indices.sum(axis=0).astype(int).flatten()
+
+    photons = np.bincount(indices, weights=intensity*weights*valids)
+    contributions = np.bincount(indices, weights=weights*valids)
+    variances = np.bincount(indices, weights=variances*weights**2*valids)
+
+    space.photons.ravel()[:photons.size] += photons
+    space.contributions.ravel()[:contributions.size] += contributions
+    space.variances.ravel()[:variances.size] += variances
+
+
+def legacy_from_image(resolutions, labels, coordinates, intensity, weights, variances):
+    axes = tuple(binoculars.space.Axis(coord.min(), coord.max(), res, label) for res, label, coord in zip(resolutions, labels, coordinates))
+    newspace = binoculars.space.Space(axes)
+    legacy_bin_image(newspace, coordinates, intensity, weights, variances)
+    return newspace
+
+
+def make_frame(shape, seed, mask=False):
+    """Synthetic frame: a smooth mapping of the pixels on a 3D grid, Poisson counts"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]].astype(float)
+    y /= shape[0]
+    x /= shape[1]
+    offset = rng.random_sample(3)
+    coords = (np.sin(x + offset[0]) * 0.8, np.cos(y + offset[1]) * 0.8, 0.5 * (x + y) + offset[2])
+    intensity = rng.poisson(10, shape).astype(float)
+    variances = intensity + 1
+    weights = np.ones(shape)
+    if mask:
+        weights[:, :shape[1] // 10] = 0
+    return tuple(c.flatten() for c in coords), intensity, weights, variances
+
+
+def run(binner, frames, resolutions, labels):
+    start = time.time()
+    for coords, intensity, weights, variances in frames:
+        binner(resolutions, labels, coords, intensity, weights, variances)
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pixels', default='2048,1024', help='detector size, default 2048,1024')
+    parser.add_argument('--frames', type=int, default=10, help='number of frames, default 10')
+    parser.add_argument('--resolution', type=float, default=0.002, help='grid resolution, default 0.002')
+    parser.add_argument('--mask', action='store_true', help='mask 10%% of the detector with zero weights')
+    args = parser.parse_args()
+
+    shape = tuple(int(i) for i in args.pixels.split(','))
+    resolutions = (args.resolution,) * 3
+    labels = 'x', 'y', 'z'
+    frames = [make_frame(shape, seed, args.mask) for seed in range(args.frames)]
+
+    # sanity check: both engines should produce identical spaces
+    old = legacy_from_image(resolutions, labels, *frames[0])
+    new = binoculars.space.Space.from_image(resolutions, labels, *frames[0])
+    for name in ('photons', 'contributions', 'variances'):
+        if not np.allclose(getattr(old, name), getattr(new, name)):
+            raise AssertionError('binning engines disagree on {0}'.format(name))
+
+    before = run(legacy_from_image, frames, resolutions, labels)
+    after = run(binoculars.space.Space.from_image, frames, resolutions, labels)
+    print('{0} frames of {1[0]}x{1[1]} pixels, {2!r}'.format(args.frames, shape, new.axes))
+    print('before: {0:.2f} images/s'.format(before))
+    print('after:  {0:.2f} images/s ({1:.2f}x)'.format(after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark of the storage options of Space.tofile().
+
+Writes a synthetic space with several codec/chunk layouts (see the
+compression, shuffle and chunks options of the dispatcher) and reports
+write time, file size and the latency of reading a rod along the last axis
+and a plane perpendicular to it.
+
+usage: python benchmarks/compression.py [--shape 200,200,400] [--rods 50]
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import binoculars.space  # noqa: E402
+
+LAYOUTS = (
+    ('gzip, auto chunks (default)', {}),
+    ('none, contiguous', dict(compression='none')),
+    ('lzf, auto chunks', dict(compression='lzf')),
+    ('gzip:1 + shuffle', dict(compression='gzip:1', shuffle=True)),
+    ('lzf, rod chunks 4,4,0', dict(compression='lzf', chunks=(4, 4, 0))),
+    ('gzip:1 + shuffle, rod chunks 4,4,0', dict(compression='gzip:1', shuffle=True, chunks=(4, 4, 0))),
+)
+
+
+def make_space(shape, seed=0):
+    """Synthetic output: Poisson counts on a partially filled grid"""
+    rng = np.random.RandomState(seed)
+    axes = tuple(binoculars.space.Axis(0, n - 1, 0.01, label) for n, label in zip(shape, 'hkl'))
+    space = binoculars.space.Space(axes)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    filled = sum((g / n - 0.5) ** 2 for g, n in zip(grid, shape)) < 0.15
+    space.contributions[...] = filled * rng.poisson(20, shape)
+    space.photons[...] = space.contributions * rng.gamma(2, 50, shape)
+    space.variances[...] = space.photons
+    return space
+
+
+def read_latency(filename, shape, rods, seed=0):
+    rng = np.random.RandomState(seed)
+    with h5py.File(filename, 'r') as fp:
+        counts = fp['binoculars']['counts']
+        start = time.time()
+        for i, j in zip(rng.randint(shape[0], size=rods), rng.randint(shape[1], size=rods)):
+            counts[i, j, :]
+        rod = (time.time() - start) / rods
+        start = time.time()
+        counts[:, :, shape[2] // 2]
+        plane = time.time() - start
+    return rod, plane
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', default='200,200,400', help='grid size, default 200,200,400')
+    parser.add_argument('--rods', type=int, default=50, help='number of rods to read, default 50')
+    args = parser.parse_args()
+
+    shape = tuple(int(i) for i in args.shape.split(','))
+    space = make_space(shape)
+    directory = tempfile.mkdtemp()
+    print('{0!r}'.format(space.axes))
+    print('{0:<38} {1:>9} {2:>10} {3:>10} {4:>10}'.format('layout', 'write s', 'size MB', 'rod ms', 'plane ms'))
+    for label, storage in LAYOUTS:
+        filename = os.path.join(directory, 'space.hdf5')
+        start = time.time()
+        space.tofile(filename, **storage)
+        write = time.time() - start
+        size = os.path.getsize(filename) / 2**20
+        rod, plane = read_latency(filename, shape, args.rods)
+        print('{0:<38} {1:>9.2f} {2:>10.1f} {3:>10.2f} {4:>10.1f}'.format(label, write, size, rod * 1e3, plane * 1e3))
+        os.remove(filename)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Benchmark suite of the binning, reduction and I/O hot paths.
+
+The benchmarks follow the conventions of asv (airspeed velocity): classes
+with 'params' and 'param_names', setup() and time_* methods taking the
+parameters, such that asv can run them as well. Without asv, this script
+runs them itself on synthetic data (see binning.py and compression.py) and
+reports per parameter combination the best time of a few repeats, the
+throughput and the peak memory allocated (traced by tracemalloc, within
+the benchmarking process only). The results can be saved as a baseline and
+later runs compared against it.
+
+usage: python benchmarks/suite.py [--quick] [--filter REGEX] [--repeat 3]
+                                  [--save FILE] [--baseline FILE]
+"""
+from __future__ import print_function, division
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import inspect
+import tempfile
+import argparse
+import warnings
+import itertools
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import binoculars.space  # noqa: E402
+import binoculars.util  # noqa: E402
+import binoculars.main  # noqa: E402
+from binning import make_frame  # noqa: E402
+from compression import make_space  # noqa: E402
+
+
+def shifted(space, offset):
+    """Copy of 'space' moved by 'offset' grid points along the first axis"""
+    axes = tuple(binoculars.space.Axis(ax.imin + (offset if i == 0 else 0), ax.imax + (offset if i == 0 else 0), ax.res, ax.label) for i, ax in enumerate(space.axes))
+    result = binoculars.space.Space(axes)
+    result.photons[...] = space.photons
+    result.contributions[...] = space.contributions
+    result.variances[...] = space.variances
+    return result
+
+
+class BinImage(object):
+    """Binning one detector frame, into a new space or a preallocated one"""
+    params = [['256x256', '1024x1024'], [0.02, 0.005]]
+    param_names = ['detector', 'resolution']
+    unit = 'pixels'
+
+    def setup(self, detector, resolution):
+        shape = tuple(int(i) for i in detector.split('x'))
+        self.frame = make_frame(shape, 0)
+        self.resolutions = (resolution, ) * 3
+        self.space = binoculars.space.Space.from_image(self.resolutions, 'xyz', *self.frame)
+
+    def count(self, detector, resolution):
+        return self.frame[1].size
+
+    def time_from_image(self, detector, resolution):
+        binoculars.space.Space.from_image(self.resolutions, 'xyz', *self.frame)
+
+    def time_bin_image(self, detector, resolution):
+        self.space.bin_image(*self.frame)
+
+
+class ChunkedSum(object):
+    """Summing 8 spaces that overlap by three quarters or do not overlap at all"""
+    params = [['overlapping', 'disjoint'], [40, 100]]
+    param_names = ['layout', 'grid']
+    unit = 'points'
+
+    def setup(self, layout, grid):
+        base = make_space((grid, grid, grid))
+        step = grid // 4 if layout == 'overlapping' else grid
+        self.verses = [binoculars.space.Multiverse((shifted(base, i * step), )) for i in range(8)]
+
+    def count(self, layout, grid):
+        return 8 * grid**3
+
+    def time_chunked_sum(self, layout, grid):
+        binoculars.space.chunked_sum(iter(self.verses))
+
+
+class Storage(object):
+    """Writing and reading an output file with the default storage options"""
+    params = [[50, 120]]
+    param_names = ['grid']
+    unit = 'points'
+
+    def setup(self, grid):
+        self.space = make_space((grid, grid, 2 * grid))
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'space.hdf5')
+        self.space.tofile(self.filename)
+
+    def teardown(self, grid):
+        shutil.rmtree(self.directory)
+
+    def count(self, grid):
+        return self.space.photons.size
+
+    def time_tofile(self, grid):
+        self.space.tofile(os.path.join(self.directory, 'written.hdf5'))
+
+    def time_fromfile(self, grid):
+        binoculars.space.Space.fromfile(self.filename)
+
+
+class Transform(object):
+    """Operations on a finished space"""
+    params = [[50, 120]]
+    param_names = ['grid']
+    unit = 'points'
+
+    def setup(self, grid):
+        self.space = make_space((grid, grid, 2 * grid))
+        self.transformation = binoculars.util.transformation_from_expressions(self.space, ('sqrt(h**2 + k**2)', 'l'))
+
+    def count(self, grid):
+        return self.space.photons.size
+
+    def time_rebin(self, grid):
+        self.space.rebin_factors((2, 2, 2))
+
+    def time_project(self, grid):
+        self.space.project('h')
+
+    def time_transform_coordinates(self, grid):
+        self.space.transform_coordinates((0.01, 0.01), ('q', 'l'), self.transformation)
+
+
+class MainRun(object):
+    """Full run of the example backend: 2 scans of 100 frames of 100x100 pixels"""
+    params = [['singlecore', 'local'], ['perimage', 'fixedgrid']]
+    param_names = ['dispatcher', 'grid']
+    unit = 'pixels'
+    config = '\n'.join((
+        '[dispatcher]',
+        'type = {dispatcher}',
+        'ncores = 2',
+        'destination = {directory}/output.hdf5',
+        'overwrite = true',
+        '[input]',
+        'type = example:input',
+        'wavelength = 0.5',
+        'centralpixel = 50,50',
+        'sdd = 636',
+        'pixelsize = 0.055, 0.055',
+        '[projection]',
+        'type = example:qprojection',
+        'resolution = 0.01',
+        'limits = [-2:2,-2:2,0:4]',
+        'fixedgrid = {fixedgrid}',
+    ))
+
+    def setup(self, dispatcher, grid):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'config.txt')
+        options = self.config.format(dispatcher=dispatcher, directory=self.directory, fixedgrid=grid == 'fixedgrid')
+        if dispatcher == 'singlecore':  # ncores is not known to singlecore
+            options = options.replace('ncores = 2\n', '')
+        with open(self.filename, 'w') as fp:
+            fp.write(options)
+
+    def teardown(self, dispatcher, grid):
+        shutil.rmtree(self.directory)
+
+    def count(self, dispatcher, grid):
+        return 2 * 100 * 100 * 100
+
+    def time_run(self, dispatcher, grid):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')  # the example backend prints every frame
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                binoculars.main.Main.from_args([self.filename, '1-2'])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+BENCHMARKS = BinImage, ChunkedSum, Storage, Transform, MainRun
+
+
+def measure(func, args, repeat):
+    """Returns the best time of 'repeat' calls and the peak memory allocated by one call"""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.time()
+        func(*args)
+        best = min(best, time.time() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def run(pattern, repeat, quick):
+    """Yields (name, time, throughput, peak memory) of every benchmark matching 'pattern'"""
+    for cls in BENCHMARKS:
+        params = [values[:1] for values in cls.params] if quick else cls.params
+        methods = [name for name, value in inspect.getmembers(cls) if name.startswith('time_')]
+        for args in itertools.product(*params):
+            label = ','.join('{0}={1}'.format(name, value) for name, value in zip(cls.param_names, args))
+            names = ['{0}.{1}({2})'.format(cls.__name__, method, label) for method in methods]
+            if not any(re.search(pattern, name) for name in names):
+                continue
+            bench = cls()
+            bench.setup(*args)
+            try:
+                for name, method in zip(names, methods):
+                    if re.search(pattern, name):
+                        t, peak = measure(getattr(bench, method), args, repeat)
+                        yield name, t, bench.count(*args) / t, cls.unit, peak
+            finally:
+                if hasattr(bench, 'teardown'):
+                    bench.teardown(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='only the first (smallest) value of every parameter')
+    parser.add_argument('--filter', default='', help='only the benchmarks whose name matches this regular expression')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed calls per benchmark, default 3')
+    parser.add_argument('--save', metavar='FILE', help='store the results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with the results stored by --save')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    results = {}
+    print('{0:<62} {1:>10} {2:>16} {3:>9} {4:>8}'.format('benchmark', 'time ms', 'throughput /s', 'peak MB', 'vs base'))
+    for name, t, throughput, unit, peak in run(args.filter, args.repeat, args.quick):
+        results[name] = dict(time=t, peakmem=peak)
+        ratio = ''
+        if name in baseline:
+            ratio = '{0:.2f}x'.format(t / baseline[name]['time'])
+            if t > 1.2 * baseline[name]['time']:
+                ratio += ' !'  # slower than the baseline beyond the usual noise
+        print('{0:<62} {1:>10.2f} {2:>9.3g} {3:<6} {4:>9} {5:>8}'.format(name, t * 1e3, throughput, unit, '-' if peak is None else '{0:.1f}'.format(peak / 2**20), ratio))
+        sys.stdout.flush()
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
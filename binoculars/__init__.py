@@ -36,11 +36,14 @@ def run(args):
         return tuple(binoculars.space.Space.fromfile(fn) for fn in filenames)
 
 
-def load(filename, key=None):
+def load(filename, key=None, lazy=False):
     ''' Parameters
         filename: string
             Only hdf5 files are acceptable
         key: a tuple with slices in as much dimensions as the space is
+        lazy: bool
+            Keep the file open and only read data when needed, for
+            projecting or slicing spaces that do not fit in memory
 
         Returns
         A binoculars space
@@ -56,7 +59,7 @@ def load(filename, key=None):
     '''
     import binoculars.space
     if os.path.exists(filename):
-        return binoculars.space.Space.fromfile(filename, key=key)
+        return binoculars.space.Space.fromfile(filename, key=key, lazy=lazy)
     else:
         raise IOError("File '{0}' does not exist".format(filename))
 
@@ -1,4 +1,6 @@
-from . import util, errors, dispatcher
+import numpy as np
+
+from . import util, errors, dispatcher, space
 
 
 class ProjectionBase(util.ConfigurableObject):
@@ -17,6 +19,26 @@ class ProjectionBase(util.ConfigurableObject):
                 raise errors.ConfigError('dimension mismatch between projection axes ({0}) and resolution specification ({1}) in {2}'.format(labels, self.config.resolution, self.__class__.__name__))
         else:
             self.config.resolution = tuple([float(res)] * len(labels))
+        self.config.fixedgrid = util.parse_bool(config.pop('fixedgrid', 'false'))  # Optional, bin all images of a job in place into one preallocated space per limit set. Only possible when the limits bound every axis, false by default
+        self.config.prepass = util.parse_bool(config.pop('prepass', 'false'))  # Optional, determine the extent of the output of a job by projecting only the detector border of every image before binning, requires support of the input backend. false by default
+        self.config.sparse = float(config.pop('sparse', 0.05))  # Optional, with fixedgrid or prepass: store the data of a job sparsely when its pixels can fill at most this fraction of the grid. The decision needs the grid of the job before binning, so without fixedgrid or prepass (the output sized per image) the data is always stored densely. 0.05 by default, 0 to disable
+        self.config.scratch = config.pop('scratch', None)  # Optional, with fixedgrid or prepass: keep grids larger than maxmemory out-of-core, in chunked HDF5 files in this directory. Disabled by default
+        self.config.maxmemory = float(config.pop('maxmemory', 1024))  # Optional, size in MB of the largest grid kept in memory if scratch is given, 1024 by default
+        self.config.precision = config.pop('precision', 'double')  # Optional, 'double' (float64 arrays) or 'single' (float32 photons and variances, uint32 contributions, promoted to float64 for non-integral or overflowing contributions). double by default
+        if self.config.precision not in space.PRECISIONS:
+            raise errors.ConfigError("invalid precision '{0}' in {1}, choose from {2}".format(self.config.precision, self.__class__.__name__, ', '.join(space.PRECISIONS)))
+
+    def get_limit_axes(self):
+        """Returns a tuple of Axes, one per limit set, spanning the limits.
+        Returns None if there are no limits or if they do not bound every axis."""
+        if self.config.limits is None:
+            return None
+        axes = []
+        for lim in self.config.limits:
+            if any(sl.start is None or sl.stop is None for sl in lim):
+                return None
+            axes.append(space.Axes(space.Axis(sl.start, sl.stop, res, label) for sl, res, label in zip(lim, self.config.resolution, self.get_axis_labels())))
+        return tuple(axes)
 
     def project(self, *args):
         raise NotImplementedError
@@ -52,6 +74,47 @@ class InputBase(util.ConfigurableObject):
 
         Job()s could have been pickle'd and distributed over a cluster"""
         self.metadata = util.MetaBase('job', job.__dict__)
+        # the output records which scans and points it contains, see the append option of the dispatcher
+        stored = {'scankey': util.scan_key(job)}
+        if getattr(job, 'firstpoint', None) is not None and getattr(job, 'lastpoint', None) is not None:
+            stored.update(firstpoint=job.firstpoint, lastpoint=job.lastpoint)
+        self.metadata.add_section('binoculars', stored)
+
+    def get_border_params(self, job):
+        """Optional. Yields per image of the Job() the same projection
+        arguments as process_job(), but only for the pixels on the border
+        of the detector and without reading the images. Used to determine
+        the extent of the output before binning."""
+        raise NotImplementedError
+
+    def get_job_files(self, job):
+        """Optional. Returns the files the Job() reads, such that cached and
+        checkpointed results are invalidated when one of them changes (see
+        the cache and checkpoint options of the dispatcher). An empty list
+        if the result depends on the configuration and the Job() only. None
+        by default: the files are unknown and the results are not reused."""
+        return None
+
+    def get_pixel_count(self, job):
+        """Optional. Returns the number of pixels per image of the Job()
+        (e.g. the size of the region of interest), used to estimate the cost
+        of the Job() for scheduling. None if unknown."""
+        return None
+
+    def split_job(self, job, parts):
+        """Optional. Returns at most 'parts' Job()s that together process the
+        same images as 'job', used to split jobs that take much longer than the
+        others. By default, jobs with a range of points (firstpoint and
+        lastpoint) are split into shorter ranges, others are not split."""
+        first, last = getattr(job, 'firstpoint', None), getattr(job, 'lastpoint', None)
+        if first is None or last is None or parts < 2 or last <= first:
+            return [job]
+        count = last - first + 1
+        jobs = []
+        for s in util.chunk_slicer(count, int(np.ceil(float(count) / parts))):
+            kwargs = dict(job.__dict__, firstpoint=first + s.start, lastpoint=first + s.stop - 1, weight=job.weight * (s.stop - s.start) / float(count))
+            jobs.append(job.__class__(**kwargs))
+        return jobs
 
     def get_destination_options(self, command):
         """Receives the same command as generate_jobs(), but returns
@@ -90,6 +90,9 @@ class EDFInput(backend.InputBase):
         for image in images:
             yield self.process_image(image)
 
+    def get_job_files(self, job):
+        return job.images[job.firstimage:job.lastimage + 1]
+
     def parse_config(self, config):
         super(EDFInput, self).parse_config(config)
         self.config.xmask = util.parse_multi_range(config.pop('xmask'))
@@ -206,6 +206,10 @@ class BM32Input(backend.InputBase):
             raise
         self.metadata.add_section('id03_backend', self.metadict)
 
+    def get_job_files(self, job):
+        scan = self.get_scan(job.scan)
+        return [self.config.specfile] + self.get_image_files(scan, job.firstpoint, job.lastpoint)
+
     def parse_config(self, config):
         super(BM32Input, self).parse_config(config)
         self.config.xmask = util.parse_multi_range(config.pop('xmask', None))#Optional, select a subset of the image range in the x direction. all by default
@@ -267,35 +271,39 @@ class BM32Input(backend.InputBase):
         return wavelength, UB
 
     def get_images(self, scan, first, last, dry_run=False):
+        files = self.get_image_files(scan, first, last)
+        if dry_run:
+            yield
+        elif self.config.background:
+            edf = EdfFile.EdfFile(files[0])
+            for i in range(first, last+1):
+                self.dbg_pointno = i
+                yield edf
+        else:
+            imagenos = numpy.array(scan.datacol('img')[slice(first, last + 1)], dtype = numpy.int) + 1 #error in spec?
+            for i, filename in zip(imagenos, files):
+                self.dbg_pointno = i
+                edf = EdfFile.EdfFile(filename)
+                yield edf
+
+    def get_image_files(self, scan, first, last):
+        """Returns the edf files with the images of the points first to last, a single file for a background"""
         imagenos = numpy.array(scan.datacol('img')[slice(first, last + 1)], dtype = numpy.int) + 1 #error in spec?
         if self.config.background:
             if not os.path.exists(self.config.background):
                 raise errors.FileError('could not find background file {0}'.format(self.config.background))
-            if dry_run:
-                yield
-            else:
-                edf = EdfFile.EdfFile(self.config.background)
-                for i in range(first, last+1):
-                    self.dbg_pointno = i
-                    yield edf
-        else:
-            try:
-                uccdtagline = scan.header('M')[0].split()[-1]
-                UCCD = os.path.dirname(uccdtagline).split(os.sep)
-            except:
-                print('warning: UCCD tag not found, use imagefolder for proper file specification')
-                UCCD = []
-            pattern = self._get_pattern(UCCD)
-            matches = self.find_edfs(pattern)
-            if not set(imagenos).issubset(set(matches.keys())):
-                raise errors.FileError("incorrect number of matches for scan {0} using pattern {1}".format(scan.number(), pattern))
-            if dry_run:
-                yield
-            else:
-                for i in imagenos:
-                    self.dbg_pointno = i
-                    edf = EdfFile.EdfFile(matches[i])
-                    yield edf
+            return [self.config.background]
+        try:
+            uccdtagline = scan.header('M')[0].split()[-1]
+            UCCD = os.path.dirname(uccdtagline).split(os.sep)
+        except:
+            print('warning: UCCD tag not found, use imagefolder for proper file specification')
+            UCCD = []
+        pattern = self._get_pattern(UCCD)
+        matches = self.find_edfs(pattern)
+        if not set(imagenos).issubset(set(matches.keys())):
+            raise errors.FileError("incorrect number of matches for scan {0} using pattern {1}".format(scan.number(), pattern))
+        return [matches[i] for i in imagenos]
 
     def _get_pattern(self,UCCD):
        imagefolder = self.config.imagefolder
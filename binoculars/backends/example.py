@@ -54,7 +54,7 @@ class Input(backend.InputBase):
 
         scans = util.parse_multi_range(','.join(command).replace(' ', ','))# parse the command
         for scanno in scans:
-            yield backend.Job(scan=scanno)
+            yield backend.Job(scan=scanno, firstpoint=0, lastpoint=99, weight=100)  # 100 images per scan, see get_trajectory
 
     def process_job(self, job):
         '''
@@ -70,37 +70,17 @@ class Input(backend.InputBase):
         of the pixels and ai and omega are the in plane and out of plane angles of the incoming beam.
         '''
         super(Input, self).process_job(job)# call super to fix metadeta handling
-        scan = job.scan
-
-        #reflects a scan with 100 datapoints
-        aaf    = np.linspace(0, np.random.random() * 20, 100)
-        adelta = np.linspace(0, np.random.random() * 20, 100)
-        aai = np.linspace(0, np.random.random() * 20, 100)
-        aomega = np.linspace(0, np.random.random() * 20, 100)
-        for af, delta, ai, omega in zip(aaf, adelta, aai, aomega):
-            print('af: {0}, delta: {1}, ai: {2}, omega: {3}'.format(af, delta, ai, omega))
 
-            # caculating the angles per pixel. The values specified in the configuration file
-            # can be used for calculating these values
-            pixelsize = np.array(self.config.pixelsize)
-            sdd = self.config.sdd
-            app = np.arctan(pixelsize / sdd) * 180 / np.pi
+        for af, delta, ai, omega in self.get_trajectory(job):
+            print('af: {0}, delta: {1}, ai: {2}, omega: {3}'.format(af, delta, ai, omega))
 
             # create an image of 100 x 100 pixels and calculate the coordinates corresponding to every pixel
-            centralpixel = self.config.centralpixel # (column, row) = (delta, af)
-            af_range= -app[1] * (np.arange(100) - centralpixel[1]) + af
-            delta_range= app[0] * (np.arange(100) - centralpixel[0]) + delta
+            af, delta, ai, omega = self.get_pixel_angles(af, delta, ai, omega)
 
             #calculating the coordinates for simulating the image. This is only included
             #in this example for simulating of the images. It has no other use.
 
             k0 = 2 * np.pi / self.config.wavelength
-            delta, af = np.meshgrid(delta_range, af_range)
-            ai *= np.pi/180
-            delta *= np.pi/180
-            af *= np.pi/180
-            omega *= np.pi/180
-
             qy = k0 * (np.cos(af) * np.cos(delta) - np.cos(ai) * np.cos(omega))
             qx = k0 * (np.cos(af) * np.sin(delta) - np.cos(ai) * np.sin(omega))
             qz = k0 * (np.sin(af) + np.sin(ai))
@@ -111,6 +91,65 @@ class Input(backend.InputBase):
 
             yield data, weights, (self.config.wavelength, af, delta, omega, ai)
 
+    def get_border_params(self, job):
+        '''
+        Optional. Yields the same coordinates as process_job, but only for the pixels on the border of the
+        detector and without reading (here: simulating) any image. Implement this if the coordinates of the
+        pixels can be calculated cheaply, it allows BINoculars to determine the extent of the output before
+        binning (prepass = true in the projection section of the configfile).
+        '''
+        for af, delta, ai, omega in self.get_trajectory(job):
+            af, delta, ai, omega = self.get_pixel_angles(af, delta, ai, omega)
+            border = np.ones(af.shape, dtype=bool)
+            border[1:-1, 1:-1] = False
+            yield self.config.wavelength, af[border], delta[border], omega, ai
+
+    def get_trajectory(self, job):
+        '''
+        Simulates a scan with 100 datapoints on a random path through angular space starting at the origin. The
+        random generator is seeded with the scan number, such that every call describes the same scan. Returns
+        the points firstpoint to lastpoint of the job.
+        '''
+        random = np.random.RandomState(job.scan)
+        aaf    = np.linspace(0, random.random_sample() * 20, 100)
+        adelta = np.linspace(0, random.random_sample() * 20, 100)
+        aai = np.linspace(0, random.random_sample() * 20, 100)
+        aomega = np.linspace(0, random.random_sample() * 20, 100)
+        return itertools.islice(zip(aaf, adelta, aai, aomega), job.firstpoint, job.lastpoint + 1)
+
+    def get_job_files(self, job):
+        '''
+        Optional. The files read by the job, such that cached and checkpointed results (see the cache and checkpoint
+        options of the dispatcher) are not reused when one of them changes. This example simulates its images and
+        reads no files: its results only depend on the configuration and the job. By default the files are unknown
+        and the results are not cached.
+        '''
+        return ()
+
+    def get_pixel_count(self, job):
+        '''
+        Optional. The number of pixels per image, used together with the number of images (the weight of the job)
+        to estimate how long a job will take. Jobs with firstpoint and lastpoint attributes, like those of this
+        example, can be split up automatically to even out the load (see split_job in backend.InputBase).
+        '''
+        return 100 * 100
+
+    def get_pixel_angles(self, af, delta, ai, omega):
+        '''
+        Calculates the angles (in radians) per pixel of a 100 x 100 pixel detector. The values specified in the
+        configuration file can be used for calculating these values
+        '''
+        pixelsize = np.array(self.config.pixelsize)
+        sdd = self.config.sdd
+        app = np.arctan(pixelsize / sdd) * 180 / np.pi
+
+        centralpixel = self.config.centralpixel # (column, row) = (delta, af)
+        af_range= -app[1] * (np.arange(100) - centralpixel[1]) + af
+        delta_range= app[0] * (np.arange(100) - centralpixel[0]) + delta
+
+        delta, af = np.meshgrid(delta_range, af_range)
+        return af * np.pi/180, delta * np.pi/180, ai * np.pi/180, omega * np.pi/180
+
     def parse_config(self, config):
         '''
         To collect and process data you need the values provided in the configuration file.
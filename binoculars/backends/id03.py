@@ -340,6 +340,10 @@ class ID03Input(backend.InputBase):
             raise
         self.metadata.add_section('id03_backend', self.metadict)
 
+    def get_job_files(self, job):
+        scan = self.get_scan(job.scan)
+        return [self.config.specfile] + self.get_image_files(scan, job.firstpoint, job.lastpoint)
+
     def parse_config(self, config):
         super(ID03Input, self).parse_config(config)
         self.config.xmask = util.parse_multi_range(config.pop('xmask', None))   # Optional, select a subset of the image range in the x direction. all by default
@@ -517,56 +521,57 @@ class ID03Input(backend.InputBase):
         return wavelength, UB
 
     def get_images(self, scan, first, last, dry_run=False):
+        files = self.get_image_files(scan, first, last)
+        if dry_run:
+            yield
+        elif self.config.background:
+            edf = EdfFile.EdfFile(files[0])
+            for i in range(first, last+1):
+                self.dbg_pointno = i
+                yield edf.GetData(0)
+        elif self.is_zap(scan) or self.is_anglescan(scan) or self.is_ccoscan(scan):
+            edf = EdfFile.EdfFile(files[0])
+            for i in range(first, last+1):
+                self.dbg_pointno = i
+                yield edf.GetData(i)
+        else:
+            for i, filename in zip(range(first, last+1), files):
+                self.dbg_pointno = i
+                edf = EdfFile.EdfFile(filename)
+                yield edf.GetData(0)
+
+    def get_image_files(self, scan, first, last):
+        """Returns the edf files with the images of the points first to last,
+        a single file for zap, angle and cco scans and for a background"""
         if self.config.background:
             if not os.path.exists(self.config.background):
                 raise errors.FileError('could not find background file {0}'.format(self.config.background))
-            if dry_run:
-                yield
-            else:
-                edf = EdfFile.EdfFile(self.config.background)
-                for i in range(first, last+1):
-                    self.dbg_pointno = i
-                    yield edf.GetData(0)
-        else:
-            if self.is_zap(scan) or self.is_anglescan(scan) or self.is_ccoscan(scan):
-                scanheaderC = scan.header('C')
-                zapscanno = int(scanheaderC[2].split(' ')[-1])  # is different from scanno should be changed in spec!
-                try:
-                    uccdtagline = scanheaderC[0]
-                    UCCD = os.path.split(uccdtagline.split()[-1])
-                except:
-                    print('warning: UCCD tag not found, use imagefolder for proper file specification')
-                    UCCD = []
-                pattern = self._get_pattern(UCCD)
-                matches = self.find_edfs(pattern, zapscanno)
-                if 0 not in matches:
-                    raise errors.FileError('could not find matching edf for zapscannumber {0} using pattern {1}'.format(zapscanno, pattern))
-                if dry_run:
-                    yield
-                else:
-                    edf = EdfFile.EdfFile(matches[0])
-                    for i in range(first, last+1):
-                        self.dbg_pointno = i
-                        yield edf.GetData(i)
-
-            else:
-                try:
-                    uccdtagline = scan.header('UCCD')[0]
-                    UCCD = os.path.split(os.path.dirname(uccdtagline.split()[-1]))
-                except:
-                    print('warning: UCCD tag not found, use imagefolder for proper file specification')
-                    UCCD = []
-                pattern = self._get_pattern(UCCD)
-                matches = self.find_edfs(pattern, scan.number())
-                if set(range(first, last + 1)) > set(matches.keys()):
-                    raise errors.FileError("incorrect number of matches for scan {0} using pattern {1}".format(scan.number(), pattern))
-                if dry_run:
-                    yield
-                else:
-                    for i in range(first, last+1):
-                        self.dbg_pointno = i
-                        edf = EdfFile.EdfFile(matches[i])
-                        yield edf.GetData(0)
+            return [self.config.background]
+        if self.is_zap(scan) or self.is_anglescan(scan) or self.is_ccoscan(scan):
+            scanheaderC = scan.header('C')
+            zapscanno = int(scanheaderC[2].split(' ')[-1])  # is different from scanno should be changed in spec!
+            try:
+                uccdtagline = scanheaderC[0]
+                UCCD = os.path.split(uccdtagline.split()[-1])
+            except:
+                print('warning: UCCD tag not found, use imagefolder for proper file specification')
+                UCCD = []
+            pattern = self._get_pattern(UCCD)
+            matches = self.find_edfs(pattern, zapscanno)
+            if 0 not in matches:
+                raise errors.FileError('could not find matching edf for zapscannumber {0} using pattern {1}'.format(zapscanno, pattern))
+            return [matches[0]]
+        try:
+            uccdtagline = scan.header('UCCD')[0]
+            UCCD = os.path.split(os.path.dirname(uccdtagline.split()[-1]))
+        except:
+            print('warning: UCCD tag not found, use imagefolder for proper file specification')
+            UCCD = []
+        pattern = self._get_pattern(UCCD)
+        matches = self.find_edfs(pattern, scan.number())
+        if set(range(first, last + 1)) > set(matches.keys()):
+            raise errors.FileError("incorrect number of matches for scan {0} using pattern {1}".format(scan.number(), pattern))
+        return [matches[i] for i in range(first, last + 1)]
 
     def _get_pattern(self, UCCD):
         imagefolder = self.config.imagefolder
@@ -150,6 +150,11 @@ class IO7Input(backend.InputBase):
             raise
         self.metadata.add_section('id7_backend', self.metadict)
 
+    def get_job_files(self, job):
+        scan = self.get_scan(job.scan)
+        datafile = os.path.join(self.config.datafilefolder, str(job.scan) + '.dat')
+        return [datafile] + [self.get_imagefilename(fn) for fn in scan.file[job.firstpoint:job.lastpoint + 1]]
+
     def get_scan_params(self, scan):
         energy = scan.metadata.dcm1energy
         UB = numpy.array(json.loads(scan.metadata.diffcalc_ub))
@@ -359,6 +359,12 @@ class SIXS(backend.InputBase):
                 raise
             self.metadata.add_section('sixs_backend', self.metadict)
 
+    def get_job_files(self, job):
+        files = [self.get_filename(job.scan)]
+        if self.config.maskmatrix is not None:
+            files.append(self.config.maskmatrix)
+        return files
+
     def parse_config(self, config):
         super(SIXS, self).parse_config(config)
         self.config.xmask = util.parse_multi_range(config.pop('xmask', None))  # Optional, select a subset of the image range in the x direction. all by default
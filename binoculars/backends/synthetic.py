@@ -0,0 +1,225 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+
+from .. import backend, errors, util
+from . import example
+
+
+'''
+Synthetic detector input for load testing the dispatchers and the binning
+engine offline at production scale: configurable detector size (up to 4k x 4k),
+frames per scan, data type and motor trajectory, deterministic per seed and
+scan number. The geometry and the projection are those of the example backend.
+
+By default the frames are generated in memory while processing. With
+storage = edf or storage = hdf5 they are written to disk first, while
+generating the jobs, and read back by the jobs, such that the I/O path is
+exercised too. The files are kept and reused by later runs with the same
+seed, detector size, frames per scan, counts and data type.
+'''
+
+DTYPES = 'uint16', 'uint32', 'int32', 'float32', 'float64'
+TRAJECTORIES = 'linear', 'random', 'fixed'
+STORAGES = 'memory', 'edf', 'hdf5'
+
+EDF_TYPES = {'uint16': 'UnsignedShort', 'uint32': 'UnsignedInteger', 'int32': 'SignedInteger', 'float32': 'FloatValue', 'float64': 'DoubleValue'}
+EDF_BLOCK = 512
+
+
+def write_edf(filename, data):
+    """Writes a 2D array as a single image EDF file (header padded to 512 byte blocks)"""
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+    header = '{{\nHeaderID = EH:000001:000000:000000 ;\nImage = 1 ;\nByteOrder = LowByteFirst ;\nDataType = {0} ;\nDim_1 = {1} ;\nDim_2 = {2} ;\nSize = {3} ;\n'.format(EDF_TYPES[data.dtype.name], data.shape[1], data.shape[0], data.nbytes)
+    size = -(-(len(header) + 2) // EDF_BLOCK) * EDF_BLOCK
+    with util.atomic_write(filename) as tmpfile:
+        with open(tmpfile, 'wb') as fp:
+            fp.write((header + ' ' * (size - len(header) - 2) + '}\n').encode('ascii'))
+            data.tofile(fp)
+
+
+def read_edf(filename):
+    """Reads the first image of an EDF file"""
+    with open(filename, 'rb') as fp:
+        header = b''
+        while not header.rstrip().endswith(b'}'):
+            block = fp.read(EDF_BLOCK)
+            if len(block) < EDF_BLOCK:
+                raise errors.FileError('{0} is not an EDF file'.format(filename))
+            header += block
+        keys = dict((key.strip(), value.strip()) for key, sep, value in (line.rstrip(' ;').partition('=') for line in header.decode('ascii').splitlines()) if sep)
+        types = dict((value, key) for key, value in EDF_TYPES.items())
+        dtype = np.dtype(types[keys['DataType']]).newbyteorder('>' if keys.get('ByteOrder') == 'HighByteFirst' else '<')
+        shape = int(keys['Dim_2']), int(keys['Dim_1'])
+        return np.fromfile(fp, dtype=dtype, count=shape[0] * shape[1]).reshape(shape)
+
+
+class QProjection(example.QProjection):
+    '''Same as example:qprojection'''
+
+
+class Input(backend.InputBase):
+    _offsets = None  # pixel offsets of the angles, see get_pixel_angles
+
+    def generate_jobs(self, command):
+        scans = util.parse_multi_range(','.join(command).replace(' ', ','))
+        if self.config.storage != 'memory':
+            for scanno in scans:
+                self.write_scan(scanno)
+        for scanno in scans:
+            yield backend.Job(scan=scanno, firstpoint=0, lastpoint=self.config.frames - 1, weight=self.config.frames)
+
+    def process_job(self, job):
+        super(Input, self).process_job(job)
+        weights = np.ones(self.config.shape)
+        for intensity, (af, delta, ai, omega) in zip(self.read_frames(job), self.get_trajectory(job)):
+            af, delta = self.get_pixel_angles(af, delta)
+            # counting statistics: the variance equals the counts
+            yield intensity, weights, intensity, (self.config.wavelength, af, delta, np.radians(omega), np.radians(ai))
+
+    def read_frames(self, job):
+        indices = range(job.firstpoint, job.lastpoint + 1)
+        if self.config.storage == 'hdf5':
+            with h5py.File(self.get_filename(job.scan), 'r') as fp:
+                for index in indices:
+                    yield fp['frames'][index]
+        elif self.config.storage == 'edf':
+            for index in indices:
+                yield read_edf(self.get_filename(job.scan, index))
+        else:
+            base = self.get_base(job.scan)
+            for index in indices:
+                yield self.get_frame(base, index)
+
+    def get_border_params(self, job):
+        border = np.ones(self.config.shape, dtype=bool)
+        border[1:-1, 1:-1] = False
+        for af, delta, ai, omega in self.get_trajectory(job):
+            af, delta = self.get_pixel_angles(af, delta)
+            yield self.config.wavelength, af[border], delta[border], np.radians(omega), np.radians(ai)
+
+    def get_job_files(self, job):
+        if self.config.storage == 'edf':
+            return [self.get_filename(job.scan, index) for index in range(job.firstpoint, job.lastpoint + 1)]
+        if self.config.storage == 'hdf5':
+            return [self.get_filename(job.scan)]
+        return ()
+
+    def get_pixel_count(self, job):
+        return self.config.shape[0] * self.config.shape[1]
+
+    def get_destination_options(self, command):
+        if not command:
+            return False
+        command = ','.join(command).replace(' ', ',')
+        scans = util.parse_multi_range(command)
+        return dict(first=min(scans), last=max(scans), range=','.join(command))
+
+    ### generating the data
+    def get_trajectory(self, job):
+        '''Yields (af, delta, ai, omega) in degrees for the points firstpoint to lastpoint of a scan'''
+        random = np.random.RandomState([self.config.seed, job.scan, 1])
+        frames = self.config.frames
+        if self.config.trajectory == 'linear':
+            motors = [np.linspace(0, random.random_sample() * self.config.range, frames) for i in range(4)]
+        elif self.config.trajectory == 'random':  # random walk covering about the same range
+            motors = [np.cumsum(random.standard_normal(frames)) * self.config.range / np.sqrt(frames) for i in range(4)]
+        else:
+            motors = [np.full(frames, random.random_sample() * self.config.range) for i in range(4)]
+        for point in range(job.firstpoint, job.lastpoint + 1):
+            yield tuple(motor[point] for motor in motors)
+
+    def get_base(self, scan):
+        '''Background counts of a scan, shifted from frame to frame'''
+        random = np.random.RandomState([self.config.seed, scan, 0])
+        return random.poisson(self.config.counts, self.config.shape).astype(self.config.dtype)
+
+    def get_frame(self, base, index):
+        '''Frame 'index' of a scan: the rolled background plus a peak moving along the detector'''
+        rows, cols = self.config.shape
+        frame = np.roll(base, index, axis=1)
+        sigma = max(1., min(rows, cols) / 64.)
+        row, col = rows // 2, int(index * cols / float(self.config.frames))
+        window = tuple(slice(max(0, c - int(3 * sigma)), min(n, c + int(3 * sigma) + 1)) for c, n in ((row, rows), (col, cols)))
+        y, x = np.ogrid[window]
+        peak = 50 * self.config.counts * np.exp(-((y - row)**2 + (x - col)**2) / (2 * sigma**2))
+        frame[window] += peak.astype(frame.dtype)
+        return frame
+
+    def get_pixel_angles(self, af, delta):
+        '''Angles (in radians) of every pixel, the pixel offsets are calculated once'''
+        if self._offsets is None:
+            app = np.degrees(np.arctan(np.array(self.config.pixelsize) / self.config.sdd))
+            rows, cols = self.config.shape
+            centralpixel = self.config.centralpixel  # (column, row) = (delta, af)
+            af_range = -app[1] * (np.arange(rows) - centralpixel[1])
+            delta_range = app[0] * (np.arange(cols) - centralpixel[0])
+            delta_offsets, af_offsets = np.meshgrid(np.radians(delta_range), np.radians(af_range))
+            self._offsets = af_offsets, delta_offsets
+        return self._offsets[0] + np.radians(af), self._offsets[1] + np.radians(delta)
+
+    ### storage
+    def get_filename(self, scan, index=None):
+        # every setting the content of the frames depends on
+        name = 'synthetic_{0}_{1}_{2[0]}x{2[1]}_{3}_{4}_{5}'.format(self.config.seed, scan, self.config.shape, self.config.frames, self.config.counts, self.config.dtype)
+        if self.config.storage == 'hdf5':
+            return os.path.join(self.config.directory, '{0}.h5'.format(name))
+        return os.path.join(self.config.directory, name, '{0:05d}.edf'.format(index))
+
+    def write_scan(self, scan):
+        '''Writes the frames of a scan that are not on disk yet'''
+        if self.config.storage == 'hdf5':
+            filename = self.get_filename(scan)
+            if os.path.exists(filename):
+                with h5py.File(filename, 'r') as fp:
+                    if fp['frames'].shape[0] == self.config.frames:
+                        return
+            directory = self.config.directory
+            missing = range(self.config.frames)
+        else:
+            directory = os.path.dirname(self.get_filename(scan, 0))
+            missing = [index for index in range(self.config.frames) if not os.path.exists(self.get_filename(scan, index))]
+            if not missing:
+                return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        util.statusnl('writing {0} synthetic frames of scan {1} to {2}'.format(len(missing), scan, directory))
+        base = self.get_base(scan)
+        if self.config.storage == 'hdf5':
+            with util.atomic_write(filename) as tmpfile:
+                with h5py.File(tmpfile, 'w') as fp:
+                    frames = fp.create_dataset('frames', (self.config.frames, ) + self.config.shape, dtype=self.config.dtype, chunks=(1, ) + self.config.shape)
+                    for index in missing:
+                        frames[index] = self.get_frame(base, index)
+        else:
+            for index in missing:
+                write_edf(self.get_filename(scan, index), self.get_frame(base, index))
+
+    def parse_config(self, config):
+        super(Input, self).parse_config(config)
+        self.config.shape = util.parse_tuple(config.pop('shape', '512,512'), length=2, type=int)  # optionally, detector size in pixels (rows, columns), up to 4096,4096. 512,512 by default
+        if not all(0 < n <= 4096 for n in self.config.shape):
+            raise errors.ConfigError('detector shape {0} out of range, at most 4096,4096'.format(self.config.shape))
+        self.config.frames = int(config.pop('frames', 100))  # optionally, images per scan, 100 by default
+        self.config.dtype = config.pop('dtype', 'uint16').lower()  # optionally, data type of the images: uint16, uint32, int32, float32 or float64. uint16 by default
+        if self.config.dtype not in DTYPES:
+            raise errors.ConfigError('dtype {0} not supported, choose from {1}'.format(self.config.dtype, ', '.join(DTYPES)))
+        self.config.counts = int(config.pop('counts', 10))  # optionally, mean background counts per pixel, 10 by default
+        self.config.trajectory = config.pop('trajectory', 'linear').lower()  # optionally, motor trajectory of a scan: linear, random (random walk) or fixed (no motor moves). linear by default
+        if self.config.trajectory not in TRAJECTORIES:
+            raise errors.ConfigError('trajectory {0} not supported, choose from {1}'.format(self.config.trajectory, ', '.join(TRAJECTORIES)))
+        self.config.range = float(config.pop('range', 20))  # optionally, maximum range of every motor in degrees, 20 by default
+        self.config.seed = int(config.pop('seed', 0))  # optionally, seed of the generated data, together with the scan number. 0 by default
+        self.config.storage = config.pop('storage', 'memory').lower()  # optionally, memory: generate the frames while processing. edf or hdf5: write the frames to directory first (one file per frame or per scan) and read them back
+        if self.config.storage not in STORAGES:
+            raise errors.ConfigError('storage {0} not supported, choose from {1}'.format(self.config.storage, ', '.join(STORAGES)))
+        self.config.directory = config.pop('directory', os.path.join(tempfile.gettempdir(), 'binoculars-synthetic'))  # optionally, directory of the files with storage edf or hdf5, must be shared with the nodes of a cluster. binoculars-synthetic in the temporary directory by default
+        self.config.wavelength = float(config.pop('wavelength', 0.5))  # optionally, 0.5 by default
+        self.config.sdd = float(config.pop('sdd', 636))  # optionally, sample detector distance, 636 by default
+        self.config.pixelsize = util.parse_tuple(config.pop('pixelsize', '0.055,0.055'), length=2, type=float)  # optionally, 0.055,0.055 by default
+        centralpixel = config.pop('centralpixel', None)  # optionally, (column, row) of the direct beam, the center of the detector by default
+        if centralpixel is None:
+            self.config.centralpixel = self.config.shape[1] / 2., self.config.shape[0] / 2.
+        else:
+            self.config.centralpixel = util.parse_tuple(centralpixel, length=2, type=float)
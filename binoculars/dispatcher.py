@@ -1,7 +1,13 @@
 import sys
 import os
+import re
 import time
+import shlex
+import hashlib
 import itertools
+import threading
+import warnings
+import traceback
 import subprocess
 import multiprocessing
 
@@ -9,10 +15,16 @@ from . import util, errors, space
 
 #python3 support
 PY3 = sys.version_info > (3,)
+if PY3:
+    import queue
+else:
+    import Queue as queue
 
 class Destination(object):
     type = filename = overwrite = value = config = limits = None
+    append = False
     opts = {}
+    storage = {}
 
     def set_final_filename(self, filename, overwrite):
         self.type = 'final'
@@ -23,6 +35,14 @@ class Destination(object):
         if opts is not False:
             self.opts = opts
 
+    def set_append(self, append):
+        """Add the output to the existing final files instead of replacing them"""
+        self.append = append
+
+    def set_storage(self, storage):
+        """Options for Space.tofile(), see space.dataset_options()"""
+        self.storage = storage
+
     def set_limits(self, limits):
         self.limits = limits
 
@@ -47,7 +67,10 @@ class Destination(object):
         elif self.type == 'final':
             for sp, fn in zip(verse.spaces, self.final_filenames()):
                 sp.config = self.config
-                sp.tofile(fn)
+                if self.append and os.path.exists(fn):
+                    sp.addtofile(fn, **self.storage)
+                else:
+                    sp.tofile(fn, **self.storage)
 
     def retrieve(self):
         if self.type == 'memory':
@@ -59,20 +82,179 @@ class Destination(object):
             base, ext = os.path.splitext(self.filename)
             for limlabel in util.limit_to_filelabel(self.limits):
                 fn = (base + '_' + limlabel + ext).format(**self.opts)
-                if not self.overwrite:
+                if not self.overwrite and not self.append:
                     fn = util.find_unused_filename(fn)
                 fns.append(fn)
         else:
             fn = self.filename.format(**self.opts)
-            if not self.overwrite:
+            if not self.overwrite and not self.append:
                 fn = util.find_unused_filename(fn)
             fns.append(fn)
         return fns
 
+    def get_stored_jobs(self):
+        """Returns {scan key: points} of the jobs in the existing final files
+        (see util.scan_key()), the points being a set of point numbers, or
+        None for jobs without a range of points"""
+        stored = {}
+        for fn in self.final_filenames():
+            if not os.path.exists(fn):
+                continue
+            for meta in util.MetaData.fromfile(fn).metas:
+                if 'binoculars' in meta.sections and 'scankey' in meta.binoculars:
+                    key = meta.binoculars['scankey']
+                    key = key.decode('utf-8') if isinstance(key, bytes) else str(key)
+                    if 'firstpoint' in meta.binoculars:
+                        points = stored.setdefault(key, set())
+                        if points is not None:
+                            points.update(range(int(meta.binoculars['firstpoint']), int(meta.binoculars['lastpoint']) + 1))
+                    else:
+                        stored[key] = None
+                elif 'job' in meta.sections:
+                    raise errors.FileError('cannot append to {0}: it does not record which scans and points it contains (written by an older version of BINoculars), process all jobs without append'.format(fn))
+        return stored
+
+def source_key(job, files):
+    """Identifies the result of a Job() by its attributes and the size and
+    modification time of the files it reads (see InputBase.get_job_files()).
+    None if the files are unknown or one of them is missing: the result
+    cannot be reused then."""
+    if files is None:
+        return None
+    stats = []
+    for filename in files:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        stats.append((os.path.abspath(filename), stat.st_size, stat.st_mtime))
+    return hashlib.sha1(repr((util.job_key(job), stats)).encode('utf-8')).hexdigest()
+
+
+class Checkpoint(object):
+    """Stores the result of every job of a run in a directory and lists it in
+    a manifest, such that an interrupted run can be resumed: jobs that are
+    in the manifest are not processed again. Jobs are identified by their
+    attributes and source files (see source_key()), runs by the input and
+    projection configuration (each configuration gets its own subdirectory).
+    Jobs of which the source files are unknown are not checkpointed."""
+
+    def __init__(self, directory, identity):
+        self.directory = os.path.join(directory, hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16])
+        self.manifest = os.path.join(self.directory, 'manifest.txt')
+
+    def get_key(self, job, files):
+        """Returns the key of the result of 'job', None if it cannot be checkpointed"""
+        return source_key(job, files)
+
+    def store(self, key, job, verse):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created concurrently
+                if not os.path.isdir(self.directory):
+                    raise
+        verse.tofile(os.path.join(self.directory, '{0}.hdf5'.format(key)))
+        # one short line per write, appended atomically by concurrent processes
+        with open(self.manifest, 'a') as fp:
+            fp.write('{0}\t{1!r}\n'.format(key, sorted(job.__dict__.items())))
+
+    def get_completed(self):
+        """Returns {key: filename} of the jobs in the manifest"""
+        completed = {}
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as fp:
+                for line in fp:
+                    key = line.split('\t', 1)[0]
+                    filename = os.path.join(self.directory, '{0}.hdf5'.format(key))
+                    if line.endswith('\n') and os.path.exists(filename):
+                        completed[key] = filename
+        return completed
+
+    def resume(self, jobs, get_job_files):
+        """Returns the jobs that still have to be processed, and the result files of the others"""
+        completed = self.get_completed()
+        remaining, files = [], []
+        for job in jobs:
+            key = self.get_key(job, get_job_files(job))
+            if key is not None and key in completed:
+                files.append(completed.pop(key))  # pop: the same job twice is processed twice
+            else:
+                remaining.append(job)
+        if files:
+            util.statusnl('resuming from checkpoint {0}: {1} jobs completed, {2} remaining'.format(self.directory, len(files), len(remaining)))
+        return remaining, files
+
+
+class ResultCache(object):
+    """Content-addressed cache of job results in a directory, shared between
+    runs. Entries are keyed by the input and projection configuration, the
+    attributes of the job and the size and modification time of its source
+    files (see source_key()); jobs of which the source files are unknown are
+    not cached. Beyond 'maxsize' bytes, the least recently used entries are
+    removed."""
+
+    def __init__(self, directory, identity, maxsize):
+        self.directory = directory
+        self.identity = identity
+        self.maxsize = maxsize
+
+    def get_key(self, job, files):
+        """Returns the key of the result of 'job', None if it cannot be cached"""
+        key = source_key(job, files)
+        if key is None:
+            return None
+        return hashlib.sha1(repr((self.identity, key)).encode('utf-8')).hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, '{0}.hdf5'.format(key))
+
+    def load(self, key):
+        """Returns the cached Multiverse, None if there is none"""
+        filename = self.get_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            verse = space.Multiverse.fromfile(filename)
+            os.utime(filename, None)  # the modification time orders the entries for eviction
+        except (errors.HDF5FileError, OSError, TypeError):  # evicted concurrently, or damaged
+            return None
+        return verse
+
+    def store(self, key, verse):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created concurrently
+                if not os.path.isdir(self.directory):
+                    raise
+        verse.tofile(self.get_filename(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.hdf5'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:  # removed concurrently
+                pass
+            total -= size
+
 
 class DispatcherBase(util.ConfigurableObject):
     def __init__(self, config, main):
         self.main = main
+        self.profiles = []  # util.Profile of the workers, see Main.write_profile()
         super(DispatcherBase, self).__init__(config)
 
     def parse_config(self, config):
@@ -81,9 +263,44 @@ class DispatcherBase(util.ConfigurableObject):
         destination = config.pop('destination', 'output.hdf5')  # optional 'output.hdf5' by default
         overwrite = util.parse_bool(config.pop('overwrite', 'false'))  #by default: numbered files in the form output_  # .hdf5:
         self.config.destination.set_final_filename(destination, overwrite)  # explicitly parsing the options first helps with the debugging
+        storage = {}
+        compression = config.pop('compression', None)  # optional, codec of the output datasets: none, lzf, gzip or gzip:<level 0-9>. gzip by default
+        if compression is not None:
+            storage['compression'] = compression
+        shuffle = config.pop('shuffle', None)  # optional, apply the shuffle filter before compression, false by default
+        if shuffle is not None:
+            storage['shuffle'] = util.parse_bool(shuffle)
+        chunks = config.pop('chunks', None)  # optional, chunk shape of the output datasets, e.g. 4,4,0 for reading rods along the last axis (0 = full axis). automatic by default
+        if chunks is not None and chunks.lower() != 'auto':
+            storage['chunks'] = util.parse_tuple(chunks, type=int)
+        try:
+            space.dataset_options((1, ) * len(storage.get('chunks', ())), **storage)  # fail early on invalid options, not when the output is written
+        except ValueError as e:
+            raise errors.ConfigError('invalid storage options of the destination: {0}'.format(e))
+        self.config.destination.set_storage(storage)
+        self.config.destination.set_append(util.parse_bool(config.pop('append', 'false')))  # optionally, add the output to the existing destination files, processing only the jobs they do not contain yet. false by default
         self.config.host = config.pop('host', None)  # ip adress of the running gui awaiting the spaces
         self.config.port = config.pop('port', None)  # port of the running gui awaiting the spaces
         self.config.send_to_gui = util.parse_bool(config.pop('send_to_gui', 'false'))  # previewing the data, if true, also specify host and port
+        checkpoint = config.pop('checkpoint', None)  # optionally, directory to keep the result of every job, such that an interrupted run can be resumed by running it again. Not supported by the threaded dispatcher, nor by inputs that do not list the files of their jobs
+        if checkpoint is not None:
+            checkpoint = Checkpoint(checkpoint, self.get_identity())
+        self.config.checkpoint = checkpoint
+        self.config.resumed = ()  # result files of the jobs completed by a previous run, see Checkpoint
+        cache = config.pop('cache', None)  # optionally, directory of a cache of job results shared between runs, used by all dispatchers except threaded and local with shared = true, for inputs that list the files of their jobs
+        cachesize = float(config.pop('cachesize', 10240))  # optionally, size limit of the cache in MB, 10240 by default
+        if cache is not None:
+            cache = ResultCache(cache, self.get_identity(), cachesize * 2**20)
+        self.config.cache = cache
+        self.config.trace = config.pop('trace', None)  # optionally, file to write the processing stages of the dispatcher and the workers to as span events in the Chrome trace event format. Also set by the --trace command line option
+        self.config.profile = config.pop('profile', None)  # optionally, report the time spent per processing stage and counters at the end of the run: '-' prints them, otherwise they are dumped as JSON into the given file. Also set by the --profile command line option
+
+    def get_identity(self):
+        """The configuration that determines the result of a job"""
+        return repr([sorted(item for item in self.main.config.input.items() if item[0] != 'target_weight'), sorted(self.main.config.projection.items())])  # target_weight only affects scheduling
+
+    def resumed_verses(self):
+        return (space.Multiverse.fromfile(filename) for filename in self.config.resumed)
 
     def send(self, verses):  # provides the possiblity to send the results to the gui over the network
         if self.config.send_to_gui or (self.config.host is not None and self.config.host is not None):  # only continue of ip is specified and send_to_server is flagged
@@ -119,7 +336,7 @@ class SingleCore(DispatcherBase):
             yield self.main.process_job(job)
 
     def sum(self, results):
-        return space.chunked_sum(self.send(results))
+        return space.chunked_sum(itertools.chain(self.send(results), self.resumed_verses()))
 
 
 # Base class for Dispatchers using subprocesses to do some work.
@@ -131,6 +348,14 @@ class ReentrantBase(DispatcherBase):
         self.config.action = config.pop('action', 'user').lower()
         if self.config.action not in self.actions:
             raise errors.ConfigError('action {0} not recognized for {1}'.format(self.config.action, self.__class__.__name__))
+        self.config.schedule = config.pop('schedule', 'order').lower()  # optionally, order: process the jobs as the input generates them (e.g. while waiting for data being measured). cost: collect all jobs, split big jobs and start the most expensive jobs first, by their estimated cost. order by default
+        if self.config.schedule not in ('cost', 'order'):
+            raise errors.ConfigError('schedule {0} not recognized for {1}, expected cost or order'.format(self.config.schedule, self.__class__.__name__))
+
+    def cluster_jobs(self, jobs):
+        if self.config.schedule == 'cost':
+            return self.main.cluster_jobs(jobs, split=self.config.checkpoint is None)  # split jobs would not match the checkpoint of a rerun
+        return util.cluster_jobs2(jobs, self.main.input.config.target_weight)
 
     def has_specific_task(self):
         if self.config.action == 'user':
@@ -152,20 +377,83 @@ class Local(ReentrantBase):
         self.config.ncores = int(config.pop('ncores', 0))  # optionally, specify number of cores (autodetect by default)
         if self.config.ncores <= 0:
             self.config.ncores = multiprocessing.cpu_count()
+        self.config.flushsize = float(config.pop('flushsize', 1024))  # optionally, size in MB of the running sum of a worker process at which it is handed to the main process, 1024 by default
+        self.config.shared = util.parse_bool(config.pop('shared', 'false'))  # optionally, with fixedgrid or prepass in the projection: all workers bin directly into one output grid in shared memory (python 3.8+). false by default
+        if self.config.shared and space.shared_memory is None:
+            raise errors.ConfigError('shared = true requires python 3.8 or newer')
 
     def process_jobs(self, jobs):
         if self.config.ncores == 1 and not PY3:  # note: SingleCore will be marginally faster
-            map = itertools.imap
-        else:
-            pool = multiprocessing.Pool(self.config.ncores)
-            map = pool.imap_unordered
+            yield space.chunked_sum(self.main.process_job(job) for job in jobs)
+            return
 
-        configs = (self.prepare_config(job) for job in jobs)
-        for result in map(self.main.get_reentrant(), configs):
-            yield result
+        # the configuration is shipped once per worker process, which sets up
+        # the projection and input once and sums its results itself: only
+        # the partial sums of the workers are returned
+        if self.config.schedule == 'cost':
+            jobs = self.main.schedule_jobs(jobs, self.config.ncores, split=self.config.checkpoint is None)  # split jobs would not match the checkpoint of a rerun
+        shared = None
+        if self.config.shared and self.config.checkpoint is not None:
+            warnings.warn('shared memory binning does not keep the results per job, binning per worker to checkpoint them')
+        elif self.config.shared:
+            jobs = list(jobs)
+            axes = self.main.get_axes(jobs)
+            if axes is None:
+                warnings.warn('shared memory binning requires output axes known in advance (fixedgrid or prepass), binning per worker')
+            else:
+                shared = tuple(space.SharedSpace(ax) for ax in axes)
+
+        jobqueue = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        config = self.main.clone_config()
+        workers = [multiprocessing.Process(target=self.main.get_worker(), args=(config, jobqueue, results, self.config.flushsize * 2**20, shared)) for i in range(self.config.ncores)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for job in jobs:
+                jobqueue.put(job)
+            for worker in workers:
+                jobqueue.put(None)
+
+            running = len(workers)
+            while running:
+                try:
+                    with self.main.stage('wait'):
+                        result = results.get(timeout=1)
+                except queue.Empty:
+                    if any(worker.exitcode for worker in workers):
+                        raise errors.SubprocessError('worker process exited unexpectedly')
+                    continue
+                if result is None:
+                    running -= 1
+                elif isinstance(result, errors.SubprocessError):
+                    raise result
+                elif isinstance(result, util.SharedMetaData):
+                    for sp, metadata in zip(shared, result.metadata):
+                        sp.metadata += metadata
+                elif isinstance(result, util.Profile):
+                    self.profiles.append(result)
+                else:
+                    yield result
+            for worker in workers:
+                worker.join()
+            if shared is not None:
+                yield space.Multiverse(space.trimmed(sp.tospace()) for sp in shared)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for sp in shared or ():
+                sp.close()
 
     def sum(self, results):
-        return space.chunked_sum(self.send(results))
+        # reduced while the results arrive, see space.parallel_sum: only a
+        # few partial sums of the workers are kept at any time
+        verses = self.send(results)
+        if self.config.resumed:
+            verses = itertools.chain(verses, [space.chunked_sum(self.resumed_verses())])
+        return space.parallel_sum(verses)
 
     def run_specific_task(self, command):
         if command:
@@ -182,6 +470,100 @@ class Local(ReentrantBase):
         config.dispatcher.job = job
         return config, ()
 
+# Bins in several threads of the main process, sharing the backends and the
+# output: no process spawning, config pickling or result transfer. A reader
+# thread decodes images ahead of the binning threads. Suits interactive use
+# and backends that release the GIL.
+class Threaded(DispatcherBase):
+    def parse_config(self, config):
+        super(Threaded, self).parse_config(config)
+        self.config.nthreads = int(config.pop('nthreads', 0))  # optionally, number of binning threads (number of cores by default)
+        if self.config.nthreads <= 0:
+            self.config.nthreads = multiprocessing.cpu_count()
+        self.config.prefetch = int(config.pop('prefetch', 16))  # optionally, number of images decoded ahead of the binning threads, 16 by default
+        if self.config.checkpoint is not None:
+            raise errors.ConfigError('checkpoint is not supported by the threaded dispatcher, the threads do not keep the results per job')
+
+    def process_jobs(self, jobs):
+        main = self.main
+        jobs = list(jobs)
+        limits = main.projection.config.limits
+        if limits is None:
+            limits = (None, )
+        # bin into one output per limit set if the axes are known in advance,
+        # otherwise every thread sums spaces sized to the images
+        axes = main.get_axes(jobs)
+        shared = None if axes is None else tuple(space.LockedSpace(ax) for ax in axes)
+
+        frames = queue.Queue(max(1, self.config.prefetch))
+        metadata = []  # per job
+        hits = set()  # (job index, limit set index) of the outputs that received data
+        overflow = tuple([] for lim in limits)
+        partials = []
+        failures = []
+
+        def read():
+            try:
+                for index, job in enumerate(jobs):
+                    for image in main.read_job(job):
+                        if failures:
+                            return
+                        frames.put((index, image))
+                    metadata.append(main.input.metadata)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                for i in range(self.config.nthreads):
+                    frames.put(None)
+
+        def work():
+            partial = space.EmptyVerse()
+            for item in iter(frames.get, None):
+                if failures:
+                    continue  # drain the queue, such that the reader finishes
+                index, (intensity, weights, variances, params) = item
+                try:
+                    with main.stage('project'):
+                        coords = main.projection.project(*params)
+                    if shared is not None:
+                        for i, (sp, lim, spill) in enumerate(zip(shared, limits, overflow)):
+                            if main.bin_limited(sp, lim, (coords, intensity, weights, variances), spill):
+                                hits.add((index, i))
+                    else:
+                        with main.stage('bin'):
+                            verse = main.image_verse(intensity, weights, variances, coords)
+                        hits.update((index, i) for i, sp in enumerate(verse.spaces) if isinstance(sp, space.Space))
+                        partial += verse
+                except Exception as e:
+                    failures.append(e)
+            if isinstance(partial, space.Multiverse):
+                partials.append(partial)
+
+        threads = [threading.Thread(target=read)] + [threading.Thread(target=work) for i in range(self.config.nthreads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        with main.stage('wait'):
+            for thread in threads:
+                thread.join()
+        if failures:
+            raise failures[0]
+
+        if shared is not None:
+            spaces = [space.sum((space.trimmed(sp.tospace()), ) + tuple(spill)) for sp, spill in zip(shared, overflow)]
+        elif partials:
+            spaces = space.parallel_sum(partials).spaces
+        else:
+            spaces = [space.EmptySpace() for lim in limits]
+        for index, i in sorted(hits):
+            if isinstance(spaces[i], space.Space):
+                spaces[i].metadata.add_dataset(metadata[index])
+        yield space.Multiverse(spaces)
+
+    def sum(self, results):
+        return space.chunked_sum(self.send(results))
+
+
 # Dispatch many worker processes on an Oar cluster.
 
 
@@ -194,11 +576,12 @@ class Oar(ReentrantBase):
         self.config.tmpdir = config.pop('tmpdir', os.getcwd())  # Optional, current directory by default
         self.config.oarsub_options = config.pop('oarsub_options', 'walltime=0:15')  # optionally, tweak oarsub parameters
         self.config.executable = config.pop('executable', ' '.join(util.get_python_executable()))  # optionally, override default location of python and/or BINoculars installation
+        self.config.fanin = int(config.pop('fanin', 16))  # optionally, maximum number of intermediate results summed by one job: larger numbers are summed by a tree of merge jobs, 0 sums everything in the final job. 16 by default
 
     def process_jobs(self, jobs):
         self.configfiles = []
         self.intermediates = []
-        clusters = util.cluster_jobs2(jobs, self.main.input.config.target_weight)
+        clusters = self.cluster_jobs(jobs)
         for jobscluster in clusters:
             uniq = util.uniqid()
             jobconfig = os.path.join(self.config.tmpdir, 'binoculars-{0}-jobcfg.zpi'.format(uniq))
@@ -208,19 +591,43 @@ class Oar(ReentrantBase):
             interm = os.path.join(self.config.tmpdir, 'binoculars-{0}-jobout.hdf5'.format(uniq))
             self.intermediates.append(interm)
             config.dispatcher.destination.set_tmp_filename(interm)
-            config.dispatcher.sum = ()
+            config.dispatcher.sum = config.dispatcher.resumed = ()
 
             config.dispatcher.action = 'process'
             config.dispatcher.jobs = jobscluster
             util.zpi_save(config, jobconfig)
             yield self.oarsub(jobconfig)
 
+        # sum the intermediates by a tree of merge jobs, which start summing as
+        # soon as their inputs appear, such that the final job sums only a few
+        merges = []
+
+        def merge(group):
+            uniq = util.uniqid()
+            jobconfig = os.path.join(self.config.tmpdir, 'binoculars-{0}-jobcfg.zpi'.format(uniq))
+            self.configfiles.append(jobconfig)
+            interm = os.path.join(self.config.tmpdir, 'binoculars-{0}-jobout.hdf5'.format(uniq))
+            self.intermediates.append(interm)
+            config = self.main.clone_config()
+            config.dispatcher.destination.set_tmp_filename(interm)
+            config.dispatcher.sum = group
+            config.dispatcher.resumed = ()
+            config.dispatcher.action = 'process'
+            config.dispatcher.jobs = ()
+            util.zpi_save(config, jobconfig)
+            merges.append(self.oarsub(jobconfig))
+            return interm
+        inputs = util.merge_tree(self.intermediates[:], self.config.fanin, merge)
+        for jobid in merges:
+            yield jobid
+
         #if all jobs are sent to the cluster send the process that sums all other jobs
         uniq = util.uniqid()
         jobconfig = os.path.join(self.config.tmpdir, 'binoculars-{0}-jobcfg.zpi'.format(uniq))
         self.configfiles.append(jobconfig)
         config = self.main.clone_config()
-        config.dispatcher.sum = self.intermediates
+        config.dispatcher.sum = inputs
+        config.dispatcher.resumed = self.config.resumed
         config.dispatcher.action = 'process'
         config.dispatcher.jobs = ()
         util.zpi_save(config, jobconfig)
@@ -234,15 +641,18 @@ class Oar(ReentrantBase):
         return True
 
     def run_specific_task(self, command):
-        if self.config.action != 'process' or (not self.config.jobs and not self.config.sum) or command:
+        if self.config.action != 'process' or (not self.config.jobs and not self.config.sum and not self.config.resumed) or command:
             raise errors.SubprocessError("invalid command, too many parameters or no jobs/sum given")
 
         jobs = sum = space.EmptyVerse()
         if self.config.jobs:
             jobs = space.verse_sum(self.send(self.main.process_job(job) for job in self.config.jobs))
-        if self.config.sum:
-            sum = space.chunked_sum(space.Multiverse.fromfile(src) for src in util.yield_when_exists(self.config.sum))
-        self.config.destination.store(jobs + sum)
+        if self.config.sum or self.config.resumed:
+            sum = space.chunked_sum(itertools.chain((space.Multiverse.fromfile(src) for src in util.yield_when_exists(self.config.sum)), self.resumed_verses()))
+        with self.main.stage('store'):
+            self.config.destination.store(jobs + sum)
+        if self.config.profile:  # ends up in the output file of the job
+            util.statusnl(util.Profile.report([self.main.profile]))
 
     ### calling OAR
     @staticmethod
@@ -330,3 +740,249 @@ class Oar(ReentrantBase):
 
         if len(errorfn) > 0:
             print('Warning! {0} job(s) failed. See above for the details or the error log files: {1}'.format(len(errorfn), ', '.join(errorfn)))
+
+
+# Dispatch many worker processes through a batch scheduler, which is driven by
+# configurable submit, status and cancel commands (OAR by default, see
+# fakebatch.py for a local stand-in). Every job signals its completion with a
+# marker file, which is picked up as soon as it appears; the scheduler is only
+# queried every once in a while, for all jobs at once, to detect jobs that
+# died without leaving a marker.
+class Batch(ReentrantBase):
+    ### OFFICIAL API
+    actions = 'user', 'process'
+
+    def parse_config(self, config):
+        super(Batch, self).parse_config(config)
+        self.config.tmpdir = config.pop('tmpdir', os.getcwd())  # optionally, directory for job configurations, intermediate results and marker files, must be shared with the nodes. current directory by default
+        self.config.submit = config.pop('submit', 'oarsub -l walltime=0:15 {command}')  # optionally, command submitting {command} as a job
+        self.config.jobid = config.pop('jobid', r'OAR_JOB_ID=(\S+)')  # optionally, regular expression matching the job id in the output of submit
+        self.config.status = config.pop('status', 'oarstat -u -s')  # optionally, command listing the states of all queued and running jobs of the user
+        self.config.state = config.pop('state', r'^\s*(\S+?):\s*(\S+)')  # optionally, regular expression matching job id and state in every line of the output of status
+        self.config.cancel = config.pop('cancel', 'oardel {jobids}')  # optionally, command cancelling the jobs {jobids}
+        self.config.interval = float(config.pop('interval', 30))  # optionally, seconds between status queries, 30 by default
+        self.config.executable = config.pop('executable', ' '.join(util.get_python_executable()))  # optionally, override default location of python and/or BINoculars installation
+        self.config.fanin = int(config.pop('fanin', 16))  # optionally, maximum number of intermediate results summed by one job: larger numbers are summed by a tree of merge jobs, 0 sums everything in the final job. 16 by default
+        for key in ('jobid', 'state'):
+            try:
+                re.compile(getattr(self.config, key))
+            except re.error as e:
+                raise errors.ConfigError('invalid regular expression for {0}: {1}'.format(key, e))
+
+    def process_jobs(self, jobs):
+        bases = []
+        for jobscluster in self.cluster_jobs(jobs):
+            base = self.new_base()
+            bases.append(base)
+            config = self.job_config(base)
+            config.dispatcher.destination.set_tmp_filename(self.get_output(base))
+            config.dispatcher.jobs = jobscluster
+            yield base, self.submit_job(base, config)
+
+        # the outputs are summed by a tree of merge jobs, which start summing as
+        # soon as their inputs are done, such that the last job sums only a few
+        merges = []
+
+        def merge(group):
+            base = self.new_base()
+            config = self.job_config(base)
+            config.dispatcher.destination.set_tmp_filename(self.get_output(base))
+            config.dispatcher.sum = group
+            merges.append((base, self.submit_job(base, config)))
+            return base
+        bases = util.merge_tree(bases, self.config.fanin, merge)
+        for job in merges:
+            yield job
+
+        base = self.new_base()
+        config = self.job_config(base)
+        config.dispatcher.sum = bases
+        config.dispatcher.resumed = self.config.resumed
+        yield base, self.submit_job(base, config)
+
+    def sum(self, results):
+        jobs = dict(results)
+        try:
+            with self.main.stage('wait'):
+                failures = self.wait_for_jobs(jobs)
+            if self.main.profile is not None and not failures:
+                for base in jobs:
+                    self.profiles.extend(util.Profile.load(self.get_profile(base)))
+        finally:
+            self.cleanup(jobs)
+        if failures:
+            raise errors.SubprocessError('{0} job(s) failed:\n{1}'.format(len(failures), '\n'.join('job {0}: {1}'.format(jobid, msg) for jobid, msg in sorted(failures.items()))))
+        return True
+
+    def run_specific_task(self, command):
+        if self.config.action != 'process' or (not self.config.jobs and not self.config.sum and not self.config.resumed) or command:
+            raise errors.SubprocessError("invalid command, too many parameters or no jobs/sum given")
+
+        try:
+            jobs = sum = space.EmptyVerse()
+            if self.config.jobs:
+                jobs = space.verse_sum(self.send(self.main.process_job(job) for job in self.config.jobs))
+            if self.config.sum or self.config.resumed:
+                sum = space.chunked_sum(itertools.chain((space.Multiverse.fromfile(self.get_output(base)) for base in self.yield_when_done(self.config.sum)), self.resumed_verses()))
+            with self.main.stage('store'):
+                self.config.destination.store(jobs + sum)
+            if self.main.profile is not None:
+                self.main.profile.label = os.path.basename(self.config.marker)
+                util.Profile.dump([self.main.profile], self.get_profile(self.config.marker), events=True)
+        except Exception:
+            self.write_marker(self.config.marker, 'failed', traceback.format_exc())
+            raise
+        self.write_marker(self.config.marker, 'done')
+
+    ### job files
+    def new_base(self):
+        return os.path.join(self.config.tmpdir, 'binoculars-{0}'.format(util.uniqid()))
+
+    @staticmethod
+    def get_output(base):
+        return '{0}-jobout.hdf5'.format(base)
+
+    @staticmethod
+    def get_profile(base):
+        return '{0}-profile.json'.format(base)
+
+    @staticmethod
+    def get_files(base):
+        return ['{0}-jobcfg.zpi'.format(base), Batch.get_output(base), Batch.get_profile(base), '{0}.done'.format(base), '{0}.failed'.format(base)]
+
+    def job_config(self, base):
+        config = self.main.clone_config()
+        config.dispatcher.action = 'process'
+        config.dispatcher.marker = base
+        config.dispatcher.jobs = config.dispatcher.sum = config.dispatcher.resumed = ()
+        return config
+
+    @staticmethod
+    def write_marker(base, state, message=''):
+        filename = '{0}.{1}'.format(base, state)
+        with util.atomic_write(filename) as tmpfile:
+            with open(tmpfile, 'w') as fp:
+                fp.write(message)
+
+    @staticmethod
+    def read_marker(base):
+        """Returns True if the job is done, the error message if it failed, None otherwise"""
+        if os.path.exists('{0}.done'.format(base)):
+            return True
+        try:
+            with open('{0}.failed'.format(base)) as fp:
+                return fp.read() or 'failed'
+        except IOError:
+            return None
+
+    def yield_when_done(self, bases):
+        """Yields the jobs in 'bases' as they finish, raises SubprocessError when one failed"""
+        pending = set(bases)
+        with util.FileWatcher([self.config.tmpdir]) as watcher:
+            while pending:
+                for base in list(pending):
+                    state = self.read_marker(base)
+                    if state is True:
+                        pending.remove(base)
+                        yield base
+                    elif state is not None:
+                        raise errors.SubprocessError('input job {0} failed:\n{1}'.format(base, state))
+                if pending:
+                    watcher.wait(5)
+
+    def wait_for_jobs(self, jobs):
+        """Waits until all jobs ({base: jobid}) have finished, or one of them has
+        failed, in which case the others are cancelled. Returns {jobid: error message}
+        of the failed jobs."""
+        pending = dict(jobs)
+        failures = {}
+        missing = set()  # jobs not listed by the last status query
+        util.status('{0}: waiting for {1} jobs...'.format(time.ctime(), len(pending)))
+        with util.FileWatcher([self.config.tmpdir]) as watcher:
+            query = time.time() + self.config.interval
+            while pending and not failures:
+                for base in list(pending):
+                    state = self.read_marker(base)
+                    if state is True:
+                        del pending[base]
+                    elif state is not None:
+                        failures[pending.pop(base)] = state
+                if not pending or failures:
+                    break
+                if time.time() >= query:
+                    states = self.query_states()
+                    if states is not None:
+                        # the marker might not be visible yet on a network filesystem: a job
+                        # has failed if it is still missing from the next status query
+                        for base in missing & set(pending):
+                            if pending[base] not in states and self.read_marker(base) is None:
+                                failures[pending.pop(base)] = 'job disappeared from the queue without finishing (killed, or out of walltime?)'
+                        missing = set(base for base, jobid in pending.items() if jobid not in states)
+                        counts = {}
+                        for base, jobid in pending.items():
+                            counts[states.get(jobid, 'Unknown')] = counts.get(states.get(jobid, 'Unknown'), 0) + 1
+                        util.status('{0}: {1} jobs to go. {2}'.format(time.ctime(), len(pending), ', '.join('{0} {1}'.format(n, state.lower()) for state, n in sorted(counts.items()))))
+                    query = time.time() + self.config.interval
+                else:
+                    watcher.wait(query - time.time())
+        if pending:
+            self.cancel_jobs(pending.values())
+        util.statuseol()
+        return failures
+
+    def cleanup(self, jobs):
+        for base, jobid in jobs.items():
+            for filename in self.get_files(base):
+                if os.path.exists(filename):
+                    try:
+                        os.remove(filename)
+                    except Exception as e:
+                        print("unable to remove {0}: {1}".format(filename, e))
+
+    ### calling the scheduler
+    @staticmethod
+    def subprocess_run(*command):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        output, unused_err = process.communicate()
+        retcode = process.poll()
+        return retcode, output
+
+    @staticmethod
+    def format_command(template, command='', jobids=()):
+        """Splits 'template' into arguments, substituting {command} and {jobids}"""
+        args = []
+        for arg in shlex.split(template):
+            if arg == '{jobids}':
+                args.extend(str(jobid) for jobid in jobids)
+            else:
+                args.append(arg.replace('{command}', command))
+        return args
+
+    def submit_job(self, base, config):
+        jobconfig = self.get_files(base)[0]
+        util.zpi_save(config, jobconfig)
+        command = '{0} process {1}'.format(self.config.executable, jobconfig)
+        ret, output = self.subprocess_run(*self.format_command(self.config.submit, command=command))
+        match = re.search(self.config.jobid, output, re.MULTILINE)
+        if ret != 0 or not match:
+            raise errors.SubprocessError('submitting job failed (exit code {0}):\n{1}'.format(ret, output))
+        jobid = match.group(1)
+        util.status('{0}: Launched job {1}'.format(time.ctime(), jobid))
+        return jobid
+
+    def query_states(self):
+        """Returns {jobid: state} of all jobs known to the scheduler, None if the query failed"""
+        ret, output = self.subprocess_run(*self.format_command(self.config.status))
+        if ret != 0:
+            return None
+        states = {}
+        for line in output.splitlines():
+            match = re.match(self.config.state, line)
+            if match:
+                states[match.group(1)] = match.group(2)
+        return states
+
+    def cancel_jobs(self, jobids):
+        jobids = list(jobids)
+        if jobids:
+            self.subprocess_run(*self.format_command(self.config.cancel, jobids=jobids))
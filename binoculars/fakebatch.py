@@ -0,0 +1,126 @@
+"""Minimal stand-in for a batch scheduler, running the jobs in the background
+on the local machine. Allows trying out the batch dispatcher on one machine,
+for example with these options in the dispatcher section of the configfile:
+
+type = batch
+submit = python /path/to/binoculars/fakebatch.py submit {command}
+jobid = JOB_ID=(\\S+)
+status = python /path/to/binoculars/fakebatch.py status
+cancel = python /path/to/binoculars/fakebatch.py cancel {jobids}
+
+usage:
+  fakebatch.py submit COMMAND        run COMMAND in the background, prints JOB_ID=<id>
+  fakebatch.py status                prints '<id>: Running' for every job that has not finished
+  fakebatch.py cancel ID [ID ...]    terminates jobs
+
+The jobs are kept in a spool directory, $BINOCULARS_FAKEBATCH_SPOOL or
+binoculars-fakebatch in the temporary directory by default. The output of a job
+goes to <spool>/<id>.log. This module only depends on the standard library,
+such that it can be run as a script. POSIX only.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import errno
+import shlex
+import random
+import signal
+import tempfile
+import subprocess
+
+
+def get_spool():
+    spool = os.environ.get('BINOCULARS_FAKEBATCH_SPOOL', os.path.join(tempfile.gettempdir(), 'binoculars-fakebatch'))
+    if not os.path.isdir(spool):
+        try:
+            os.makedirs(spool)
+        except OSError as e:  # created concurrently
+            if e.errno != errno.EEXIST:
+                raise
+    return spool
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_jobs(spool):
+    """Returns {jobid: pid} of the jobs that have not finished, removes stale entries"""
+    jobs = {}
+    for jobid in os.listdir(spool):
+        filename = os.path.join(spool, jobid)
+        if jobid.endswith('.log'):
+            continue
+        try:
+            with open(filename) as fp:
+                pid = int(fp.read())
+        except (IOError, OSError, ValueError):  # just finished, or being written
+            continue
+        if is_alive(pid):
+            jobs[jobid] = pid
+        else:
+            remove(filename)
+    return jobs
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def submit(command):
+    spool = get_spool()
+    jobid = '{0:08x}'.format(random.getrandbits(32))
+    with open(os.path.join(spool, jobid + '.log'), 'wb') as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'run', jobid, command], stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid, close_fds=True)
+    with open(os.path.join(spool, jobid), 'w') as fp:
+        fp.write(str(process.pid))
+    print('JOB_ID={0}'.format(jobid))
+
+
+def run(jobid, command):
+    try:
+        return subprocess.call(shlex.split(command))
+    finally:
+        remove(os.path.join(get_spool(), jobid))
+
+
+def status():
+    for jobid in sorted(get_jobs(get_spool())):
+        print('{0}: Running'.format(jobid))
+
+
+def cancel(jobids):
+    jobs = get_jobs(get_spool())
+    for jobid in jobids:
+        if jobid in jobs:
+            try:
+                os.killpg(jobs[jobid], signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def main(args):
+    if len(args) >= 2 and args[0] == 'submit':
+        submit(' '.join(args[1:]))
+    elif len(args) == 3 and args[0] == 'run':
+        return run(args[1], args[2])
+    elif len(args) == 1 and args[0] == 'status':
+        status()
+    elif len(args) >= 2 and args[0] == 'cancel':
+        cancel(args[1:])
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,6 +2,7 @@ import os
 import sys
 import argparse
 import warnings
+import traceback
 
 import numpy as np
 
@@ -11,6 +12,8 @@ from . import space, backend, util, errors
 def parse_args(args):
     parser = argparse.ArgumentParser(prog='binoculars process')
     parser.add_argument('-c', metavar='SECTION:OPTION=VALUE', action='append', type=parse_commandline_config_option, default=[], help='additional configuration option in the form section:option=value')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='-', help='report the time spent per processing stage and counters at the end of the run, or dump them as JSON into FILE')
+    parser.add_argument('--trace', metavar='FILE', help='record the processing stages of the dispatcher and the workers as span events, written to FILE in the Chrome trace event format')
     parser.add_argument('configfile', help='configuration file')
     parser.add_argument('command', nargs='*', default=[])
     return parser.parse_args(args)
@@ -31,7 +34,61 @@ def multiprocessing_main(xxx_todo_changeme):  # note the double parenthesis for
     return config.dispatcher.destination.retrieve()
 
 
+def multiprocessing_worker(config, jobs, results, flushsize, shared=None):
+    """Worker process: sets up a Worker once from 'config' and processes the
+    Jobs from queue 'jobs' until it receives None, keeping a running sum of
+    the results. The sum is put on queue 'results' whenever it exceeds
+    'flushsize' bytes and at the end, followed by None. Exceptions are put
+    on the queue as SubprocessError.
+
+    If 'shared' is given (spaces in shared memory, one per limit set), the
+    data is binned directly into these spaces. The running sum then only
+    contains the points outside of them, the metadata of the jobs is put on
+    the queue as a util.SharedMetaData message before the final None."""
+    partial = space.EmptyVerse()
+    try:
+        worker = Worker(config)
+        if shared is not None:
+            metadata = tuple(util.MetaData() for sp in shared)
+        for job in iter(jobs.get, None):
+            if shared is None:
+                verse = worker.process_job(job)
+            else:
+                verse = worker.bin_job_shared(job, shared, metadata)
+            with worker.stage('sum'):
+                partial += verse
+            if partial.memory_size > flushsize:
+                with worker.stage('transfer'):
+                    results.put(partial)
+                partial = space.EmptyVerse()
+        if isinstance(partial, space.Multiverse):
+            with worker.stage('transfer'):
+                results.put(partial)
+        if shared is not None:
+            results.put(util.SharedMetaData(metadata))
+        if worker.profile is not None:
+            results.put(worker.profile)
+        results.put(None)
+    except Exception:
+        for sp in getattr(partial, 'spaces', ()):
+            space.discard(sp)  # the worker exits without garbage collecting the running sum
+        results.put(errors.SubprocessError('worker process failed:\n{0}'.format(traceback.format_exc())))
+
+
+def count_bins(sp):
+    """Number of grid points of 'sp' that received data, not counted (0) for
+    out-of-core and empty spaces"""
+    if isinstance(sp, space.SparseSpace):
+        return int(np.count_nonzero(sp.values[1]))
+    if isinstance(sp, space.DiskSpace) or not isinstance(sp, space.Space):
+        return 0
+    return int(np.count_nonzero(sp.contributions))
+
+
 class Main(object):
+    checkpoint = cache = None  # see dispatcher.Checkpoint and dispatcher.ResultCache
+    profile = None  # see util.Profile
+
     def __init__(self, config, command):
         if isinstance(config, util.ConfigSectionGroup):
             self.config = config.configfile.copy()
@@ -47,6 +104,13 @@ class Main(object):
         self.dispatcher = backend.get_dispatcher(config.dispatcher, self, default='local')
         self.projection = backend.get_projection(config.projection)
         self.input = backend.get_input(config.input)
+        space.set_precision(self.projection.config.precision)
+        self.checkpoint = self.dispatcher.config.checkpoint
+        self.cache = self.dispatcher.config.cache
+        if (self.checkpoint is not None or self.cache is not None) and type(self.input).get_job_files is backend.InputBase.get_job_files:
+            warnings.warn('{0} does not list the files its jobs read, their results are not checkpointed or cached'.format(type(self.input).__name__))
+        if self.dispatcher.config.profile or self.dispatcher.config.trace:
+            self.profile = util.Profile('job {0}'.format(os.getpid()) if self.dispatcher.has_specific_task() else 'main', trace=bool(self.dispatcher.config.trace))
 
         self.dispatcher.config.destination.set_final_options(self.input.get_destination_options(command))
         if 'limits' in self.config.projection:
@@ -64,10 +128,14 @@ class Main(object):
                 raise errors.FileError("configuration file '{0}' does not exist".format(args.configfile))
         configobj = False
         with open(args.configfile, 'rb') as fp:
-            if fp.read(2) == '\x1f\x8b':  # gzip marker
+            if fp.read(2) == b'\x1f\x8b':  # gzip marker
                 fp.seek(0)
                 configobj = util.zpi_load(fp)
         if not configobj:
+            if args.profile:
+                args.c.append(('dispatcher', 'profile', args.profile))
+            if args.trace:
+                args.c.append(('dispatcher', 'trace', args.trace))
             configobj = util.ConfigFile.fromtxtfile(args.configfile, command=args.command, overrides=args.c)
         return cls(configobj, args.command)
 
@@ -80,39 +148,305 @@ class Main(object):
         if self.dispatcher.has_specific_task():
             self.dispatcher.run_specific_task(command)
         else:
-            jobs = self.input.generate_jobs(command)
+            with self.stage('generate'):
+                jobs = self.input.generate_jobs(command)
+            destination = self.dispatcher.config.destination
+            if destination.append:
+                jobs = util.unstored_jobs(jobs, destination.get_stored_jobs())
+                if not jobs:
+                    util.statusnl('all jobs are in the destination already, nothing to append')
+                    self.result = True
+                    return
+                util.statusnl('appending {0} jobs to the destination'.format(len(jobs)))
+            if self.checkpoint is not None:
+                jobs, self.dispatcher.config.resumed = self.checkpoint.resume(jobs, self.input.get_job_files)
             tokens = self.dispatcher.process_jobs(jobs)
-            self.result = self.dispatcher.sum(tokens)
+            with self.stage('reduce'):
+                self.result = self.dispatcher.sum(tokens)
             if self.result is True:
                 pass
             elif isinstance(self.result, space.EmptySpace):
                 sys.stderr.write('error: output is an empty dataset\n')
             else:
-                self.dispatcher.config.destination.store(self.result)
+                if self.profile is not None:  # once for the output, not per job: it scans the whole grid
+                    for sp in self.result.spaces:
+                        self.profile.count('bins', count_bins(sp))
+                with self.stage('store'):
+                    self.dispatcher.config.destination.store(self.result)
+            if self.profile is not None:
+                self.write_profile()
+
+    def stage(self, name):
+        """Context manager timing processing stage 'name' if profiling, see util.Profile"""
+        if self.profile is None:
+            return util.no_stage
+        return self.profile.stage(name)
+
+    def write_profile(self):
+        """Prints the profile of the run, or dumps it as JSON into the file given
+        by the profile option, and writes the trace file given by the trace option"""
+        profiles = [self.profile] + self.dispatcher.profiles
+        if self.dispatcher.config.profile == '-':
+            util.statusnl(util.Profile.report(profiles))
+        elif self.dispatcher.config.profile:
+            util.Profile.dump(profiles, self.dispatcher.config.profile)
+        if self.dispatcher.config.trace:
+            util.Profile.write_trace(profiles, self.dispatcher.config.trace)
 
     def process_job(self, job):
-        def generator():
+        if self.profile is not None:
+            self.profile.start_job(', '.join('{0}={1}'.format(k, v) for k, v in sorted(job.__dict__.items()) if isinstance(v, (int, float, str))))
+        try:
+            return self._process_job(job)
+        finally:
+            if self.profile is not None:
+                self.profile.end_job()
+
+    def _process_job(self, job):
+        key = jobverse = None
+        if self.cache is not None or self.checkpoint is not None:
+            files = self.input.get_job_files(job)
+        if self.cache is not None:
+            key = self.cache.get_key(job, files)
+            if key is not None:
+                with self.stage('cache'):
+                    jobverse = self.cache.load(key)
+        if jobverse is None:
+            axes = self.get_job_axes(job)
+            if axes is None:
+                with self.stage('sum'):
+                    jobverse = space.chunked_sum(self.generate_verses(job), chunksize=25)
+            else:
+                with self.stage('sum'):
+                    jobverse = self.bin_job(job, axes)
+            for sp in jobverse.spaces:
+                if isinstance(sp, space.Space):
+                    sp.metadata.add_dataset(self.input.metadata)
+            if key is not None:
+                with self.stage('cache'):
+                    self.cache.store(key, jobverse)
+        if self.checkpoint is not None:
+            checkpointkey = self.checkpoint.get_key(job, files)
+            if checkpointkey is not None:
+                with self.stage('checkpoint'):
+                    self.checkpoint.store(checkpointkey, job, jobverse)
+        return jobverse
+
+    def iterate_job(self, job):
+        """Yields (intensity, weights, variances, coordinates) per image of 'job'"""
+        for intensity, weights, variances, params in self.read_job(job):
+            with self.stage('project'):
+                coords = self.projection.project(*params)
+            yield intensity, weights, variances, coords
+
+    def read_job(self, job):
+        """Yields (intensity, weights, variances, projection parameters) per
+        image of 'job', without projecting"""
+        images = iter(self.input.process_job(job))
+        while True:
+            with self.stage('read'):
+                processedjob = next(images, None)
+            if processedjob is None:
+                break
+            # old backends do not provide variances
+            if len(processedjob) == 3:
+                intensity, weights, params = processedjob
+                variances = np.full_like(intensity, np.nan)
+                warnings.warn('variances not found, consider changing your backend')
+            # new backends do provide variances
+            elif len(processedjob) == 4:
+                intensity, weights, variances, params = processedjob
+            if self.profile is not None:
+                self.profile.count('frames')
+                self.profile.count('pixels', np.size(intensity))
+                self.profile.count('bytes', sum(getattr(a, 'nbytes', 0) for a in (intensity, weights, variances)))
+            yield intensity, weights, variances, params
+
+    def generate_verses(self, job):
+        """Yields a Multiverse per image, with spaces sized to the image"""
+        for intensity, weights, variances, coords in self.iterate_job(job):
+            with self.stage('bin'):
+                verse = self.image_verse(intensity, weights, variances, coords)
+            yield verse
+
+    def image_verse(self, intensity, weights, variances, coords):
+        """Returns a Multiverse of a single image, with spaces sized to the image"""
+        res = self.projection.config.resolution
+        labels = self.projection.get_axis_labels()
+        if self.projection.config.limits == None:
+            return space.Multiverse((space.Space.from_image(res, labels, coords, intensity, weights=weights, variances=variances), ))
+        return space.Multiverse(space.Space.from_image(res, labels, coords, intensity, weights=weights, variances=variances, limits=limits) for limits in self.projection.config.limits)
+
+    def get_job_axes(self, job):
+        """Returns the Axes of the output spaces of 'job' (one per limit set)
+        if they are known before binning, None otherwise."""
+        return self.get_axes((job, ))
+
+    def get_axes(self, jobs):
+        """Returns the Axes of the output spaces of all 'jobs' (one per
+        limit set) if they are known before binning, None otherwise."""
+        if self.projection.config.fixedgrid:
+            axes = self.projection.get_limit_axes()
+            if axes is not None:
+                return axes
+        if self.projection.config.prepass:
+            return self.prepass(jobs)
+        return None
+
+    def prepass(self, jobs):
+        """Determines the Axes of the output spaces (one per limit set) of
+        'jobs' by projecting only the detector border of every image.
+        Returns None if the input backend does not support this or if there
+        is no data within the limits."""
+        res = self.projection.config.resolution
+        labels = self.projection.get_axis_labels()
+        limits = self.projection.config.limits
+        if limits is None:
+            limits = (None, )
+        extents = [None] * len(limits)
+        try:
+            for job in jobs:
+                for params in self.input.get_border_params(job):
+                    coords = self.projection.project(*params)
+                    for i, lim in enumerate(limits):
+                        if lim is None:
+                            selected = tuple(np.ravel(coord) for coord in coords)
+                        else:
+                            valid = space.limits_mask(coords, lim)
+                            if not valid.any():
+                                continue
+                            selected = tuple(np.ravel(coord)[valid] for coord in coords)
+                        extent = tuple((coord.min(), coord.max()) for coord in selected)
+                        if extents[i] is not None:
+                            extent = tuple((min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(extent, extents[i]))
+                        extents[i] = extent
+        except NotImplementedError:
+            warnings.warn('prepass not supported by {0}, sizing the output per image'.format(self.input.__class__.__name__))
+            return None
+        if any(extent is None for extent in extents):
+            return None
+        return tuple(space.Axes(space.Axis(mi, ma, r, label) for (mi, ma), r, label in zip(extent, res, labels)) for extent in extents)
+
+    def bin_job(self, job, axes):
+        """Bins all images of 'job' in place into a single preallocated space
+        per limit set, the spaces are trimmed afterwards. Points outside the
+        preallocated axes (possible if the axes are estimated from the
+        detector border) are binned separately and added at the end."""
+        limits = self.projection.config.limits
+        if limits is None:
+            limits = (None, ) * len(axes)
+        spaces = None
+        overflow = tuple([] for ax in axes)
+        try:
+            for intensity, weights, variances, coords in self.iterate_job(job):
+                if spaces is None:
+                    spaces = tuple(self.allocate(ax, np.size(intensity) * job.weight) for ax in axes)
+                for sp, lim, spill in zip(spaces, limits, overflow):
+                    self.bin_limited(sp, lim, (coords, intensity, weights, variances), spill)
+        except Exception:
+            for sp in spaces or ():
+                space.discard(sp)
+            raise
+        if spaces is None:
+            return space.Multiverse(space.EmptySpace() for ax in axes)
+        return space.Multiverse(space.sum((space.trimmed(sp), ) + tuple(spill)) for sp, spill in zip(spaces, overflow))
+
+    def bin_job_shared(self, job, spaces, metadata):
+        """Bins all images of 'job' into 'spaces' (one per limit set, e.g.
+        SharedSpaces spanning the output of all jobs) and adds the metadata
+        of the job to the MetaData instances 'metadata' of the spaces that
+        received data. Returns a Multiverse of the points outside of these
+        spaces."""
+        limits = self.projection.config.limits
+        if limits is None:
+            limits = (None, ) * len(spaces)
+        overflow = tuple([] for sp in spaces)
+        binned = [False] * len(spaces)
+        for intensity, weights, variances, coords in self.iterate_job(job):
+            for i, (sp, lim, spill) in enumerate(zip(spaces, limits, overflow)):
+                if self.bin_limited(sp, lim, (coords, intensity, weights, variances), spill):
+                    binned[i] = True
+        for md, hit in zip(metadata, binned):
+            if hit:
+                md.add_dataset(self.input.metadata)
+        return space.Multiverse(space.sum(spill) for spill in overflow)
+
+    def bin_limited(self, sp, limits, image, spill):
+        """Bins the points of 'image' (coordinates, intensity, weights,
+        variances) within 'limits' into 'sp'. Points outside the axes of
+        'sp' are binned into a new space, appended to the list 'spill'.
+        Returns False if no point is within the limits."""
+        with self.stage('bin'):
+            return self._bin_limited(sp, limits, image, spill)
+
+    def _bin_limited(self, sp, limits, image, spill):
+        coords = image[0]
+        if limits is not None:
+            valid = space.limits_mask(coords, limits)
+            if not valid.any():
+                return False
+            if not valid.all():
+                image = space.compress_image(valid, *image)
+        try:
+            sp.bin_image(*image)
+        except ValueError:
+            inside = sp.axes.inside(image[0])
+            sp.bin_image(*space.compress_image(inside, *image))
             res = self.projection.config.resolution
             labels = self.projection.get_axis_labels()
-            for processedjob in self.input.process_job(job):
-                # old backends do not provide variances
-                if len(processedjob) == 3:
-                    intensity, weights, params = processedjob
-                    variances = np.full_like(intensity, np.nan)
-                    warnings.warn('variances not found, consider changing your backend')
-                # new backends do provide variances
-                elif len(processedjob) == 4:
-                    intensity, weights, variances, params = processedjob
-                coords = self.projection.project(*params)
-                if self.projection.config.limits == None:
-                    yield space.Multiverse((space.Space.from_image(res, labels, coords, intensity, weights=weights, variances=variances), ))
-                else:
-                    yield space.Multiverse(space.Space.from_image(res, labels, coords, intensity, weights=weights, variances=variances, limits=limits) for limits in self.projection.config.limits)
-        jobverse = space.chunked_sum(generator(), chunksize=25)
-        for sp in jobverse.spaces:
-            if isinstance(sp, space.Space):
-                sp.metadata.add_dataset(self.input.metadata)
-        return jobverse
+            spill.append(space.Space.from_image(res, labels, *space.compress_image(~inside, *image)))
+        return True
+
+    def allocate(self, axes, npixels):
+        """Returns an empty space spanning 'axes' to bin about 'npixels'
+        detector pixels in. A SparseSpace is used if these can fill
+        at most a fraction 'sparse' of the grid, a DiskSpace if the grid
+        needs more than 'maxmemory' and a scratch directory is configured."""
+        conf = self.projection.config
+        fill = min(1., npixels / float(axes.npoints))
+        if fill < conf.sparse:
+            return space.SparseSpace(axes)
+        if conf.scratch and axes.memory_size > conf.maxmemory * 2**20:
+            return space.DiskSpace(axes, directory=conf.scratch)
+        return space.Space(axes)
+
+    def get_job_cost(self, job):
+        """Estimated cost of a job: images x pixels per image x limit sets"""
+        pixels = self.input.get_pixel_count(job) or 1
+        limits = self.projection.config.limits
+        return job.weight * pixels * (len(limits) if limits else 1)
+
+    def split_jobs(self, jobs, maxcost):
+        """Splits the jobs that cost more than 'maxcost', returns a list of (cost, job)"""
+        result = []
+        for job in jobs:
+            cost = self.get_job_cost(job)
+            if maxcost > 0 and cost > maxcost:
+                parts = self.input.split_job(job, int(np.ceil(cost / maxcost)))
+                result.extend((self.get_job_cost(part), part) for part in parts)
+            else:
+                result.append((cost, job))
+        return result
+
+    def schedule_jobs(self, jobs, workers, split=True):
+        """Orders the jobs longest first, after splitting (if 'split') the
+        jobs that cost more than half of the fair share of one of 'workers'
+        parallel workers, such that the run does not end waiting for one big job"""
+        jobs = list(jobs)
+        maxcost = np.sum([self.get_job_cost(job) for job in jobs]) / (2. * workers) if workers > 1 and split else 0
+        return [job for cost, job in sorted(self.split_jobs(jobs, maxcost), key=lambda item: -item[0])]
+
+    def cluster_jobs(self, jobs, split=True):
+        """Groups the jobs into clusters costing about as much as target_weight
+        images of an average job, biggest clusters first. If 'split', bigger
+        jobs are split first"""
+        jobs = list(jobs)
+        images = np.sum([job.weight for job in jobs])
+        if not images:
+            return [jobs] if jobs else []
+        target = self.input.config.target_weight * np.sum([self.get_job_cost(job) for job in jobs]) / images
+        clusters = util.cluster_jobs(self.split_jobs(jobs, target if split else 0), target, weight=lambda item: item[0])
+        return [[job for cost, job in cluster] for cluster in clusters]
 
     def clone_config(self):
         config = util.ConfigSectionGroup()
@@ -125,6 +459,28 @@ class Main(object):
     def get_reentrant(self):
         return multiprocessing_main
 
+    def get_worker(self):
+        """Returns the target of worker processes, see multiprocessing_worker()"""
+        return multiprocessing_worker
+
+
+class Worker(Main):  # sets up projection and input only, processes the jobs it is handed
+    def __init__(self, config):
+        if isinstance(config, util.ConfigSectionGroup):
+            self.config = config.configfile.copy()
+        elif isinstance(config, util.ConfigFile):
+            self.config = config.copy()
+        else:
+            raise ValueError('Configfile is the wrong type')
+
+        self.projection = backend.get_projection(config.projection)
+        self.input = backend.get_input(config.input)
+        space.set_precision(self.projection.config.precision)
+        self.checkpoint = getattr(config.dispatcher, 'checkpoint', None)
+        self.cache = getattr(config.dispatcher, 'cache', None)
+        if getattr(config.dispatcher, 'profile', None) or getattr(config.dispatcher, 'trace', None):
+            self.profile = util.Profile('worker {0}'.format(os.getpid()), trace=bool(getattr(config.dispatcher, 'trace', None)))
+
 
 class Split(Main):  # completely ignores the dispatcher, just yields a space per image
     def __init__(self, config, command):
@@ -139,20 +495,12 @@ class Split(Main):  # completely ignores the dispatcher, just yields a space per
         #input from either the configfile or the configsectiongroup is valid
         self.projection = backend.get_projection(config.projection)
         self.input = backend.get_input(config.input)
+        space.set_precision(self.projection.config.precision)
 
     def process_job(self, job):
         res = self.projection.config.resolution
         labels = self.projection.get_axis_labels()
-        for processedjob in self.input.process_job(job):
-            # old backends do not provide variances
-            if len(processedjob) == 3:
-                intensity, weights, params = processedjob
-                variances = np.full_like(intensity, np.nan)
-                warnings.warn('variances not found, consider changing your backend')
-            # new backends do provide variances
-            elif len(processedjob) == 4:
-                intensity, weights, variances, params = processedjob
-            coords = self.projection.project(*params)
+        for intensity, weights, variances, coords in self.iterate_job(job):
             if self.projection.config.limits == None:
                 yield space.Space.from_image(res, labels, coords, intensity, weights=weights, variances=variances)
             else:
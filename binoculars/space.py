@@ -1,10 +1,18 @@
 from __future__ import unicode_literals
 
+import os
 import numbers
 import sys
+import shutil
+import tempfile
 import itertools
+import collections
+import threading
+import multiprocessing
+import multiprocessing.pool
 
 import numpy as np
+import h5py
 
 from . import util, errors
 
@@ -16,6 +24,11 @@ if PY3:
 else:
     from itertools import izip as zip
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
 
 def silence_numpy_errors():
     """Silence numpy warnings about zero division. Normal usage of Space()
@@ -23,12 +36,203 @@ def silence_numpy_errors():
     np.seterr(divide='ignore', invalid='ignore')
 
 
+PRECISIONS = ('double', 'single')
+_precision = 'double'
+
+
+def set_precision(precision):
+    """Set the precision policy for the arrays of newly created spaces:
+    'double' (float64 photons, contributions and variances) or 'single'
+    (float32 photons and variances, uint32 contributions). Single precision
+    photons and variances are accumulated in float32 and rounded as such,
+    beyond 2**24 unit increments are lost."""
+    global _precision
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision {0!r}, choose from {1}'.format(precision, ', '.join(PRECISIONS)))
+    _precision = precision
+
+
+def get_dtypes():
+    """Returns the dtypes of photons, contributions and variances of new
+    spaces under the current precision policy."""
+    if _precision == 'single':
+        return np.dtype(np.float32), np.dtype(np.uint32), np.dtype(np.float32)
+    return (np.dtype(np.float64), ) * 3
+
+
+# integer arrays that overflow beyond these values
+_exact_limits = {np.dtype(np.uint32): 2**32}
+
+
+def _accumulate(array, index, values, integral=None):
+    """array[index] += values, in place in the dtype of array. A uint32
+    contributions array is promoted to float64 when the increments are not
+    integral (by default: when values is not of an integer dtype), negative
+    or would overflow it. Returns the array, which is a new array if it was
+    promoted: always use the return value."""
+    limit = _exact_limits.get(array.dtype)
+    if limit is not None and np.size(values):
+        if integral is None:
+            integral = values.dtype.kind in 'biu'
+        # headroom is checked on the increments, not on the sum
+        if not integral or values.min() < 0 or int(array[index].max()) + int(values.max()) >= limit:
+            array = array.astype(np.float64)
+        else:
+            values = values.astype(array.dtype, copy=False)
+    array[index] += values
+    return array
+
+
 def sum_onto(a, axis):
     """Numpy convenience. Project all dimensions of an array onto an axis,
     i.e. apply sum() to all axes except the one given."""
     return a.sum(tuple(i for i in range(a.ndim) if i != axis))
 
 
+def _finite(a, copy=True):
+    """np.nan_to_num(), but skipping the (expensive) replacement for the
+    common case of all-finite data, for which the sum is finite as well."""
+    if np.isfinite(a.sum()):
+        return a
+    return np.nan_to_num(a, copy=copy)
+
+
+def weigh_image(indices, intensity, weights=None, variances=None, valids=None):
+    """Prepare image data for binning: flatten, drop the points that are
+    filtered out (valids) or have zero weight, replace non-finite values and
+    apply the weights. Returns (indices, photons, contributions, variances)
+    per point, where contributions is None for unit weights and variances is
+    None if not given."""
+    intensity = np.ravel(intensity)
+    if weights is not None:
+        weights = np.ravel(weights)
+    if variances is not None:
+        variances = np.ravel(variances)
+
+    if valids is not None:
+        keep = np.ravel(valids) != 0
+        if weights is not None:
+            keep &= weights != 0
+    elif weights is not None:
+        keep = weights != 0
+    else:
+        keep = None
+    compacted = keep is not None and not keep.all()
+    if compacted:
+        indices = indices[keep]
+        intensity = intensity[keep]
+        if weights is not None:
+            weights = weights[keep]
+        if variances is not None:
+            variances = variances[keep]
+    if weights is not None and (weights == 1).all():
+        weights = None  # unit weights (e.g. a mask) once the zeros are dropped
+
+    # compacted arrays are private copies and can be cleaned in place
+    photons = _finite(intensity, copy=not compacted)
+    if variances is not None:
+        variances = _finite(variances, copy=not compacted)
+    if weights is not None:
+        photons = photons * weights
+        if variances is not None:
+            variances = variances * weights**2
+    return indices, photons, weights, variances
+
+
+def bincount_image(indices, intensity, weights=None, variances=None, valids=None):
+    """Bin the photons, contributions and variances of an image in one go.
+
+    The filter (valids) and zero weights are applied once by compacting all
+    inputs to the contributing points, the multiplications with the weights
+    are skipped for unit weights and the counting only spans the range of
+    bins that is actually hit. Returns (start, photons, contributions,
+    variances), where the three flat float arrays describe the bins
+    start, start + 1, ...
+
+    indices     flat bin index per point, see Axes.ravel_index()
+    intensity   data intensity array
+    weights     weights array or None for unit weights
+    variances   variances array or None
+    valids      filter array (0=filter out, 1=keep point) or None"""
+    indices, photons, contributions, variances = weigh_image(indices, intensity, weights, variances, valids)
+    if indices.size == 0:
+        return 0, np.zeros(0), np.zeros(0), np.zeros(0)
+    start = indices.min()
+    indices = indices - start
+    size = indices.max() + 1
+
+    photons = np.bincount(indices, weights=photons, minlength=size)
+    if contributions is None:
+        contributions = np.bincount(indices, minlength=size)
+    elif contributions.dtype.kind in 'biu':
+        contributions = np.bincount(indices, weights=contributions, minlength=size).astype(np.int64)
+    else:
+        contributions = np.bincount(indices, weights=contributions, minlength=size)
+    if variances is None:
+        variances = np.zeros(size)
+    else:
+        variances = np.bincount(indices, weights=variances, minlength=size)
+    return start, photons, contributions, variances
+
+
+def limits_mask(coordinates, limits):
+    """Returns a flat boolean array selecting the points whose coordinates
+    are inside 'limits', an n-tuple of slice()s in data coordinates.
+    Open ended slices are allowed."""
+    valid = np.ones(np.size(coordinates[0]), dtype=bool)
+    for coord, sl in zip(coordinates, limits):
+        coord = np.ravel(coord)
+        if sl.start is not None:
+            valid &= coord >= sl.start
+        if sl.stop is not None:
+            valid &= coord <= sl.stop
+    return valid
+
+
+def compress_image(mask, coordinates, intensity, weights, variances=None):
+    """Select the points of image data where 'mask' is True. All arrays are
+    flattened, None (e.g. for missing variances) is passed on."""
+    def compress(a):
+        if a is None:
+            return None
+        return np.ravel(a)[mask]
+    return tuple(compress(coord) for coord in coordinates), compress(intensity), compress(weights), compress(variances)
+
+
+def dataset_options(shape, compression='gzip', shuffle=False, chunks=None):
+    """Returns the keyword arguments for h5py's create_dataset() to store
+    an array of 'shape'.
+
+    compression   'none', 'lzf', 'gzip' or 'gzip:<level>' (level 0-9, default 4)
+    shuffle       apply the shuffle filter before compressing
+    chunks        None for automatic chunking (or contiguous storage without
+                  compression), or the chunk shape as a tuple of integers,
+                  0 meaning the full axis. E.g. (4, 4, 0) for reading rods
+                  along the last axis"""
+    options = {}
+    compression = (compression or 'none').lower()
+    if compression == 'lzf':
+        options['compression'] = 'lzf'
+    elif compression.startswith('gzip'):
+        options['compression'] = 'gzip'
+        if ':' in compression:
+            level = compression.split(':', 1)[1]
+            if not level.isdigit() or not 0 <= int(level) <= 9:
+                raise ValueError("invalid gzip level '{0}', use gzip:<level> with a level from 0 to 9".format(level))
+            options['compression_opts'] = int(level)
+    elif compression != 'none':
+        raise ValueError("unknown compression '{0}', use none, lzf, gzip or gzip:<level>".format(compression))
+    if shuffle:
+        options['shuffle'] = True
+    if chunks:
+        if len(chunks) != len(shape):
+            raise ValueError('chunk shape {0} does not match dimension of data {1}'.format(chunks, shape))
+        options['chunks'] = tuple(max(1, min(c or n, n)) for c, n in zip(chunks, shape))
+    elif options:
+        options['chunks'] = True
+    return options
+
+
 class Axis(object):
     """Represents a single dimension finite discrete grid centered at 0.
 
@@ -160,10 +364,16 @@ class Axis(object):
         return NotImplemented
 
     def rebin(self, factor):
-        # for integers the following relations hold:
-        # a // b == floor(a / b), -(-a // b) == ceil(a / b)
-        new = self.__class__(self.imin // factor, -(-self.imax // factor), factor*self.res, self.label)
-        return self.imin % factor, -self.imax % factor, new
+        """Axis with a resolution of 'factor' times the current one. New grid
+        point j collects the old grid points i with round(i / factor) == j
+        (ties rounded up), a block of 'factor' points.
+
+        returns (number of points to pad before the first point, number of
+                 points to pad after the last point, new Axis)"""
+        shift = factor // 2
+        imin, imax = (self.imin + shift) // factor, (self.imax + shift) // factor
+        new = self.__class__(imin, imax, factor*self.res, self.label)
+        return (self.imin + shift) % factor, factor - 1 - (self.imax + shift) % factor, new
 
     def __repr__(self):
         return '{0.__class__.__name__} {0.label} (min={0.min}, max={0.max}, res={0.res}, count={1})'.format(self, len(self))
@@ -213,10 +423,9 @@ class Axes(object):
 
     @property
     def memory_size(self):
-        # assuming double precision floats for photons,
-        # 32 bit integers for contributions and
-        # double precision floats for the variances
-        return (8+4+8) * self.npoints
+        # itemsizes of photons, contributions and variances
+        # under the current precision policy, see set_precision()
+        return np.sum([dtype.itemsize for dtype in get_dtypes()]) * self.npoints
 
     @classmethod
     def fromfile(cls, filename):
@@ -243,6 +452,35 @@ class Axes(object):
             for index, ax in enumerate(self.axes):
                 axes.create_dataset(ax.label, data=[index, ax.min, ax.max, ax.res, ax.imin, ax.imax])
 
+    def ravel_index(self, coordinates):
+        """Convert an n-tuple of data coordinate arrays to a flat array of
+        indices into C-ordered arrays spanning these axes. Only integer
+        arithmetic is used after the initial rounding, like
+        np.ravel_multi_index(), but with the range checking of
+        Axis.get_index()."""
+        flat = None
+        for ax, coord in zip(self.axes, coordinates):
+            index = np.ravel(coord) / ax.res
+            index = np.around(index, out=index).astype(np.intp)
+            if index.size and (index.min() < ax.imin or index.max() > ax.imax):
+                raise ValueError('cannot get indices, values from [{0}, {1}], axes range [{2}, {3}]'.format(np.min(coord), np.max(coord), ax.min, ax.max))
+            index -= ax.imin
+            if flat is None:
+                flat = index
+            else:
+                flat *= len(ax)
+                flat += index
+        return flat
+
+    def inside(self, coordinates):
+        """Returns a flat boolean array selecting the points whose
+        coordinates fall in a bin of these axes."""
+        valid = np.ones(np.size(coordinates[0]), dtype=bool)
+        for ax, coord in zip(self.axes, coordinates):
+            index = np.around(np.ravel(coord) / ax.res)
+            valid &= (index >= ax.imin) & (index <= ax.imax)
+        return valid
+
     def toarray(self):
         return np.vstack([np.hstack([str(ax.imin), str(ax.imax), str(ax.res), ax.label]) for ax in self.axes])
 
@@ -326,12 +564,17 @@ class EmptySpace(object):
             return NotImplemented
         return other
 
-    def tofile(self, filename):
+    def tofile(self, filename, **storage):
         """Store EmptySpace in HDF5 file."""
         with util.atomic_write(filename) as tmpname:
             with util.open_h5py(tmpname, 'w') as fp:
                 fp.attrs['type'] = 'Empty'
 
+    def addtofile(self, filename, **storage):
+        """Add EmptySpace to the space in HDF5 file, see Space.addtofile()."""
+        if not os.path.exists(filename):
+            self.tofile(filename, **storage)
+
     def __repr__(self):
         return '{0.__class__.__name__}'.format(self)
 
@@ -359,9 +602,11 @@ class Space(object):
         self.config = config
         self.metadata = metadata
 
-        self.photons = np.zeros([len(ax) for ax in self.axes], order='C')
-        self.contributions = np.zeros_like(self.photons)
-        self.variances = np.zeros_like(self.photons)
+        shape = [len(ax) for ax in self.axes]
+        dtypes = get_dtypes()
+        self.photons = np.zeros(shape, dtype=dtypes[0], order='C')
+        self.contributions = np.zeros(shape, dtype=dtypes[1], order='C')
+        self.variances = np.zeros(shape, dtype=dtypes[2], order='C')
 
     @property
     def dimension(self):
@@ -411,9 +656,9 @@ class Space(object):
         """Returns a copy of self. Numpy data is not shared,
         but the Axes object is."""
         new = self.__class__(self.axes, self.config, self.metadata)
-        new.photons[:] = self.photons
-        new.contributions[:] = self.contributions
-        new.variances[:] = self.variances
+        new.photons = self.photons.copy()
+        new.contributions = self.contributions.copy()
+        new.variances = self.variances.copy()
         return new
 
     def __repr__(self):
@@ -578,10 +823,15 @@ class Space(object):
         if not all(b in a for (a, b) in zip(self.axes, other.axes)):
             return self.__add__(other)
 
+        if isinstance(other, SparseSpace):
+            other.add_to(self)
+            self.metadata += other.metadata
+            return self
+
         index = tuple(slice(a.get_index(b.min), a.get_index(b.min) + len(b)) for (a, b) in zip(self.axes, other.axes))
-        self.photons[index] += other.photons
-        self.contributions[index] += other.contributions
-        self.variances[index] += other.variances
+        self.photons = _accumulate(self.photons, index, other.photons)
+        self.contributions = _accumulate(self.contributions, index, other.contributions)
+        self.variances = _accumulate(self.variances, index, other.variances)
         self.metadata += other.metadata
         return self
 
@@ -624,6 +874,10 @@ class Space(object):
                 resolutions[i] = old_resolutions[i]
         resolutions = tuple(resolutions)
 
+        factors = tuple(res / old for res, old in zip(resolutions, old_resolutions))
+        if all(round(f) >= 1 and abs(f - round(f)) < 1e-9 * f for f in factors):
+            return self.rebin_factors(tuple(int(round(f)) for f in factors))
+
         # gather data and transform
         coords = self.get_grid()
         intensity = self.photons / self.contributions
@@ -632,6 +886,32 @@ class Space(object):
         labels = tuple(ax.label for ax in self.axes.axes)
         return self.from_image(resolutions, labels, coords, intensity, weights, variances)
 
+    def rebin_factors(self, factors):
+        """Reduce the number of grid points by summing blocks of
+        factors[0] x factors[1] x ... grid points, see Axis.rebin().
+        Returns a normal Space.
+
+        factors    n-tuple of positive integers, one per axis"""
+        if len(factors) != len(self.axes):
+            raise ValueError('cannot rebin space with different dimensionality')
+        if not all(isinstance(f, (int, np.integer)) and f >= 1 for f in factors):
+            raise ValueError('rebin factors should be positive integers, got {0}'.format(factors))
+
+        pads, axes = zip(*(((left, right), new) for (left, right, new) in (ax.rebin(f) for ax, f in zip(self.axes, factors))))
+        new = Space(axes, self.config, self.metadata)
+        for name in ('photons', 'contributions', 'variances'):
+            array = getattr(self, name)
+            if any(left or right for (left, right) in pads):
+                array = np.pad(array, pads, mode='constant')
+            # pad to a multiple of the factors, then sum the blocks one axis
+            # at a time: (len0 * factor0, ...) -> (len0, factor0, ...) -> (len0, ...)
+            sums = array
+            for i, (ax, factor) in enumerate(zip(axes, factors)):
+                if factor > 1:
+                    sums = sums.reshape(sums.shape[:i] + (len(ax), factor) + sums.shape[i+1:]).sum(axis=i+1, dtype=np.float64 if array.dtype.kind == 'f' else np.uint64)
+            setattr(new, name, _accumulate(np.zeros(sums.shape, dtype=array.dtype), Ellipsis, sums))
+        return new
+
     def reorder(self, labels):
         """Change order of axes."""
         if not self.dimension == len(labels):
@@ -643,57 +923,91 @@ class Space(object):
         new.variances = np.transpose(self.variances, axes=newindices)
         return new
 
-    def transform_coordinates(self, resolutions, labels, transformation):
-        # gather data and transform
-        coords = self.get_grid()
-        transcoords = transformation(*coords)
-        intensity = self.photons / self.contributions
-        weights = self.contributions
-        variances = self.variances / self.contributions**2
-
-        # get rid of invalid coords
-        valid = reduce(np.bitwise_and, itertools.chain((np.isfinite(t) for t in transcoords)), (weights > 0))
-        transcoords = tuple(t[valid] for t in transcoords)
+    def transform_coordinates(self, resolutions, labels, transformation, slabsize=None):
+        """Rebin the data on new axes, the new coordinates of the grid points
+        given by transformation(*coordinates). Only grid points with
+        contributions are transformed, in slabs along the first axis of at
+        most 'slabsize' grid points (default: _slab_size): a first pass
+        determines the extent of the new axes, a second pass bins the data.
+
+        resolutions     n-tuple of resolutions of the new axes
+        labels          n-tuple of labels of the new axes
+        transformation  function of the coordinate arrays of all axes,
+                        returns an n-tuple of new coordinate arrays"""
+        resolutions, labels = tuple(resolutions), tuple(labels)
+        rows = max(1, (slabsize or _slab_size) * len(self.axes[0]) // self.npoints)
+
+        starts = range(0, len(self.axes[0]), rows)
+        if len(starts) == 1:  # transform a single slab only once
+            points = [self._transform_points(transformation, 0, rows)]
+            slabs = lambda: points
+        else:
+            slabs = lambda: (self._transform_points(transformation, start, start + rows) for start in starts)
+
+        extent = []
+        for coords, intensity, weights, variances in slabs():
+            if weights.size:
+                extent.append(tuple((c.min(), c.max()) for c in coords))
+        if not extent:
+            return EmptySpace()
+        axes = tuple(Axis(min(e[0] for e in ext), max(e[1] for e in ext), res, label) for ext, res, label in zip(zip(*extent), resolutions, labels))
+
+        newspace = self._like(axes)
+        for coords, intensity, weights, variances in slabs():
+            if weights.size:
+                newspace.bin_image(coords, intensity, weights, variances)
+        return newspace
 
-        return self.from_image(resolutions, labels, transcoords, intensity[valid], weights[valid], variances[valid])
+    def _transform_points(self, transformation, start, stop):
+        """Returns the transformed coordinates, intensity, weights and
+        variances of the grid points with contributions in rows start:stop
+        of the first axis, dropping points with invalid coordinates."""
+        index, photons, contributions, variances = self._points(start, stop)
+        coords = tuple((i + ax.imin) * ax.res for i, ax in zip(index, self.axes))
+        transcoords = tuple(np.broadcast_to(t, contributions.shape) for t in transformation(*coords))
+        valid = reduce(np.bitwise_and, (np.isfinite(t) for t in transcoords))
+        return tuple(t[valid] for t in transcoords), (photons / contributions)[valid], contributions[valid], (variances / contributions**2)[valid]
+
+    def _points(self, start, stop):
+        """Returns the grid points with contributions in rows start:stop of
+        the first axis: (n-tuple of index arrays, photons, contributions,
+        variances)"""
+        contributions = self.contributions[start:stop]
+        index = np.nonzero(contributions > 0)
+        return (index[0] + start, ) + index[1:], self.photons[start:stop][index], contributions[index], self.variances[start:stop][index]
+
+    def _like(self, axes):
+        """Returns an empty space of the same kind with 'axes', config and
+        metadata of self"""
+        return self.__class__(axes, self.config, self.metadata)
 
     def bin_image(self, coordinates, intensity, weights, variances, valids=None):
         """Load image data into Space, do the binning.
 
         coordinates  n-tuple of data coordinate arrays
         intensity    data intensity array
-        weights      weights array, normally this is the contributions array
+        weights      weights array, normally this is the contributions array.
+                     None is treated as unit weights
         variances    variances array
-        valids       filter array (0=filter out, 1=keep point) """
+        valids       filter array (0=filter out, 1=keep point), None keeps all points"""
 
         if len(coordinates) != len(self.axes):
             raise ValueError('dimension mismatch between coordinates and axes')
 
-        # bincount needs 1D arrays
-        intensity = np.nan_to_num(intensity).flatten()
-        weights = weights.flatten()
-        variances = np.nan_to_num(variances).flatten()
-        if valids is None:
-            valids = np.ones_like(intensity)
-        else:
-            valids = valids.flatten()
-
-        # indices are the indices of the new data points with respect to the
-        # axis they are added to. Same index means the points are in the same
-        # bin and combined.
-        indices = np.array(tuple(ax.get_index(coord) for (ax, coord) in zip(self.axes, coordinates)))
-        for i in range(len(self.axes)):
-            for j in range(i+1, len(self.axes)):
-                indices[i, :] *= len(self.axes[j])
-        indices = indices.sum(axis=0).astype(int).flatten()
-
-        photons = np.bincount(indices, weights=intensity*weights*valids)
-        contributions = np.bincount(indices, weights=weights*valids)
-        variances = np.bincount(indices, weights=variances*weights**2*valids)
-
-        self.photons.ravel()[:photons.size] += photons
-        self.contributions.ravel()[:contributions.size] += contributions
-        self.variances.ravel()[:variances.size] += variances
+        # indices are the flat indices of the new data points in the
+        # (C-ordered) arrays of this space. Same index means the points are
+        # in the same bin and combined.
+        indices = self.axes.ravel_index(coordinates)
+        start, photons, contributions, variances = bincount_image(indices, intensity, weights, variances, valids)
+        stop = start + photons.size
+
+        # reshape() copies non-contiguous arrays (e.g. after reorder()),
+        # the copy replaces the original array
+        region = slice(start, stop)
+        shape = self.photons.shape
+        self.photons = _accumulate(self.photons.reshape(-1), region, photons).reshape(shape)
+        self.contributions = _accumulate(self.contributions.reshape(-1), region, contributions).reshape(shape)
+        self.variances = _accumulate(self.variances.reshape(-1), region, variances).reshape(shape)
 
     @classmethod
     def from_image(cls, resolutions, labels, coordinates, intensity, weights, variances=None, limits=None):
@@ -707,21 +1021,11 @@ class Space(object):
         variances     variances array"""
         # filter out invalid points (coordinates outside the limits (if given))
         if limits is not None:
-            invalid = np.zeros(intensity.shape).astype(np.bool)
-            for coord, sl in zip(coordinates, limits):
-                if sl.start is None and sl.stop is not None:
-                    invalid += coord > sl.stop
-                elif sl.start is not None and sl.stop is None:
-                    invalid += coord < sl.start
-                elif sl.start is not None and sl.stop is not None:
-                    invalid += np.bitwise_or(coord < sl.start, coord > sl.stop)
-
-            if np.all(invalid):
+            valid = limits_mask(coordinates, limits)
+            if not valid.any():
                 return EmptySpace()
-            coordinates = tuple(coord[~invalid] for coord in coordinates)
-            intensity = intensity[~invalid]
-            weights = weights[~invalid]
-            variances = variances[~invalid]
+            if not valid.all():
+                coordinates, intensity, weights, variances = compress_image(valid, coordinates, intensity, weights, variances)
 
         if variances is None:
             print('variances not provided')
@@ -732,25 +1036,81 @@ class Space(object):
         newspace.bin_image(coordinates, intensity, weights, variances)
         return newspace
 
-    def tofile(self, filename):
-        """Store Space in HDF5 file."""
+    def tofile(self, filename, **storage):
+        """Store Space in HDF5 file.
+
+        storage   compression, shuffle and chunks, see dataset_options()"""
+        options = dataset_options(self.photons.shape, **storage)
         with util.atomic_write(filename) as tmpname:
             with util.open_h5py(tmpname, 'w') as fp:
                 fp.attrs['type'] = 'Space'
                 self.config.tofile(fp)
                 self.axes.tofile(fp)
                 self.metadata.tofile(fp)
-                fp.create_dataset('counts', self.photons.shape, dtype=self.photons.dtype, compression='gzip').write_direct(self.photons)
-                fp.create_dataset('contributions', self.contributions.shape, dtype=self.contributions.dtype, compression='gzip').write_direct(self.contributions)
-                fp.create_dataset('variances', self.variances.shape, dtype=self.variances.dtype, compression='gzip').write_direct(self.variances)
+                fp.create_dataset('counts', self.photons.shape, dtype=self.photons.dtype, **options).write_direct(self.photons)
+                fp.create_dataset('contributions', self.contributions.shape, dtype=self.contributions.dtype, **options).write_direct(self.contributions)
+                fp.create_dataset('variances', self.variances.shape, dtype=self.variances.dtype, **options).write_direct(self.variances)
+
+    def addtofile(self, filename, **storage):
+        """Add this space to the space stored in HDF5 file 'filename'.
+
+        If the axes of this space lie within those in the file and the
+        datasets can hold the sum, only the overlapping part of the datasets
+        is updated in place (this is not atomic), otherwise the file is
+        rewritten with the sum, growing its axes."""
+        with util.open_h5py(filename, 'r') as fp:
+            if fp.attrs.get('type') == 'Empty':
+                return self.tofile(filename, **storage)
+            axes = Axes.fromfile(fp)
+        if len(axes) == len(self.axes) and all(b in a for (a, b) in zip(axes, self.axes)):
+            index = tuple(slice(a.get_index(b.min), a.get_index(b.min) + len(b)) for (a, b) in zip(axes, self.axes))
+            with h5py.File(filename, 'r+') as fp:
+                if 'binoculars' in fp:
+                    fp = fp['binoculars']
+                sums = []
+                for name, values in (('counts', self.photons), ('contributions', self.contributions), ('variances', self.variances)):
+                    dataset = fp.get(name)
+                    if dataset is None:
+                        break
+                    result = _accumulate(dataset[index], Ellipsis, values)
+                    if result.dtype != dataset.dtype:  # promoted, does not fit in the file
+                        break
+                    sums.append((dataset, result))
+                else:
+                    for dataset, result in sums:
+                        dataset[index] = result
+                    self.metadata.togroup(fp['metadata'] if 'metadata' in fp else fp.create_group('metadata'))
+                    return
+        total = Space.fromfile(filename)
+        total += self
+        total.config = self.config
+        total.tofile(filename, **storage)
+
+    @staticmethod
+    def _file_key(axes, key, file):
+        """Convert 'key' (see fromfile()) to an index key into the datasets
+        of a space with 'axes'. Returns (key, axes of the selection)."""
+        if not key:
+            return Ellipsis, axes
+        if len(axes) != len(key):
+            raise ValueError("dimensionality of 'key' {0} does not match dimensionality of space in HDF5 file {1}".format(key, file))
+        key = tuple(ax.get_index(k) for k, ax in zip(key, axes))
+        for sl in key:
+            if sl.start == sl.stop and sl.start is not None:
+                raise KeyError('key {0} results in empty space'.format(key))
+        return key, tuple(ax[k] for k, ax in zip(key, axes) if isinstance(k, slice))
 
     @classmethod
-    def fromfile(cls, file, key=None):
+    def fromfile(cls, file, key=None, lazy=False):
         """Load Space from HDF5 file.
 
         file      filename string or h5py.Group instance
         key       sliced (subset) loading, should be an n-tuple
-                  of slice()s in data coordinates"""
+                  of slice()s in data coordinates
+        lazy      keep the file open and only read data on demand,
+                  returns a LazySpace"""
+        if lazy:
+            return LazySpace.fromfile(file, key)
         try:
             with util.open_h5py(file, 'r') as fp:
                 if 'type' in fp.attrs.keys():
@@ -760,23 +1120,20 @@ class Space(object):
                 axes = Axes.fromfile(fp)
                 config = util.ConfigFile.fromfile(fp)
                 metadata = util.MetaData.fromfile(fp)
-                if key:
-                    if len(axes) != len(key):
-                        raise ValueError("dimensionality of 'key' {0} does not match dimensionality of space in HDF5 file {1}".format(key, file))
-                    key = tuple(ax.get_index(k) for k, ax in zip(key, axes))
-                    for sl in key:
-                        if sl.start == sl.stop and sl.start is not None:
-                            raise KeyError('key {0} results in empty space'.format(key))
-                    axes = tuple(ax[k] for k, ax in zip(key, axes) if isinstance(k, slice))
-                else:
-                    key = Ellipsis
+                key, axes = cls._file_key(axes, key, file)
                 space = cls(axes, config, metadata)
+                # keep the dtypes of the file, such that a space survives
+                # a round trip unchanged under any precision policy
+                shape = space.photons.shape
                 try:
+                    space.photons = np.zeros(shape, dtype=fp['counts'].dtype)
+                    space.contributions = np.zeros(shape, dtype=fp['contributions'].dtype)
                     fp['counts'].read_direct(space.photons, key)
                     fp['contributions'].read_direct(space.contributions, key)
                 except (KeyError, TypeError) as e:
                     raise errors.HDF5FileError('unable to load space from HDF5 file {0}, is it a valid BINoculars file? (original error: {1!r})'.format(file, e))
                 try:
+                    space.variances = np.zeros(shape, dtype=fp['variances'].dtype)
                     fp['variances'].read_direct(space.variances, key)
                 except (KeyError, TypeError) as e:
                     space.variances = np.zeros_like(space.photons)
@@ -786,6 +1143,1089 @@ class Space(object):
         return space
 
 
+class SparseSpace(Space):
+    """Space that only stores the grid points containing data. Meant for
+    volumes of which only a small fraction of the bounding box is filled,
+    like rod scans at high resolution.
+
+    Data is kept as sorted, unique flat indices into the (C-ordered) grid
+    plus the photons, contributions and variances per index. Binned images
+    are collected and merged in bulk. The dense .photons, .contributions and
+    .variances arrays are created on every access, use todense() to convert
+    to a normal Space once.
+
+    Important attributes:
+        axes      Axes instances describing range and stepsizes of each of the dimensions
+        indices   1D integer array, flat indices of the grid points with data
+        values    (3, n) float array, photons, contributions and variances per index"""
+
+    pending_limit = 2**22  # merge binned images when this many points are pending
+
+    def __init__(self, axes, config=None, metadata=None):
+        if not isinstance(axes, Axes):
+            self.axes = Axes(axes)
+        else:
+            self.axes = axes
+
+        self.config = config
+        self.metadata = metadata
+
+        self._indices = np.zeros(0, dtype=np.intp)
+        self._values = np.zeros((3, 0))
+        self._pending = []
+        self._npending = 0
+
+    @property
+    def shape(self):
+        return tuple(len(ax) for ax in self.axes)
+
+    @property
+    def indices(self):
+        self._merge()
+        return self._indices
+
+    @property
+    def values(self):
+        self._merge()
+        return self._values
+
+    @property
+    def npoints(self):
+        return self.axes.npoints
+
+    @property
+    def memory_size(self):
+        """Returns approximate memory consumption of this SparseSpace."""
+        return self.indices.nbytes + self.values.nbytes
+
+    @property
+    def fill_fraction(self):
+        return self.indices.size / float(self.npoints)
+
+    def _points(self, start, stop):
+        """See Space._points(), the indices are sorted and C-ordered"""
+        rowsize = self.npoints // len(self.axes[0])
+        first, last = np.searchsorted(self.indices, (start * rowsize, stop * rowsize))
+        values = self.values[:, first:last]
+        filled = values[1] > 0
+        return np.unravel_index(self.indices[first:last][filled], self.shape), values[0][filled], values[1][filled], values[2][filled]
+
+    def _dense(self, row):
+        a = np.zeros(self.shape)
+        a.reshape(-1)[self.indices] = self.values[row]
+        return a
+
+    @property
+    def photons(self):
+        return self._dense(0)
+
+    @property
+    def contributions(self):
+        return self._dense(1)
+
+    @property
+    def variances(self):
+        return self._dense(2)
+
+    def _append(self, indices, values):
+        self._pending.append((indices, values))
+        self._npending += indices.size
+        if self._npending > self.pending_limit:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        indices = np.concatenate([self._indices] + [i for i, v in self._pending])
+        values = np.hstack([self._values] + [v for i, v in self._pending])
+        self._pending = []
+        self._npending = 0
+        self._indices, self._values = _unique_sum(indices, values)
+
+    def _grow(self, axes):
+        """Extend the grid to 'axes' (which should contain the current axes)"""
+        self._indices = _reindex(self.indices, self.axes, axes)
+        self.axes = axes
+
+    def _new(self, axes, indices, values):
+        new = self.__class__(axes, self.config, self.metadata)
+        new._indices = indices
+        new._values = values
+        return new
+
+    def copy(self):
+        """Returns a copy of self. Numpy data is not shared,
+        but the Axes object is."""
+        return self._new(self.axes, self.indices.copy(), self.values.copy())
+
+    def addtofile(self, filename, **storage):
+        self.todense().addtofile(filename, **storage)
+
+    def todense(self):
+        """Returns a normal Space with the same data."""
+        new = Space(self.axes, self.config, self.metadata)
+        self.add_to(new)
+        return new
+
+    @classmethod
+    def fromdense(cls, space):
+        """Returns a SparseSpace with the data of a normal Space."""
+        indices, values = _sparse_points(space)
+        return cls(space.axes, space.config, space.metadata)._new(space.axes, indices, values)
+
+    def _select(self, key):
+        """Select data by index key (n-tuple of integers and slices), see
+        Space.__getitem__()"""
+        multi = np.unravel_index(self.indices, self.shape)
+        mask = np.ones(self.indices.size, dtype=bool)
+        newaxes = []
+        newmulti = []
+        for m, k, ax in zip(multi, key, self.axes):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(len(ax))
+                mask &= (m >= start) & (m < stop)
+                newaxes.append(ax[start:stop])
+                newmulti.append(m - start)
+            else:
+                mask &= m == k
+        values = self.values[:, mask]
+        if not newaxes:
+            return values[0].sum() / values[1].sum()
+        newaxes = Axes(newaxes)
+        indices = np.ravel_multi_index(tuple(m[mask] for m in newmulti), tuple(len(ax) for ax in newaxes))
+        return self._new(newaxes, indices, values)
+
+    def __getitem__(self, key):
+        """Slicing only! space[-0.2:0.2, 0.9:1.1] does exactly what the syntax
+        implies. Ellipsis operator '...' is not supported."""
+        return self._select(self.get_key(key))
+
+    def indexedSlice(self, axis, key):
+        """ get a single slice along 'axis'
+        This reduces the dimensionality of the space by 1
+
+        axis         the label of the axis or the index
+        key          the number of the slice to get along the axes 'axis'
+        """
+        index = self.axes.index(axis)
+        npindex = [slice(None) for ax in self.axes]
+        npindex[index] = key
+        return self._select(npindex)
+
+    def project(self, axis, *more_axes):
+        """Reduce dimensionality of Space by projecting onto 'axis'.
+        Sum all data (photons, contributions, variances) along this axis.
+
+        axis         the label of the axis or the index
+        *more_axis   also project on these axes"""
+        index = self.axes.index(axis)
+        newaxes = list(self.axes)
+        newaxes.pop(index)
+        multi = list(np.unravel_index(self.indices, self.shape))
+        multi.pop(index)
+        if newaxes:
+            indices = np.ravel_multi_index(multi, tuple(len(ax) for ax in newaxes))
+        else:
+            indices = np.zeros_like(self.indices)
+        newspace = self._new(Axes(newaxes), *_unique_sum(indices, self.values))
+        if more_axes:
+            return newspace.project(more_axes[0], *more_axes[1:])
+        return newspace
+
+    def reorder(self, labels):
+        """Change order of axes."""
+        if not self.dimension == len(labels):
+            raise ValueError('dimension mismatch')
+        newindices = list(self.axes.index(label) for label in labels)
+        newaxes = Axes(tuple(self.axes[index] for index in newindices))
+        multi = np.unravel_index(self.indices, self.shape)
+        indices = np.ravel_multi_index(tuple(multi[index] for index in newindices), tuple(len(ax) for ax in newaxes))
+        return self._new(newaxes, *_unique_sum(indices, self.values))
+
+    def trim(self):
+        """Reduce total size of Space by trimming zero-contribution
+        data points on the boundaries."""
+        multi = np.unravel_index(self.indices, self.shape)
+        mask = self.values[1] > 0
+        lims = [(m[mask].min(), m[mask].max()) for m in multi]
+        inside = np.ones(self.indices.size, dtype=bool)
+        for m, (axmin, axmax) in zip(multi, lims):
+            inside &= (m >= axmin) & (m <= axmax)
+        axes = Axes(Axis(axmin + ax.imin, axmax + ax.imin, ax.res, ax.label) for (ax, (axmin, axmax)) in zip(self.axes, lims))
+        self._indices = np.ravel_multi_index(tuple(m[inside] - axmin for m, (axmin, axmax) in zip(multi, lims)), tuple(len(ax) for ax in axes))
+        self._values = self._values[:, inside]
+        self.axes = axes
+
+    def __add__(self, other):
+        if isinstance(other, numbers.Number):
+            new = self.copy()
+            new += other
+            return new
+        return super(SparseSpace, self).__add__(other)
+
+    def __iadd__(self, other):
+        """ Implementation of 'self += other' """
+        if isinstance(other, numbers.Number):
+            # variances are unchanged when adding a number
+            self.values[0] += other * self.values[1]
+            return self
+        if not isinstance(other, Space):
+            return NotImplemented
+        if not len(self.axes) == len(other.axes) or not all(a.is_compatible(b) for (a, b) in zip(self.axes, other.axes)):
+            raise ValueError('cannot add spaces with different dimensionality or resolution')
+
+        if not all(b in a for (a, b) in zip(self.axes, other.axes)):
+            self._grow(Axes(a | b for (a, b) in zip(self.axes, other.axes)))
+        indices, values = _sparse_points(other)
+        self._append(_reindex(indices, other.axes, self.axes), values)
+        self.metadata += other.metadata
+        return self
+
+    def add_to(self, space):
+        """Add the data to the dense arrays of 'space', which should contain
+        the axes of this SparseSpace."""
+        indices = _reindex(self.indices, self.axes, space.axes)
+        shape = space.photons.shape
+        space.photons = _accumulate(space.photons.reshape(-1), indices, self.values[0]).reshape(shape)
+        # the values are float64, check once whether the contributions are still counts
+        contributions = self.values[1]
+        integral = space.contributions.dtype.kind != 'u' or np.array_equal(contributions, np.rint(contributions))
+        space.contributions = _accumulate(space.contributions.reshape(-1), indices, contributions, integral).reshape(shape)
+        space.variances = _accumulate(space.variances.reshape(-1), indices, self.values[2]).reshape(shape)
+
+    def __mul__(self, other):
+        """Multiplying a space with a factor scales the intensity with this
+        factor, leaves contributions unchanged and scales variances
+        with the square of this factor (variances > 0)."""
+        if isinstance(other, numbers.Number):
+            values = self.values * np.array([[other], [1], [other**2]])
+            return self._new(self.axes, self.indices, values)
+        return NotImplemented
+
+    def bin_image(self, coordinates, intensity, weights, variances, valids=None):
+        """Load image data into Space, do the binning. See Space.bin_image()"""
+        if len(coordinates) != len(self.axes):
+            raise ValueError('dimension mismatch between coordinates and axes')
+
+        indices = self.axes.ravel_index(coordinates)
+        indices, photons, contributions, variances = weigh_image(indices, intensity, weights, variances, valids)
+        if indices.size == 0:
+            return
+        if contributions is None:
+            contributions = np.ones_like(photons)
+        if variances is None:
+            variances = np.zeros_like(photons)
+        values = np.vstack((photons, contributions, variances))
+
+        # combine the points of this image already if they hit a compact range of bins
+        start = indices.min()
+        size = indices.max() - start + 1
+        if size <= 4 * indices.size:
+            local = indices - start
+            binned = np.vstack(tuple(np.bincount(local, weights=row, minlength=size) for row in values))
+            hit = np.flatnonzero(np.bincount(local, minlength=size))
+            indices, values = hit + start, binned[:, hit]
+        self._append(indices, values)
+
+    def tofile(self, filename, **storage):
+        """Store SparseSpace in HDF5 file, in the same (dense) format as a Space.
+        The data is written in slabs along the first axis, slabs without any
+        data are not written at all.
+
+        storage   compression, shuffle and chunks, see dataset_options()"""
+        shape = self.shape
+        options = dataset_options(shape, **storage)
+        if 'chunks' not in options:  # the gaps need chunked storage
+            options['chunks'] = True
+        with util.atomic_write(filename) as tmpname:
+            with util.open_h5py(tmpname, 'w') as fp:
+                fp.attrs['type'] = 'Space'
+                self.config.tofile(fp)
+                self.axes.tofile(fp)
+                self.metadata.tofile(fp)
+                datasets = tuple(fp.create_dataset(name, shape, dtype=float, fillvalue=0, **options) for name in ('counts', 'contributions', 'variances'))
+                # write whole chunks only
+                rows = datasets[0].chunks[0]
+                rows *= max(1, _slab_size // (rows * max(1, int(np.prod(shape[1:])))))
+                for start, stop, indices, values in _slabs(self.indices, self.values, shape, rows):
+                    for dataset, row in zip(datasets, values):
+                        slab = np.zeros((stop - start, ) + shape[1:])
+                        slab.reshape(-1)[indices] = row
+                        dataset[start:stop] = slab
+
+    @classmethod
+    def fromfile(cls, file, key=None):
+        """Load SparseSpace from a HDF5 file (in the Space format),
+        without reading the complete dense arrays at once.
+
+        file      filename string or h5py.Group instance
+        key       sliced (subset) loading, should be an n-tuple
+                  of slice()s in data coordinates"""
+        try:
+            with util.open_h5py(file, 'r') as fp:
+                if 'type' in fp.attrs.keys():
+                    if fp.attrs['type'] == 'Empty':
+                        return EmptySpace()
+
+                axes = Axes.fromfile(fp)
+                config = util.ConfigFile.fromfile(fp)
+                metadata = util.MetaData.fromfile(fp)
+                key, axes = cls._file_key(axes, key, file)
+                space = cls(axes, config, metadata)
+                try:
+                    datasets = [fp['counts'], fp['contributions']]
+                except (KeyError, TypeError) as e:
+                    raise errors.HDF5FileError('unable to load space from HDF5 file {0}, is it a valid BINoculars file? (original error: {1!r})'.format(file, e))
+                if 'variances' in fp:
+                    datasets.append(fp['variances'])
+                else:
+                    print('Variances not found in HDF5 file {0}, using 0 as default. You should recreate the space with BINoculars.'.format(file))
+                if key is Ellipsis:
+                    key = tuple(slice(None) for ax in datasets[0].shape)
+                shape = space.shape
+                stride = int(np.prod(shape[1:]))
+                if isinstance(key[0], slice):
+                    first, last, step = key[0].indices(datasets[0].shape[0])
+                else:
+                    first, last = key[0], key[0] + 1
+                rows = max(1, _slab_size // max(stride, 1))
+                for start in range(first, last, rows):
+                    stop = min(last, start + rows)
+                    if isinstance(key[0], slice):
+                        slabkey = (slice(start, stop), ) + tuple(key[1:])
+                    else:
+                        slabkey = key
+                    slabs = [np.ravel(dataset[slabkey]) for dataset in datasets]
+                    if len(slabs) == 2:
+                        slabs.append(np.zeros_like(slabs[0]))
+                    hit = np.flatnonzero((slabs[0] != 0) | (slabs[1] != 0) | (slabs[2] != 0))
+                    if hit.size:
+                        space._append(hit + (start - first) * stride, np.vstack(tuple(slab[hit] for slab in slabs)))
+        except IOError as e:
+            raise errors.HDF5FileError('unable to open {0} as HDF5 file (original error: {1!r})'.format(file, e))
+        return space
+
+
+_slab_size = 2**23  # number of grid points per slab for slab-wise reading and writing
+
+
+def _unique_sum(indices, values):
+    """Sort flat indices and combine duplicates by summing their values
+    (array of shape (3, n)). Returns (indices, values)."""
+    if indices.size == 0:
+        return indices, values
+    order = np.argsort(indices, kind='mergesort')
+    indices = indices[order]
+    values = values[:, order]
+    starts = np.flatnonzero(np.concatenate(([True], indices[1:] != indices[:-1])))
+    if starts.size == indices.size:
+        return indices, values
+    return indices[starts], np.add.reduceat(values, starts, axis=1)
+
+
+def _reindex(indices, source, target):
+    """Convert flat indices into a grid spanning Axes 'source' to flat indices
+    into a grid spanning Axes 'target', which should contain 'source'."""
+    if source == target:
+        return indices
+    multi = np.unravel_index(indices, tuple(len(ax) for ax in source))
+    return np.ravel_multi_index(tuple(m + (s.imin - t.imin) for m, s, t in zip(multi, source, target)), tuple(len(ax) for ax in target))
+
+
+def _sparse_points(space):
+    """Returns (indices, values) of the grid points of a Space with data, see SparseSpace."""
+    if isinstance(space, SparseSpace):
+        return space.indices, space.values
+    photons, contributions, variances = (np.ravel(a) for a in (space.photons, space.contributions, space.variances))
+    indices = np.flatnonzero((contributions != 0) | (photons != 0) | (variances != 0))
+    return indices, np.vstack((photons[indices], contributions[indices], variances[indices]))
+
+
+def _slabs(indices, values, shape, rows=None):
+    """Split sorted flat indices (and values) in slabs of 'rows' along the
+    first axis of a grid with 'shape'. Yields (start, stop, indices, values)
+    for slabs containing data, with the indices relative to the start of the
+    slab."""
+    if len(shape) == 0 or indices.size == 0:
+        return
+    stride = int(np.prod(shape[1:]))
+    if rows is None:
+        rows = max(1, _slab_size // max(stride, 1))
+    for start in range(0, shape[0], rows):
+        stop = min(shape[0], start + rows)
+        lo, hi = np.searchsorted(indices, (start * stride, stop * stride))
+        if hi > lo:
+            yield start, stop, indices[lo:hi] - start * stride, values[:, lo:hi]
+
+
+class _ChunkedSpace(Space):
+    """Base class of the spaces of which the data stays in (chunked) HDF5
+    datasets: the region of the datasets starting at _offset. Data is read
+    on demand, projections and slices are done chunk by chunk and return a
+    normal Space. The dense .photons, .contributions and .variances arrays
+    are read on every access."""
+
+    def _open(self, datasets, offset=None):
+        """datasets   counts, contributions and variances (None for zeros) h5py datasets"""
+        self._datasets = tuple(datasets)
+        self._offset = tuple(offset) if offset else (0, ) * self.dimension
+        chunks = self._datasets[0].chunks
+        if chunks is None:  # contiguous dataset, read it in slabs
+            shape = self._datasets[0].shape
+            chunks = (min(shape[0], max(1, _slab_size // max(1, int(np.prod(shape[1:]))))), ) + shape[1:]
+        self.chunks = chunks
+
+    @property
+    def shape(self):
+        return tuple(len(ax) for ax in self.axes)
+
+    def flush(self):
+        pass
+
+    def _read(self, slices):
+        """Returns photons, contributions and variances of the region 'slices'
+        (relative to this space) as one (3, ...) array"""
+        source = tuple(slice(s.start + o, s.stop + o) for s, o in zip(slices, self._offset))
+        data = np.zeros((3, ) + tuple(s.stop - s.start for s in slices))
+        for d, dataset in zip(data, self._datasets):
+            if dataset is not None:
+                dataset.read_direct(d, source)
+        return data
+
+    def _points(self, start, stop):
+        """See Space._points()"""
+        self.flush()
+        data = self._read((slice(start, min(stop, self.shape[0])), ) + tuple(slice(0, n) for n in self.shape[1:]))
+        index = np.nonzero(data[1] > 0)
+        return (index[0] + start, ) + index[1:], data[0][index], data[1][index], data[2][index]
+
+    def _dense(self, index):
+        self.flush()
+        data = np.zeros(self.shape)
+        if self._datasets[index] is not None:
+            self._datasets[index].read_direct(data, tuple(slice(o, o + n) for o, n in zip(self._offset, self.shape)))
+        return data
+
+    @property
+    def photons(self):
+        return self._dense(0)
+
+    @property
+    def contributions(self):
+        return self._dense(1)
+
+    @property
+    def variances(self):
+        return self._dense(2)
+
+    def iter_chunks(self):
+        """Yields (slices, data) for all HDF5 chunks covering this space, data
+        being an array of photons, contributions and variances, (3, ) + the
+        shape of the chunk. Chunks without any data are skipped."""
+        self.flush()
+        ranges = tuple(range(o // c, (o + n - 1) // c + 1) for o, c, n in zip(self._offset, self.chunks, self.shape))
+        for chunk in itertools.product(*ranges):
+            slices = tuple(slice(max(i * c - o, 0), min((i + 1) * c - o, n)) for i, c, o, n in zip(chunk, self.chunks, self._offset, self.shape))
+            data = self._read(slices)
+            if data.any():
+                yield slices, data
+
+    def _select(self, key):
+        """Read the data selected by index key (n-tuple of integers and slices)
+        in a normal Space, or the intensity if 'key' selects a single point"""
+        self.flush()
+        axes = tuple(ax[k] for k, ax in zip(key, self.axes) if isinstance(k, slice))
+        source = []
+        for k, ax, o in zip(key, self.axes, self._offset):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(len(ax))
+                source.append(slice(start + o, stop + o))
+            else:
+                source.append(k + o)
+        source = tuple(source)
+        data = tuple(np.zeros_like(self._datasets[0][source]) if dataset is None else dataset[source] for dataset in self._datasets)
+        if not axes:
+            return data[0] / data[1]
+        newspace = Space(axes, self.config, self.metadata)
+        newspace.photons, newspace.contributions, newspace.variances = data
+        return newspace
+
+    def __getitem__(self, key):
+        """Slicing only! space[-0.2:0.2, 0.9:1.1] does exactly what the syntax
+        implies, returns a normal Space. Ellipsis operator '...' is not supported."""
+        return self._select(self.get_key(key))
+
+    def indexedSlice(self, axis, key):
+        """ get a single slice along 'axis' as a normal Space
+        This reduces the dimensionality of the space by 1
+
+        axis         the label of the axis or the index
+        key          the number of the slice to get along the axes 'axis'
+        """
+        index = self.axes.index(axis)
+        npindex = [slice(None) for ax in self.axes]
+        npindex[index] = key
+        return self._select(npindex)
+
+    def project(self, axis, *more_axes):
+        """Reduce dimensionality of Space by projecting onto 'axis', chunk by
+        chunk. Returns a normal Space.
+
+        axis         the label of the axis or the index
+        *more_axis   also project on these axes"""
+        index = self.axes.index(axis)
+        newaxes = list(self.axes)
+        newaxes.pop(index)
+        newspace = Space(newaxes, self.config, self.metadata)
+        for slices, data in self.iter_chunks():
+            slices = slices[:index] + slices[index+1:]
+            for array, d in zip((newspace.photons, newspace.contributions, newspace.variances), data):
+                array[slices] += d.sum(axis=index)
+        if more_axes:
+            return newspace.project(more_axes[0], *more_axes[1:])
+        return newspace
+
+    def get_norm_intensity(self):
+        """Returns normalized photons(intensity) with divide-by-zero's masked
+        out, computed chunk by chunk."""
+        intensity = np.ma.masked_all(self.shape)
+        for slices, data in self.iter_chunks():
+            mask = (data[1] == 0)
+            intensity[slices] = np.ma.array(data=data[0], mask=mask) / np.ma.array(data=data[1], mask=mask)
+        return intensity
+
+    def _trim_limits(self):
+        """Returns the (first, last) index of the data with contributions along each axis"""
+        lims = [None] * self.dimension
+        for slices, data in self.iter_chunks():
+            for i, s in enumerate(slices):
+                hit = np.flatnonzero(sum_onto(data[1] > 0, i))
+                if hit.size:
+                    lo, hi = s.start + hit[0], s.start + hit[-1]
+                    lims[i] = (lo, hi) if lims[i] is None else (min(lims[i][0], lo), max(lims[i][1], hi))
+        if None in lims:
+            raise ValueError('cannot trim a space without contributions')
+        return lims
+
+
+class DiskSpace(_ChunkedSpace):
+    """Space of which the data lives in chunked datasets of a (temporary)
+    HDF5 file, for grids that do not fit in memory. Recently used chunks are
+    kept in an in-memory write-back cache. The file is laid out as a normal
+    Space file, storing the DiskSpace with tofile() renames it into place.
+
+    The dense .photons, .contributions and .variances arrays are read from
+    disk on every access. Projections and slices return a normal Space.
+    Adding a space that does not fit in the axes grows the result into a
+    new DiskSpace spanning both.
+
+    Important attributes:
+        axes      Axes instances describing range and stepsizes of each of the dimensions
+        filename  the HDF5 file holding the data
+        chunks    shape of the HDF5 chunks"""
+
+    def __init__(self, axes, config=None, metadata=None, directory=None, chunks=None, cachesize=256):
+        """directory   place to create the file, system default for temporary files if None
+        chunks      chunk shape of the datasets, picked by h5py if None
+        cachesize   size of the chunk cache in MB"""
+        if not isinstance(axes, Axes):
+            self.axes = Axes(axes)
+        else:
+            self.axes = axes
+
+        self.config = config
+        self.metadata = metadata
+
+        self.directory = directory
+        self.cachesize = cachesize
+        if directory is None:
+            directory = tempfile.gettempdir()
+        self.filename = os.path.join(directory, 'binoculars-{0}.hdf5'.format(util.uniqid()))
+        self._owner = True  # remove the file when this DiskSpace is garbage collected
+        self._file = h5py.File(self.filename, 'w')
+        group = self._file.create_group('binoculars')
+        group.attrs['type'] = 'Space'
+        shape = tuple(len(ax) for ax in self.axes)
+        if chunks:
+            chunks = tuple(min(c, n) for c, n in zip(chunks, shape))
+        self._open(group.create_dataset(name, shape, dtype=float, chunks=chunks or True, fillvalue=0) for name in ('counts', 'contributions', 'variances'))
+
+    def _open(self, datasets):
+        super(DiskSpace, self)._open(datasets)
+        self._chunkgrid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunks))
+        self._capacity = max(1, int(self.cachesize * 2**20 // (3 * 8 * np.prod(self.chunks))))
+        self._cache = collections.OrderedDict()
+
+    def __del__(self):
+        self.close(remove=getattr(self, '_owner', False))
+
+    def close(self, remove=False):
+        """Close the HDF5 file without flushing the cache, and remove it if 'remove' is True"""
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+            self._file = None
+            if remove and os.path.exists(self.filename):
+                os.remove(self.filename)
+
+    def __getstate__(self):
+        # the receiving end takes over the file, this DiskSpace can not be used anymore
+        self.flush()
+        state = dict(self.__dict__)
+        for key in ('_file', '_datasets', '_cache'):
+            del state[key]
+        self.close()
+        self._owner = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reopen()
+        self._owner = True
+
+    def _reopen(self):
+        self._file = h5py.File(self.filename, 'r+')
+        self._open(self._file['binoculars'][name] for name in ('counts', 'contributions', 'variances'))
+
+    @property
+    def memory_size(self):
+        """Returns the size of the chunk cache."""
+        return self._capacity * 3 * 8 * int(np.prod(self.chunks))
+
+    def _like(self, axes):
+        """Returns an empty DiskSpace with 'axes', config and metadata of self"""
+        return self.__class__(axes, self.config, self.metadata, self.directory, self.chunks, self.cachesize)
+
+    def _chunk_slices(self, chunk):
+        return tuple(slice(i * c, min(n, (i + 1) * c)) for i, c, n in zip(chunk, self.chunks, self.shape))
+
+    def _load(self, chunk):
+        """Returns the cached (3, ) + chunkshape array of chunk index tuple 'chunk'"""
+        data = self._cache.pop(chunk, None)
+        if data is None:
+            slices = self._chunk_slices(chunk)
+            data = np.array(tuple(dataset[slices] for dataset in self._datasets))
+            while len(self._cache) >= self._capacity:
+                self._store(*self._cache.popitem(last=False))
+        self._cache[chunk] = data
+        return data
+
+    def _store(self, chunk, data):
+        slices = self._chunk_slices(chunk)
+        for dataset, d in zip(self._datasets, data):
+            dataset[slices] = d
+
+    def flush(self):
+        """Write all cached chunks to disk."""
+        while self._cache:
+            self._store(*self._cache.popitem(last=False))
+
+    def _add_points(self, indices, values):
+        """Add values (3, n) at flat grid indices, grouped per chunk"""
+        if indices.size == 0:
+            return
+        multi = np.unravel_index(indices, self.shape)
+        ids = np.ravel_multi_index(tuple(m // c for m, c in zip(multi, self.chunks)), self._chunkgrid)
+        order = np.argsort(ids, kind='mergesort')
+        ids = ids[order]
+        bounds = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        for start, stop in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [ids.size]))):
+            chunk = np.unravel_index(ids[start], self._chunkgrid)
+            data = self._load(tuple(int(i) for i in chunk))
+            select = order[start:stop]
+            local = np.ravel_multi_index(tuple(m[select] - i * c for m, i, c in zip(multi, chunk, self.chunks)), data.shape[1:])
+            offset = local.min()
+            local -= offset
+            size = local.max() + 1
+            flat = data.reshape(3, -1)
+            for target, row in zip(flat, values[:, select]):
+                target[offset:offset+size] += np.bincount(local, weights=row, minlength=size)
+
+    def bin_image(self, coordinates, intensity, weights, variances, valids=None):
+        """Load image data into Space, do the binning. See Space.bin_image()"""
+        if len(coordinates) != len(self.axes):
+            raise ValueError('dimension mismatch between coordinates and axes')
+
+        indices = self.axes.ravel_index(coordinates)
+        indices, photons, contributions, variances = weigh_image(indices, intensity, weights, variances, valids)
+        if contributions is None:
+            contributions = np.ones_like(photons)
+        if variances is None:
+            variances = np.zeros_like(photons)
+        self._add_points(indices, np.vstack((photons, contributions, variances)))
+
+    def __iadd__(self, other):
+        """ Implementation of 'self += other', a new DiskSpace if 'other' does not fit in the axes of self """
+        if isinstance(other, numbers.Number):
+            # variances are unchanged when adding a number
+            for slices, data in self.iter_chunks():
+                self._datasets[0][slices] = data[0] + other * data[1]
+            return self
+        if not isinstance(other, Space):
+            return NotImplemented
+        if not len(self.axes) == len(other.axes) or not all(a.is_compatible(b) for (a, b) in zip(self.axes, other.axes)):
+            raise ValueError('cannot add spaces with different dimensionality or resolution')
+        if not all(b in a for (a, b) in zip(self.axes, other.axes)):
+            return self.__add__(other)
+
+        if isinstance(other, DiskSpace):
+            for slices, data in other.iter_chunks():
+                multi = np.indices(data.shape[1:]).reshape(other.dimension, -1)
+                indices = np.ravel_multi_index(tuple(m + s.start for m, s in zip(multi, slices)), other.shape)
+                self._add_points(_reindex(indices, other.axes, self.axes), data.reshape(3, -1))
+        else:
+            indices, values = _sparse_points(other)
+            self._add_points(_reindex(indices, other.axes, self.axes), values)
+        self.metadata += other.metadata
+        return self
+
+    def __add__(self, other):
+        if isinstance(other, numbers.Number):
+            new = self.copy()
+            new += other
+            return new
+        if not isinstance(other, Space):
+            return NotImplemented
+        return sum((self, other))
+
+    def __mul__(self, other):
+        """Multiplying a space with a factor scales the intensity with this
+        factor, leaves contributions unchanged and scales variances
+        with the square of this factor (variances > 0)."""
+        if isinstance(other, numbers.Number):
+            new = self._like(self.axes)
+            for slices, data in self.iter_chunks():
+                for dataset, d, factor in zip(new._datasets, data, (other, 1, other**2)):
+                    dataset[slices] = d * factor
+            return new
+        return NotImplemented
+
+    def copy(self):
+        """Returns a copy of self, stored in a new file."""
+        return self * 1
+
+    def reorder(self, labels):
+        """Change order of axes, returns a new DiskSpace."""
+        if not self.dimension == len(labels):
+            raise ValueError('dimension mismatch')
+        newindices = list(self.axes.index(label) for label in labels)
+        new = self._like(Axes(tuple(self.axes[index] for index in newindices)))
+        for slices, data in self.iter_chunks():
+            for dataset, d in zip(new._datasets, data):
+                dataset[tuple(slices[index] for index in newindices)] = d.transpose(newindices)
+        return new
+
+    def trim(self):
+        """Reduce total size of Space by trimming zero-contribution
+        data points on the boundaries. Moves the data to a new file."""
+        lims = self._trim_limits()
+        if all(lo == 0 and hi == len(ax) - 1 for ax, (lo, hi) in zip(self.axes, lims)):
+            return
+        axes = Axes(Axis(lo + ax.imin, hi + ax.imin, ax.res, ax.label) for (ax, (lo, hi)) in zip(self.axes, lims))
+        new = self._like(axes)
+        for slices, data in self.iter_chunks():
+            source = tuple(slice(max(s.start, lo), min(s.stop, hi + 1)) for s, (lo, hi) in zip(slices, lims))
+            if any(s.start >= s.stop for s in source):
+                continue
+            local = tuple(slice(t.start - s.start, t.stop - s.start) for s, t in zip(slices, source))
+            target = tuple(slice(t.start - lo, t.stop - lo) for t, (lo, hi) in zip(source, lims))
+            for dataset, d in zip(new._datasets, data):
+                dataset[target] = d[local]
+        self.close(remove=self._owner)
+        self.__dict__.update(new.__dict__)
+        new._file = None
+
+    def tofile(self, filename, **storage):
+        """Store DiskSpace in HDF5 file. If 'filename' is a path, the data
+        file is moved there, after which this DiskSpace operates on that file.
+        Otherwise ('filename' is a h5py.Group) the data is copied. The file is
+        rewritten chunk by chunk if a storage layout is given.
+
+        storage   compression, shuffle and chunks, see dataset_options()"""
+        if storage:
+            self._rewrite(filename, dataset_options(self.shape, **storage))
+            return
+        self.flush()
+        group = self._file['binoculars']
+        for name in ('configuration', 'axes', 'metadata'):
+            if name in group:
+                del group[name]
+        self.config.tofile(group)
+        self.axes.tofile(group)
+        self.metadata.tofile(group)
+        if isinstance(filename, h5py.Group):
+            filename.attrs['type'] = 'Space'
+            for name in group:
+                group.copy(name, filename)
+            return
+        self.close()
+        shutil.move(self.filename, filename)
+        self.filename = filename
+        self._owner = False
+        self._reopen()
+
+    def _rewrite(self, filename, options):
+        with util.atomic_write(filename) as tmpname:
+            with util.open_h5py(tmpname, 'w') as fp:
+                fp.attrs['type'] = 'Space'
+                self.config.tofile(fp)
+                self.axes.tofile(fp)
+                self.metadata.tofile(fp)
+                options.setdefault('chunks', True)
+                datasets = tuple(fp.create_dataset(name, self.shape, dtype=float, fillvalue=0, **options) for name in ('counts', 'contributions', 'variances'))
+                for slices, data in self.iter_chunks():
+                    for dataset, d in zip(datasets, data):
+                        dataset[slices] = d
+
+
+class LazySpace(_ChunkedSpace):
+    """Read-only Space of which the data stays in the HDF5 file it was loaded
+    from, see Space.fromfile(lazy=True). Data is only read when needed,
+    projections and slices are done chunk by chunk and return a normal Space.
+    Operations that create new data (addition, rebinning, ...) return a
+    normal Space as well, load() reads everything at once. Use close() or
+    a with statement to close the file."""
+
+    def __init__(self, axes, config, metadata, datasets, offset=None, file=None):
+        if not isinstance(axes, Axes):
+            self.axes = Axes(axes)
+        else:
+            self.axes = axes
+
+        self.config = config
+        self.metadata = metadata
+        self._file = file  # closed by close(), None if the file belongs to the caller
+        self._open(datasets, offset)
+
+    def close(self):
+        """Close the HDF5 file, if opened by fromfile(). The data can not
+        be read anymore."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def memory_size(self):
+        return 0
+
+    def load(self):
+        """Returns a normal Space with all data read from file."""
+        space = Space(self.axes, self.config, self.metadata)
+        space.photons, space.contributions, space.variances = self.photons, self.contributions, self.variances
+        return space
+
+    @classmethod
+    def from_image(cls, *args, **kwargs):
+        return Space.from_image(*args, **kwargs)
+
+    def _like(self, axes):
+        return Space(axes, self.config, self.metadata)
+
+    def copy(self):
+        return self.load()
+
+    def __add__(self, other):
+        return self.load() + other
+
+    def __iadd__(self, other):
+        new = self.load()
+        new += other
+        return new
+
+    def __mul__(self, other):
+        return self.load() * other
+
+    def reorder(self, labels):
+        return self.load().reorder(labels)
+
+    def trim(self):
+        """Reduce total size of Space by trimming zero-contribution
+        data points on the boundaries. Only the selected region of the
+        file changes, no data is read besides the contributions."""
+        lims = self._trim_limits()
+        self._offset = tuple(o + lo for o, (lo, hi) in zip(self._offset, lims))
+        self.axes = Axes(Axis(lo + ax.imin, hi + ax.imin, ax.res, ax.label) for (ax, (lo, hi)) in zip(self.axes, lims))
+
+    def tofile(self, filename, **storage):
+        self.load().tofile(filename, **storage)
+
+    @classmethod
+    def fromfile(cls, file, key=None):
+        """Open Space in HDF5 file without reading the data.
+
+        file      filename string or h5py.Group instance, a file opened
+                  by filename is kept open until close()
+        key       sliced (subset) loading, should be an n-tuple
+                  of slice()s in data coordinates"""
+        opened = None
+        try:
+            if isinstance(file, h5py.Group):
+                fp = file
+            else:
+                fp = opened = h5py.File(file, 'r')
+                if 'binoculars' in fp:
+                    fp = fp['binoculars']
+            if 'type' in fp.attrs.keys():
+                if fp.attrs['type'] == 'Empty':
+                    if opened is not None:
+                        opened.close()
+                    return EmptySpace()
+
+            axes = Axes.fromfile(fp)
+            config = util.ConfigFile.fromfile(fp)
+            metadata = util.MetaData.fromfile(fp)
+            key, newaxes = cls._file_key(axes, key, file)
+            if key is Ellipsis:
+                offset = None
+            elif all(isinstance(k, slice) for k in key):
+                offset = tuple(k.indices(len(ax))[0] for k, ax in zip(key, axes))
+            else:  # dimension reducing key, read the (small) selection at once
+                if opened is not None:
+                    opened.close()
+                return Space.fromfile(file, key)
+            try:
+                datasets = [fp['counts'], fp['contributions']]
+            except (KeyError, TypeError) as e:
+                raise errors.HDF5FileError('unable to load space from HDF5 file {0}, is it a valid BINoculars file? (original error: {1!r})'.format(file, e))
+            if 'variances' in fp:
+                datasets.append(fp['variances'])
+            else:
+                datasets.append(None)
+                print('Variances not found in HDF5 file {0}, using 0 as default. You should recreate the space with BINoculars.'.format(file))
+        except Exception as e:
+            if opened is not None:
+                opened.close()
+            if isinstance(e, IOError):
+                raise errors.HDF5FileError('unable to open {0} as HDF5 file (original error: {1!r})'.format(file, e))
+            raise
+        return cls(newaxes, config, metadata, datasets, offset, opened)
+
+
+class LockedSpace(Space):
+    """Space that several threads can bin into at the same time. The
+    binning itself happens outside of any lock, the binned data is added
+    per stripe of the (flat) grid, with one lock per stripe. The data is
+    kept in double precision, convert the result with tospace() once all
+    threads are done."""
+
+    _lock = threading.Lock  # lock factory
+
+    def __init__(self, axes, config=None, metadata=None, nlocks=64):
+        if not isinstance(axes, Axes):
+            self.axes = Axes(axes)
+        else:
+            self.axes = axes
+
+        self.config = config
+        self.metadata = metadata
+
+        self._locks = tuple(self._lock() for i in range(max(1, min(nlocks, self.axes.npoints))))
+        self._allocate()
+
+    def _allocate(self):
+        self._data = np.zeros((3, ) + tuple(len(ax) for ax in self.axes))
+        self.photons, self.contributions, self.variances = self._data
+
+    def bin_image(self, coordinates, intensity, weights, variances, valids=None):
+        """Load image data into Space, do the binning. See Space.bin_image()"""
+        if len(coordinates) != len(self.axes):
+            raise ValueError('dimension mismatch between coordinates and axes')
+
+        indices = self.axes.ravel_index(coordinates)
+        start, photons, contributions, variances = bincount_image(indices, intensity, weights, variances, valids)
+        stop = start + photons.size
+        flat = self._data.reshape(3, -1)
+        stripe = -(-flat.shape[1] // len(self._locks))
+        # one lock at a time, in ascending order
+        for lock in range(start // stripe, -(-stop // stripe)):
+            lo, hi = max(start, lock * stripe), min(stop, (lock + 1) * stripe)
+            with self._locks[lock]:
+                flat[0, lo:hi] += photons[lo - start:hi - start]
+                flat[1, lo:hi] += contributions[lo - start:hi - start]
+                flat[2, lo:hi] += variances[lo - start:hi - start]
+
+    def tospace(self):
+        """Returns a normal Space with the data."""
+        new = Space(self.axes, self.config, self.metadata)
+        new.photons, new.contributions, new.variances = self._data
+        return new
+
+
+class SharedSpace(LockedSpace):
+    """LockedSpace with its arrays in POSIX shared memory, such that several
+    processes can bin into one grid at the same time (python 3.8+).
+
+    Pickling shares the memory instead of copying the data, so pass the
+    space to worker processes when starting them: the locks are inherited
+    that way.
+
+    Important attributes:
+        axes      Axes instances describing range and stepsizes of each of the dimensions
+        name      name of the shared memory block"""
+
+    _lock = multiprocessing.Lock
+
+    def __init__(self, axes, config=None, metadata=None, nlocks=64):
+        if shared_memory is None:
+            raise errors.ConfigError('shared memory spaces require python 3.8 or newer')
+        super(SharedSpace, self).__init__(axes, config, metadata, nlocks)
+
+    def _allocate(self):
+        # newly created shared memory is zero-filled
+        self._shm = shared_memory.SharedMemory(create=True, size=3 * 8 * int(self.axes.npoints))
+        self._owner = True
+        self._attach()
+
+    def _attach(self):
+        self._data = np.ndarray((3, ) + tuple(len(ax) for ax in self.axes), dtype=np.float64, buffer=self._shm.buf)
+        self.photons, self.contributions, self.variances = self._data
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_shm', '_data', 'photons', 'contributions', 'variances'):
+            del state[key]
+        state['_owner'] = False
+        state['_name'] = self._shm.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('_name')
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._attach()
+
+    def tospace(self):
+        """Returns a normal Space with a copy of the data, and releases the
+        shared memory of this space."""
+        new = Space(self.axes, self.config, self.metadata)
+        new.photons, new.contributions, new.variances = self._data.copy()
+        self.close()
+        return new
+
+    def close(self):
+        """Release the shared memory, the owner (the process that created
+        the space) removes it"""
+        if getattr(self, '_shm', None) is None:
+            return
+        self._data = self.photons = self.contributions = self.variances = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __del__(self):
+        self.close()
+
+
 class Multiverse(object):
     """A collection of spaces with basic support for addition.
        Only to be used when processing data. This makes it possible to
@@ -814,13 +2254,17 @@ class Multiverse(object):
             self.spaces[index] += o
         return self
 
-    def tofile(self, filename):
+    @property
+    def memory_size(self):
+        return np.sum([getattr(sp, 'memory_size', 0) for sp in self.spaces])
+
+    def tofile(self, filename, **storage):
         with util.atomic_write(filename) as tmpname:
             with util.open_h5py(tmpname, 'w') as fp:
                 fp.attrs['type'] = 'Multiverse'
                 for index, sp in enumerate(self.spaces):
                     spacegroup = fp.create_group('space_{0}'.format(index))
-                    sp.tofile(spacegroup)
+                    sp.tofile(spacegroup, **storage)
 
     @classmethod
     def fromfile(cls, file):
@@ -890,8 +2334,12 @@ def union_unequal_axes(axes):
     return first.__class__(mi, ma, res, first.label)
 
 
-def sum(spaces):
-    """Calculate sum of iterable of Space instances."""
+def sum(spaces, threads=None):
+    """Calculate sum of iterable of Space instances. The union of the axes is
+    allocated once; large dense sums are added by several threads at once,
+    see _parallel_add().
+
+    threads   maximum number of threads, the number of cores by default"""
     spaces = tuple(space for space in spaces if not isinstance(space, EmptySpace))
     if len(spaces) == 0:
         return EmptySpace()
@@ -902,12 +2350,83 @@ def sum(spaces):
 
     first = spaces[0]
     axes = tuple(union_axes(space.axes[i] for space in spaces) for i in range(first.dimension))
-    newspace = first.__class__(axes)
-    for space in spaces:
-        newspace += space
+    disk = [space for space in spaces if isinstance(space, DiskSpace)]
+    if disk:
+        newspace = disk[0]._like(axes)
+    elif any(isinstance(space, SparseSpace) for space in spaces):
+        newspace = SparseSpace(axes)
+    elif isinstance(first, LazySpace):
+        newspace = Space(axes)
+    else:
+        newspace = first.__class__(axes)
+    if _parallel_add(newspace, spaces, threads):
+        return newspace
+    try:
+        for space in spaces:
+            newspace += space
+    except Exception:
+        discard(newspace)
+        raise
     return newspace
 
 
+def discard(space):
+    """Removes the scratch file of 'space' if it is a DiskSpace owning one,
+    e.g. after an error, such that it is not left behind"""
+    if isinstance(space, DiskSpace):
+        space.close(remove=space._owner)
+
+
+_parallel_size = 2**20  # minimal number of grid points of a sum to add in parallel
+
+
+def _parallel_add(target, spaces, threads=None):
+    """Add 'spaces' into 'target', which spans all their axes, splitting the
+    first axis of 'target' in blocks that separate threads fill with their
+    part of every space (numpy releases the GIL for the additions). Only
+    for plain Spaces and double precision targets, where an addition never
+    has to promote the target. Returns False if not applicable."""
+    threads = min(threads or multiprocessing.cpu_count(), len(target.axes[0]))
+    if threads < 2 or target.npoints < _parallel_size or type(target) is not Space or not all(type(space) is Space for space in spaces):
+        return False
+    if any(a.dtype != np.float64 for a in (target.photons, target.contributions, target.variances)):
+        return False
+
+    offsets = tuple(tuple(a.get_index(b.min) for (a, b) in zip(target.axes, space.axes)) for space in spaces)
+
+    def add(block):
+        lo, hi = block
+        for space, offset in zip(spaces, offsets):
+            start, stop = max(lo, offset[0]), min(hi, offset[0] + len(space.axes[0]))
+            if start >= stop:
+                continue
+            index = (slice(start, stop), ) + tuple(slice(o, o + len(ax)) for o, ax in zip(offset[1:], space.axes[1:]))
+            source = slice(start - offset[0], stop - offset[0])
+            target.photons[index] += space.photons[source]
+            target.contributions[index] += space.contributions[source]
+            target.variances[index] += space.variances[source]
+
+    bounds = np.linspace(0, len(target.axes[0]), threads + 1).astype(int)
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        pool.map(add, zip(bounds[:-1], bounds[1:]))
+    finally:
+        pool.close()
+    for space in spaces:
+        target.metadata += space.metadata
+    return True
+
+
+def trimmed(space):
+    """Trim 'space' in place to the grid points with contributions. Returns
+    the space, or an EmptySpace if it does not contain any data."""
+    try:
+        space.trim()
+    except ValueError:  # no contributions at all
+        return EmptySpace()
+    return space
+
+
 def verse_sum(verses):
     i = iter(M.spaces for M in verses)
     return Multiverse(sum(spaces) for spaces in zip(*i))
@@ -915,14 +2434,31 @@ def verse_sum(verses):
 
 def chunked_sum(verses, chunksize=10):
     """Calculate sum of iterable of Multiverse instances. Creates intermediate
-    sums to avoid growing a large space at every summation.
+    sums, which are merged pairwise by parallel_sum() instead of growing
+    the total at every chunk.
 
     verses     iterable of Multiverse instances
     chunksize  number of Multiverse instances in each intermediate sum"""
-    result = EmptyVerse()
-    for chunk in util.grouper(verses, chunksize):
-        result += verse_sum(M for M in chunk)
-    return result
+    return parallel_sum(verse_sum(chunk) for chunk in util.grouper(iter(verses), chunksize))
+
+
+def parallel_sum(verses):
+    """Calculate sum of iterable of Multiverse instances, filling the union of
+    the axes in parallel, see sum(). Meant for large (partial) sums arriving
+    one by one, e.g. from a generator: pairs of equally sized sums are merged
+    as soon as they are complete, such that at most about log2(n) partial sums
+    are pending at any time; the remaining ones are added at once."""
+    pending = []  # [(number of verses summed, Multiverse)], the counts decrease
+    for verse in verses:
+        count = 1
+        while pending and pending[-1][0] == count:
+            previous_count, previous = pending.pop()
+            verse = verse_sum((previous, verse))
+            count += previous_count
+        pending.append((count, verse))
+    if not pending:
+        return EmptyVerse()
+    return verse_sum(verse for count, verse in pending)
 
 
 def iterate_over_axis(space, axis, resolution=None):
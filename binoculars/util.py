@@ -15,7 +15,12 @@ import struct
 import json
 import socket
 import binascii
+import hashlib
 import re
+import select
+import threading
+import ctypes
+import ctypes.util
 import warnings
 
 import numpy as np
@@ -137,13 +142,13 @@ def handle_ordered_operations(space, args, auto3to2=False):
                 factors = tuple(int(i) for i in opts.split(','))
             else:
                 factors = (int(opts),) * space.dimension
-            space = space.rebin(factors)
+            space = space.rebin_factors(factors)
 
         else:
             raise ValueError("unsupported Ordered Operation '{0}'".format(command))
 
     if auto3to2 and space.dimension == 3:  # automatic projection on smallest axis
-        projectaxis = np.argmin(space.photons.shape)
+        projectaxis = np.argmin([len(ax) for ax in space.axes])
         info.append('projected on {0}'.format(space.axes[projectaxis].label))
         space = space.project(projectaxis)
 
@@ -466,22 +471,25 @@ class MetaData(object): # a collection of metadata objects
                 meta = MetaBase()
                 for section in list(metadata[label].keys()):
                     group = metadata[label][section]
-                    setattr(meta, section, dict((key, group[key].value) for key in group))
+                    setattr(meta, section, dict((key, group[key][()]) for key in group))
                     meta.sections.append(section)
                 metadataobj.metas.append(meta)
         return metadataobj
 
     def tofile(self, filename):
         with open_h5py(filename, 'w') as fp:
-            metadata = fp.create_group('metadata')
-            for meta in self.metas:
-                label = find_unused_label('metasection', list(metadata.keys()))
-                metabase = metadata.create_group(label)
-                for section in meta.sections:
-                    sectiongroup = metabase.create_group(section)
-                    s = getattr(meta, section)
-                    for key in list(s.keys()):
-                        sectiongroup.create_dataset(key, data=s[key])
+            self.togroup(fp.create_group('metadata'))
+
+    def togroup(self, metadata):
+        """Add the metadata to h5py group 'metadata'"""
+        for meta in self.metas:
+            label = find_unused_label('metasection', list(metadata.keys()))
+            metabase = metadata.create_group(label)
+            for section in meta.sections:
+                sectiongroup = metabase.create_group(section)
+                s = getattr(meta, section)
+                for key in list(s.keys()):
+                    sectiongroup.create_dataset(key, data=s[key])
 
     def __repr__(self):
         str = '{0.__class__.__name__}{{\n'.format(self)
@@ -501,6 +509,13 @@ class MetaData(object): # a collection of metadata objects
             obj.metas.append(MetaBase.fromserial(item))
         return obj
 
+
+class SharedMetaData(object):
+    """Message of a worker process binning into shared spaces: the MetaData
+    instances of the jobs it binned, one per shared space."""
+    def __init__(self, metadata):
+        self.metadata = tuple(metadata)
+
 #Contains the unparsed config dicts
 
 
@@ -531,7 +546,7 @@ class ConfigFile(MetaBase):
                         configobj.command = json.loads(com.decode('utf8'))
                 for section in config:
                     if isinstance(config[section], h5py.Group):  # new
-                        setattr(configobj, section, dict((key, config[section][key].value) for key in config[section]))
+                        setattr(configobj, section, dict((key, config[section][key][()]) for key in config[section]))
                     else:  # old
                         setattr(configobj, section, dict(config[section]))
             except KeyError as e:
@@ -667,23 +682,90 @@ def find_unused_label(label, labellist):
             return l
 
 
-def yield_when_exists(filelist, timeout=None):
+class FileWatcher(object):
+    """Wakes up when files are created in, or renamed into, 'directories'.
+
+    Uses inotify on Linux, elsewhere wait() simply sleeps. inotify does not see
+    files written by other hosts on network filesystems, so wait() only
+    shortens the delay until the next check of the files themselves.
+    Usage example:
+    with FileWatcher([directory]) as watcher:
+        while not os.path.exists(filename):
+            watcher.wait(5)
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    def __init__(self, directories):
+        self.fd = None
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for directory in set(directories):
+            if libc.inotify_add_watch(fd, os.path.abspath(directory).encode(sys.getfilesystemencoding()), mask) < 0:
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait at most 'timeout' seconds for a change, returns True if there was one"""
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except OSError:  # EAGAIN: all events consumed
+            pass
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def yield_when_exists(filelist, timeout=None, interval=5):
     """Wait for files in 'filelist' to appear, for a maximum of 'timeout' seconds,
     yielding them in arbitrary order as soon as they appear.
     If 'filelist' is a set, it will be modified in place, and on timeout it will
-    contain the files that have not appeared yet."""
+    contain the files that have not appeared yet.
+    The files are checked every 'interval' seconds, and as soon as a file is
+    created in their directories (see FileWatcher)."""
     if not isinstance(filelist, set):
         filelist = set(filelist)
-    delay = loop_delayer(5)
     start = time.time()
-    while filelist:
-        next(delay)
-        exists = set(f for f in filelist if os.path.exists(f))
-        for e in exists:
-            yield e
-        filelist -= exists
-        if timeout is not None and time.time() - start > timeout:
-            break
+    with FileWatcher(os.path.dirname(os.path.abspath(f)) for f in filelist) as watcher:
+        while filelist:
+            exists = set(f for f in filelist if os.path.exists(f))
+            for e in exists:
+                yield e
+            filelist -= exists
+            if not filelist:
+                break
+            if timeout is None:
+                watcher.wait(interval)
+            else:
+                remaining = timeout - (time.time() - start)
+                if remaining < 0:
+                    break
+                watcher.wait(min(interval, remaining))
 
 
 def wait_for_files(filelist, timeout=None):
@@ -772,19 +854,79 @@ def chunk_slicer(count, chunksize):
         yield slice(i*realchunksize, min(count, (i+1)*realchunksize))
 
 
-def cluster_jobs(jobs, target_weight):
-    jobs = sorted(jobs, key=lambda job: job.weight)
+def job_key(job):
+    """Identifies a Job() by its attributes"""
+    return hashlib.sha1(repr(sorted(job.__dict__.items())).encode('utf-8')).hexdigest()
+
+
+def scan_key(job):
+    """Identifies the scan of a Job() by its attributes other than the range
+    of points (firstpoint and lastpoint) and the weight, such that all parts
+    of a scan get the same key, however the scan was split into jobs"""
+    return hashlib.sha1(repr(sorted(item for item in job.__dict__.items() if item[0] not in ('firstpoint', 'lastpoint', 'weight'))).encode('utf-8')).hexdigest()
+
+
+def point_ranges(points):
+    """Yields (first, last) of every run of consecutive integers in the sorted 'points'"""
+    points = iter(points)
+    for first in points:
+        last = first
+        for point in points:
+            if point != last + 1:
+                yield first, last
+                first = point
+            last = point
+        yield first, last
+
+
+def unstored_jobs(jobs, stored):
+    """Returns the jobs, or the parts of them, with points that are not in
+    'stored' yet, see dispatcher.Destination.get_stored_jobs(). The points are
+    compared per scan, such that it does not matter how the scans were
+    split into jobs by an earlier run."""
+    result = []
+    for job in jobs:
+        key = scan_key(job)
+        first, last = getattr(job, 'firstpoint', None), getattr(job, 'lastpoint', None)
+        if key not in stored:
+            result.append(job)
+        elif first is None or last is None or stored[key] is None:
+            continue  # stored as a whole
+        else:
+            missing = [point for point in range(first, last + 1) if point not in stored[key]]
+            if len(missing) == last - first + 1:
+                result.append(job)
+            else:
+                count = float(last - first + 1)
+                result.extend(job.__class__(**dict(job.__dict__, firstpoint=start, lastpoint=stop, weight=job.weight * (stop - start + 1) / count)) for start, stop in point_ranges(missing))
+    return result
+
+
+def merge_tree(inputs, fanin, merge):
+    """Reduces 'inputs' level by level, replacing groups of at most 'fanin' of
+    them by merge(group), until at most 'fanin' remain, which are returned.
+    A fanin below 2 returns the inputs unchanged."""
+    inputs = list(inputs)
+    if fanin < 2:
+        return inputs
+    while len(inputs) > fanin:
+        inputs = [merge(inputs[s]) if s.stop - s.start > 1 else inputs[s.start] for s in chunk_slicer(len(inputs), fanin)]
+    return inputs
+
+
+def cluster_jobs(jobs, target_weight, weight=lambda job: job.weight):
+    jobs = sorted(jobs, key=weight)
 
     # we cannot split jobs here, so just yield away all jobs that are overweight or just right
-    while jobs and jobs[-1].weight >= target_weight:
+    while jobs and weight(jobs[-1]) >= target_weight:
         yield [jobs.pop()]
 
     while jobs:
         cluster = [jobs.pop()]  # take the biggest remaining job
-        size = cluster[0].weight
+        size = weight(cluster[0])
         for i in range(len(jobs)-1, -1, -1):  # and exhaustively search for all jobs that can accompany it (biggest first)
-            if size + jobs[i].weight <= target_weight:
-                size += jobs[i].weight
+            if size + weight(jobs[i]) <= target_weight:
+                size += weight(jobs[i])
                 cluster.append(jobs.pop(i))
         yield cluster
 
@@ -822,6 +964,175 @@ def loop_delayer(delay):
     return generator()
 
 
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+no_stage = _NoStage()  # stands in for Profile.stage() when not profiling
+
+
+class Profile(object):
+    """Wall time spent per processing stage and counters (frames, pixels,
+    bytes read, bins filled in the output), in total and per job. Stages nest exclusively:
+    the time spent in an inner stage is not counted in the outer one. Every
+    thread keeps its own stack of stages, times of concurrent threads add up.
+
+    If 'trace', every stage and job is also recorded as a span event with
+    its process and thread id, see write_trace()."""
+
+    def __init__(self, label='', trace=False):
+        self.label = label
+        self.times = {}
+        self.counts = {}
+        self.jobs = []  # (label, times, counts) per job
+        self.pid = os.getpid()
+        self.events = [] if trace else None  # (name, start, duration, thread id, job label or None) per span
+        self._setup()
+
+    def _setup(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def _add(self, key, name, value):
+        with self._lock:
+            targets = [getattr(self, key)]
+            job = getattr(self._local, 'job', None)
+            if job is not None:
+                targets.append(job[key == 'counts'])
+            for target in targets:
+                target[name] = target.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        now = time.time()
+        if stack:  # pause the enclosing stage
+            self._add('times', stack[-1][0], now - stack[-1][1])
+        entry = [name, now]
+        stack.append(entry)
+        try:
+            yield
+        finally:
+            end = time.time()
+            stack.pop()
+            self._add('times', name, end - entry[1])
+            if stack:
+                stack[-1][1] = end
+            if self.events is not None:
+                self.events.append((name, now, end - now, threading.current_thread().ident, None))
+
+    def count(self, name, n=1):
+        self._add('counts', name, n)
+
+    def start_job(self, label):
+        """Attributes the following stages and counts (of this thread) to job 'label' as well"""
+        job = {}, {}
+        with self._lock:
+            self.jobs.append((label, ) + job)
+        self._local.job = job
+        self._local.jobstart = label, time.time()
+
+    def end_job(self):
+        self._local.job = None
+        if self.events is not None:
+            label, start = self._local.jobstart
+            self.events.append(('job', start, time.time() - start, threading.current_thread().ident, label))
+
+    def __iadd__(self, other):
+        with self._lock:
+            for mine, theirs in ((self.times, other.times), (self.counts, other.counts)):
+                for name, value in theirs.items():
+                    mine[name] = mine.get(name, 0) + value
+            self.jobs.extend(other.jobs)
+        return self
+
+    def todict(self, events=False):
+        d = dict(label=self.label, times=self.times, counts=self.counts, jobs=[dict(label=label, times=times, counts=counts) for label, times, counts in self.jobs])
+        if events and self.events is not None:
+            d.update(pid=self.pid, events=self.events)
+        return d
+
+    @classmethod
+    def fromdict(cls, d):
+        profile = cls(d['label'], trace='events' in d)
+        profile.times.update(d['times'])
+        profile.counts.update(d['counts'])
+        profile.jobs.extend((job['label'], job['times'], job['counts']) for job in d['jobs'])
+        if 'events' in d:
+            profile.pid = d['pid']
+            profile.events.extend(tuple(event) for event in d['events'])
+        return profile
+
+    @classmethod
+    def dump(cls, profiles, filename, events=False):
+        """Writes the total and every profile in 'profiles' to 'filename' as JSON, including the trace events if 'events'"""
+        total = cls.total(profiles)
+        with atomic_write(filename) as tmpfile:
+            with open(tmpfile, 'w') as fp:
+                json.dump(dict(total=dict(times=total.times, counts=total.counts), profiles=[profile.todict(events) for profile in profiles]), fp, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fp:
+            return [cls.fromdict(d) for d in json.load(fp)['profiles']]
+
+    @staticmethod
+    def write_trace(profiles, filename):
+        """Writes the span events of 'profiles' to 'filename' in the Chrome
+        trace event format (chrome://tracing, Perfetto), one row per process
+        and thread. The profile labels name the processes."""
+        events = []
+        for profile in profiles:
+            if profile.events is None:
+                continue
+            events.append(dict(name='process_name', ph='M', pid=profile.pid, args=dict(name=profile.label)))
+            for name, start, duration, tid, job in profile.events:
+                event = dict(name=name, cat='job' if job is not None else 'stage', ph='X', ts=start * 1e6, dur=duration * 1e6, pid=profile.pid, tid=tid)
+                if job is not None:
+                    event['args'] = dict(job=job)
+                events.append(event)
+        with atomic_write(filename) as tmpfile:
+            with open(tmpfile, 'w') as fp:
+                json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fp)
+
+    @classmethod
+    def total(cls, profiles):
+        total = cls('total')
+        for profile in profiles:
+            total += profile
+        return total
+
+    @classmethod
+    def report(cls, profiles):
+        """Returns a table of the time per stage and the counters of 'profiles', summed and per profile"""
+        total = cls.total(profiles)
+        elapsed = sum(total.times.values()) or 1.
+        lines = ['{0:<12} {1:>10} {2:>6}'.format('stage', 'time s', '%')]
+        for name, t in sorted(total.times.items(), key=lambda item: -item[1]):
+            lines.append('{0:<12} {1:>10.3f} {2:>6.1f}'.format(name, t, 100. * t / elapsed))
+        lines.append('')
+        for name, n in sorted(total.counts.items()):
+            lines.append('{0:<12} {1:>14}'.format(name, n))
+        if len(profiles) > 1:
+            lines.append('')
+            lines.append('{0:<24} {1:>6} {2:>10} {3:>10}'.format('profile', 'jobs', 'time s', 'frames'))
+            for profile in profiles:
+                lines.append('{0:<24} {1:>6} {2:>10.3f} {3:>10}'.format(profile.label, len(profile.jobs), sum(profile.times.values()), profile.counts.get('frames', 0)))
+        return '\n'.join(lines)
+
+
 def transformation_from_expressions(space, exprs):
     def transformation(*coords):
         ns = dict((i, getattr(np, i)) for i in dir(np))
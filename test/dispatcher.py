@@ -0,0 +1,318 @@
+import io
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import itertools
+import tempfile
+import warnings
+import binoculars.main
+import binoculars.space
+import binoculars.util
+import binoculars.backend
+import binoculars.backends.example
+import binoculars.dispatcher
+import binoculars.errors
+import binoculars.fakebatch
+import numpy
+
+import unittest
+
+CONFIG = '''
+[dispatcher]
+type = local
+destination = {directory}/output.hdf5
+overwrite = true
+[input]
+type = example:input
+wavelength = 0.5
+centralpixel = 50,50
+sdd = 636
+pixelsize = 0.055, 0.055
+[projection]
+type = example:qprojection
+resolution = 0.05
+limits = [-2:2,-2:2,0:4]
+'''
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'config.txt')
+        with open(self.config, 'w') as fp:
+            fp.write(CONFIG.format(directory=self.directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process(self, command, *options):
+        """Runs the example backend on the scans in 'command', options are
+        section:option=value. Returns what was printed."""
+        args = [self.config, command]
+        for option in options:
+            args.extend(('-c', option))
+        stdout, sys.stdout = sys.stdout, io.StringIO()  # the example backend prints every frame
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                binoculars.main.Main.from_args(args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def option(self, option, filename):
+        return '{0}={1}'.format(option, os.path.join(self.directory, filename))
+
+    def load(self, name):
+        return binoculars.space.Space.fromfile(os.path.join(self.directory, '{0}_[m2-2,m2-2,0-4].hdf5'.format(name)))
+
+    def assertSpaceEqual(self, space, reference):
+        space.trim()
+        reference.trim()
+        self.assertEqual(space.axes, reference.axes)
+        numpy.testing.assert_allclose(space.photons, reference.photons)
+        numpy.testing.assert_array_equal(space.contributions, reference.contributions)
+
+    def test_append(self):
+        # scans 1 and 2 split over 3 workers, then appending scans 1-3 with 1 worker must only add scan 3
+        self.process('1-2', 'dispatcher:ncores=3', 'dispatcher:schedule=cost')
+        self.assertGreater(len(self.load('output').metadata.metas), 2)
+        self.process('1-3', 'dispatcher:ncores=1', 'dispatcher:append=true', 'dispatcher:overwrite=false')
+        self.process('1-3', 'dispatcher:ncores=2', 'dispatcher:destination={0}/reference.hdf5'.format(self.directory))
+        self.assertSpaceEqual(self.load('output'), self.load('reference'))
+
+    def test_unstored_jobs(self):
+        jobs = [binoculars.backend.Job(scan=1, firstpoint=0, lastpoint=99, weight=100), binoculars.backend.Job(scan=2, firstpoint=0, lastpoint=99, weight=100)]
+        stored = {binoculars.util.scan_key(jobs[0]): set(range(0, 40)) | set(range(60, 70))}
+        remaining = binoculars.util.unstored_jobs(jobs, stored)
+        self.assertEqual([(job.scan, job.firstpoint, job.lastpoint, job.weight) for job in remaining], [(1, 40, 59, 20), (1, 70, 99, 30), (2, 0, 99, 100)])
+        stored[binoculars.util.scan_key(jobs[1])] = set(range(100))
+        stored[binoculars.util.scan_key(jobs[0])].update(range(100))
+        self.assertEqual(binoculars.util.unstored_jobs(jobs, stored), [])
+
+    def test_schedule(self):
+        class Planner(binoculars.main.Main):
+            def run(self, command):
+                pass
+        main = Planner(binoculars.util.ConfigFile.fromtxtfile(self.config), [])
+        self.assertEqual(main.dispatcher.config.schedule, 'order')
+
+        # images x 100 x 100 pixels x 1 set of limits
+        Job = binoculars.backend.Job
+        self.assertEqual(main.get_job_cost(Job(scan=1, firstpoint=0, lastpoint=99, weight=100)), 100 * 100 * 100)
+        jobs = [Job(scan=1, firstpoint=0, lastpoint=9, weight=10), Job(scan=2, firstpoint=0, lastpoint=99, weight=100), Job(scan=3, firstpoint=0, lastpoint=39, weight=40)]
+
+        self.assertEqual([cost for cost, job in main.split_jobs(jobs, 0)], [10**5, 10**6, 4 * 10**5])
+        split = main.split_jobs(jobs, 4 * 10**5)
+        self.assertEqual([(job.scan, job.firstpoint, job.lastpoint) for cost, job in split], [(1, 0, 9), (2, 0, 33), (2, 34, 67), (2, 68, 99), (3, 0, 39)])
+        self.assertTrue(all(cost <= 4 * 10**5 for cost, job in split))
+        self.assertEqual(sum(job.weight for cost, job in split), 150)
+
+        # longest first, after splitting into parts of at most half the fair share of 3 workers (2.5 * 10**5)
+        scheduled = main.schedule_jobs(iter(jobs), 3)
+        self.assertEqual([(job.scan, job.firstpoint) for job in scheduled], [(2, 0), (2, 25), (2, 50), (2, 75), (3, 0), (3, 20), (1, 0)])
+        self.assertEqual([(job.scan, job.firstpoint) for job in main.schedule_jobs(jobs, 3, split=False)], [(2, 0), (3, 0), (1, 0)])
+        self.assertEqual([job.scan for job in main.schedule_jobs(jobs, 1)], [2, 3, 1])
+
+    def test_prepass(self):
+        self.process('1-3')
+        self.process('1-3', 'projection:prepass=true', self.option('dispatcher:destination', 'prepass.hdf5'))
+        self.assertSpaceEqual(self.load('prepass'), self.load('output'))
+
+        # an underestimated extent (only the border of the first image) bins the other points separately
+        Input = binoculars.backends.example.Input
+        get_border_params, inside = Input.get_border_params, binoculars.space.Axes.inside
+        spilled = []
+
+        def counting_inside(axes, coordinates):
+            spilled.append(axes)
+            return inside(axes, coordinates)
+        Input.get_border_params = lambda self, job: itertools.islice(get_border_params(self, job), 1)
+        binoculars.space.Axes.inside = counting_inside
+        try:
+            self.process('1-3', 'dispatcher:type=singlecore', 'projection:prepass=true', self.option('dispatcher:destination', 'underestimated.hdf5'))
+        finally:
+            Input.get_border_params = get_border_params
+            binoculars.space.Axes.inside = inside
+        self.assertTrue(spilled)
+        self.assertSpaceEqual(self.load('underestimated'), self.load('output'))
+
+    def test_threaded(self):
+        for options in ((), ('projection:fixedgrid=true', )):
+            self.process('1-3', 'dispatcher:type=threaded', 'dispatcher:nthreads=2', self.option('dispatcher:destination', 'threaded.hdf5'), *options)
+            self.process('1-3', 'dispatcher:ncores=2', *options)
+            self.assertSpaceEqual(self.load('threaded'), self.load('output'))
+
+    @unittest.skipIf(binoculars.space.shared_memory is None, 'requires python 3.8+')
+    def test_shared(self):
+        self.process('1-3', 'dispatcher:ncores=2', 'dispatcher:shared=true', 'projection:fixedgrid=true', self.option('dispatcher:destination', 'shared.hdf5'))
+        self.process('1-3', 'dispatcher:ncores=2', 'projection:fixedgrid=true')
+        # the workers send the metadata of the jobs binned into the shared space separately
+        self.assertEqual(len(self.load('shared').metadata.metas), len(self.load('output').metadata.metas))
+        self.assertSpaceEqual(self.load('shared'), self.load('output'))
+
+    def test_batch_markers(self):
+        binoculars.util.register_python_executable('binoculars')  # as by the binoculars script
+        batch = binoculars.dispatcher.Batch(dict(destination=os.path.join(self.directory, 'output.hdf5'), tmpdir=self.directory, status='echo j9: Running', cancel='true {jobids}', interval='0.01'), None)
+        done, failed, empty, lost = (batch.new_base() for i in range(4))
+        self.assertIsNone(batch.read_marker(done))
+        batch.write_marker(done, 'done')
+        batch.write_marker(failed, 'failed', 'Traceback: error')
+        batch.write_marker(empty, 'failed')
+        self.assertEqual([batch.read_marker(base) for base in (done, failed, empty, lost)], [True, 'Traceback: error', 'failed', None])
+
+        self.assertEqual(batch.wait_for_jobs({done: 'j0', failed: 'j1'}), {'j1': 'Traceback: error'})
+        self.assertEqual(batch.wait_for_jobs({done: 'j0'}), {})
+        # without marker and no longer listed by the scheduler in two status queries
+        failures = batch.wait_for_jobs({done: 'j0', lost: 'j3'})
+        self.assertEqual(list(failures), ['j3'])
+        self.assertIn('disappeared', failures['j3'])
+
+        self.assertEqual(list(batch.yield_when_done([done])), [done])
+        self.assertRaises(binoculars.errors.SubprocessError, list, batch.yield_when_done([done, failed]))
+        batch.cleanup({done: 'j0', failed: 'j1'})
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(['config.txt', os.path.basename(empty) + '.failed']))
+
+    def test_merge_tree(self):
+        merges = []
+
+        def merge(group):
+            merges.append(list(group))
+            return sum(group)
+        self.assertEqual(binoculars.util.merge_tree([5], 3, merge), [5])
+        self.assertEqual(binoculars.util.merge_tree([1, 2, 3], 3, merge), [1, 2, 3])
+        self.assertEqual(merges, [])
+        # one input too many: the groups are evened out, not 3 + 1
+        self.assertEqual(binoculars.util.merge_tree([1, 2, 3, 4], 3, merge), [3, 7])
+        self.assertEqual(merges, [[1, 2], [3, 4]])
+        del merges[:]
+        self.assertEqual(binoculars.util.merge_tree(range(10), 3, merge), [15, 30])
+        self.assertEqual(merges, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [3, 12], [21, 9]])  # two levels
+        self.assertEqual(binoculars.util.merge_tree(range(10), 0, merge), list(range(10)))
+
+    def test_batch_run(self):
+        # the fake scheduler runs every job as a background process on this machine
+        binoculars.util.register_python_executable('binoculars')  # as by the binoculars script
+        os.environ['BINOCULARS_FAKEBATCH_SPOOL'] = os.path.join(self.directory, 'spool')
+        fakebatch = '{0} {1}'.format(sys.executable, binoculars.fakebatch.__file__)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(binoculars.__file__)))
+        try:
+            self.process('1-3', 'dispatcher:type=batch', 'dispatcher:tmpdir=' + self.directory, 'dispatcher:interval=0.2', 'dispatcher:fanin=2',
+                         'dispatcher:submit={0} submit {{command}}'.format(fakebatch), r'dispatcher:jobid=JOB_ID=(\S+)',
+                         'dispatcher:status={0} status'.format(fakebatch), 'dispatcher:cancel={0} cancel {{jobids}}'.format(fakebatch),
+                         'dispatcher:executable={0} {1}'.format(sys.executable, os.path.join(root, 'scripts', 'binoculars')),
+                         'input:target_weight=100', self.option('dispatcher:destination', 'batch.hdf5'))
+        finally:
+            del os.environ['BINOCULARS_FAKEBATCH_SPOOL']
+        self.process('1-3', 'dispatcher:ncores=2')
+        # one job per scan, summed by a merge job (fanin 2) and the final job
+        self.assertEqual(len(self.load('batch').metadata.metas), len(self.load('output').metadata.metas))
+        self.assertSpaceEqual(self.load('batch'), self.load('output'))
+        self.assertEqual(glob.glob(os.path.join(self.directory, 'binoculars-*')), [])  # cleaned up
+
+    def test_checkpoint_resume(self):
+        checkpoint = self.option('dispatcher:checkpoint', 'checkpoint')
+        self.process('1-3', checkpoint)
+        manifest, = glob.glob(os.path.join(self.directory, 'checkpoint', '*', 'manifest.txt'))
+        with open(manifest) as fp:
+            lines = fp.readlines()
+        self.assertEqual(len(lines), 3)
+        with open(manifest, 'w') as fp:  # interrupted while the last job was written
+            fp.write(''.join(lines[:2]) + lines[2].rstrip('\n'))
+
+        output = self.process('1-3', checkpoint, self.option('dispatcher:destination', 'resumed.hdf5'))
+        self.assertIn('2 jobs completed, 1 remaining', output)
+        self.process('1-3', self.option('dispatcher:destination', 'reference.hdf5'))
+        self.assertSpaceEqual(self.load('resumed'), self.load('reference'))
+        self.assertSpaceEqual(self.load('output'), self.load('reference'))
+
+    def test_cache(self):
+        cache = binoculars.dispatcher.ResultCache(os.path.join(self.directory, 'cache'), 'identity', 2**30)
+        source = os.path.join(self.directory, 'image.edf')
+        with open(source, 'w') as fp:
+            fp.write('image')
+        job = binoculars.backend.Job(scan=1, firstpoint=0, lastpoint=9)
+        sp = binoculars.space.Space(binoculars.space.Axes((binoculars.space.Axis(0, 99, 1, 'h'), )))
+        sp.photons[:] = numpy.arange(100)
+        sp.contributions[:] = 1
+
+        key = cache.get_key(job, [source])
+        self.assertIsNone(cache.load(key))  # miss
+        cache.store(key, binoculars.space.Multiverse((sp, )))
+        numpy.testing.assert_array_equal(cache.load(key).spaces[0].photons, sp.photons)  # hit
+        self.assertIsNone(cache.get_key(job, None))  # unknown source files
+        self.assertIsNone(cache.get_key(job, [source + '.missing']))
+        self.assertNotEqual(cache.get_key(binoculars.backend.Job(scan=1, firstpoint=0, lastpoint=10), [source]), key)
+        self.assertNotEqual(binoculars.dispatcher.ResultCache(cache.directory, 'other', 2**30).get_key(job, [source]), key)
+        with open(source, 'a') as fp:
+            fp.write(' changed')
+        self.assertIsNone(cache.load(cache.get_key(job, [source])))
+
+        # least recently used entries are evicted beyond maxsize
+        keys = [cache.get_key(binoculars.backend.Job(scan=scan), []) for scan in range(3)]
+        for key in keys[:2]:
+            cache.store(key, binoculars.space.Multiverse((sp, )))
+        cache.maxsize = 2.5 * os.path.getsize(cache.get_filename(keys[0]))
+        for key in os.listdir(cache.directory):
+            os.utime(os.path.join(cache.directory, key), (time.time() - 100, time.time() - 100))
+        os.utime(cache.get_filename(keys[1]), (time.time() - 10, time.time() - 10))
+        self.assertIsNotNone(cache.load(keys[0]))  # now the most recently used
+        cache.store(keys[2], binoculars.space.Multiverse((sp, )))
+        self.assertEqual(sorted(os.listdir(cache.directory)), sorted(os.path.basename(cache.get_filename(key)) for key in (keys[0], keys[2])))
+
+    def test_cache_run(self):
+        cache = self.option('dispatcher:cache', 'cache')
+        self.process('1-2', cache)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'cache'))), 2)
+        self.process('1-2', cache, self.option('dispatcher:destination', 'cached.hdf5'))
+        self.assertSpaceEqual(self.load('cached'), self.load('output'))
+
+    def test_profile(self):
+        profile = os.path.join(self.directory, 'profile.json')
+        self.process('1-3', 'dispatcher:ncores=2', 'dispatcher:profile=' + profile)
+
+        with open(profile) as fp:
+            data = json.load(fp)
+        self.assertEqual(sorted(data), ['profiles', 'total'])
+        self.assertEqual(data['total']['counts']['frames'], 300)
+        self.assertEqual(data['total']['counts']['pixels'], 300 * 100 * 100)
+        self.assertGreater(data['total']['counts']['bins'], 0)
+        self.assertTrue(set(('read', 'project', 'bin', 'sum', 'store')) <= set(data['total']['times']))
+        labels = [d['label'] for d in data['profiles']]
+        self.assertEqual(labels[0], 'main')
+        self.assertEqual(len(labels), 3)
+        jobs = [job for d in data['profiles'] for job in d['jobs']]
+        for job in jobs:
+            self.assertEqual(sorted(job), ['counts', 'label', 'times'])
+        self.assertEqual(sum(job['counts']['frames'] for job in jobs), 300)  # the scans might be split over the workers
+        loaded = binoculars.util.Profile.load(profile)
+        self.assertEqual([p.label for p in loaded], labels)
+        self.assertAlmostEqual(binoculars.util.Profile.total(loaded).times['bin'], data['total']['times']['bin'])
+
+    def test_trace(self):
+        trace = os.path.join(self.directory, 'trace.json')
+        self.process('1-3', 'dispatcher:ncores=2', 'dispatcher:trace=' + trace)
+
+        with open(trace) as fp:
+            data = json.load(fp)
+        events = data['traceEvents']
+        processes = dict((event['pid'], event['args']['name']) for event in events if event['ph'] == 'M')
+        self.assertEqual(sorted(processes.values())[0], 'main')
+        self.assertEqual(len(processes), 3)  # main and 2 workers
+        spans = [event for event in events if event['ph'] != 'M']
+        for event in spans:
+            self.assertEqual(event['ph'], 'X')
+            self.assertTrue(set(('name', 'cat', 'ts', 'dur', 'pid', 'tid')) <= set(event))
+            self.assertGreaterEqual(event['dur'], 0)
+            self.assertIn(event['pid'], processes)
+        jobs = [event for event in spans if event['cat'] == 'job']
+        self.assertTrue(jobs)
+        self.assertTrue(all('job' in event['args'] for event in jobs))
+        self.assertTrue(set(event['pid'] for event in jobs) <= set(pid for pid, name in processes.items() if name != 'main'))  # the workers process the jobs
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+import os
+import multiprocessing
+import binoculars.space
+import binoculars.util
+import numpy
+
+import unittest
+
+
+def make_image(shape=(60, 40), seed=0):
+    rng = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]] / 50.
+    coords = (numpy.sin(x + 0.1), numpy.cos(y) * 0.5, x + y)
+    intensity = rng.poisson(10, shape).astype(float)
+    weights = numpy.ones(shape)
+    weights[:, :5] = 0
+    return coords, intensity, weights, intensity + 1
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.resolutions = (0.01, 0.02, 0.05)
+        self.labels = ('h', 'k', 'l')
+        self.coords, self.intensity, self.weights, self.variances = make_image()
+
+    def test_bin_image(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        mask = self.weights > 0
+        self.assertAlmostEqual(space.photons.sum(), self.intensity[mask].sum())
+        self.assertEqual(space.contributions.sum(), mask.sum())
+        self.assertAlmostEqual(space.variances.sum(), self.variances[mask].sum())
+
+        # reference: independent binning of every point
+        reference = numpy.zeros_like(space.photons)
+        indices = tuple(ax.get_index(coord[mask]) for ax, coord in zip(space.axes, self.coords))
+        numpy.add.at(reference, indices, self.intensity[mask])
+        numpy.testing.assert_allclose(space.photons, reference)
+
+    def test_bin_image_valids(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        other = binoculars.space.Space(space.axes)
+        other.bin_image(self.coords, self.intensity, None, self.variances, valids=self.weights)
+        numpy.testing.assert_allclose(space.photons, other.photons)
+        numpy.testing.assert_allclose(space.contributions, other.contributions)
+        numpy.testing.assert_allclose(space.variances, other.variances)
+
+    def test_bin_image_out_of_range(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        coords = tuple(coord + 1 for coord in self.coords)
+        self.assertRaises(ValueError, space.bin_image, coords, self.intensity, self.weights, self.variances)
+
+    def test_sparse(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        sparse = binoculars.space.SparseSpace(space.axes)
+        sparse.bin_image(self.coords, self.intensity, self.weights, self.variances)
+        self.assertTrue(sparse.memory_size < space.memory_size)
+        numpy.testing.assert_allclose(sparse.photons, space.photons)
+        numpy.testing.assert_allclose(sparse.variances, space.variances)
+        numpy.testing.assert_allclose(sparse.project('k').contributions, space.project('k').contributions)
+
+        coords = tuple(coord + 0.5 for coord in self.coords)
+        other = binoculars.space.Space.from_image(self.resolutions, self.labels, coords, self.intensity, self.weights, self.variances)
+        total = binoculars.space.sum((sparse, other))
+        self.assertTrue(isinstance(total, binoculars.space.SparseSpace))
+        numpy.testing.assert_allclose(total.todense().photons, (space + other).photons)
+
+    def test_disk(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        disk = binoculars.space.DiskSpace(space.axes, chunks=(8, 4, 4), cachesize=0.01)
+        disk.bin_image(self.coords, self.intensity, self.weights, self.variances)
+        numpy.testing.assert_allclose(disk.photons, space.photons)
+        numpy.testing.assert_allclose(disk.variances, space.variances)
+        numpy.testing.assert_allclose(disk.project('h').contributions, space.project('h').contributions)
+
+        filename = disk.filename
+        disk.trim()
+        space.trim()
+        self.assertEqual(disk.axes, space.axes)
+        numpy.testing.assert_allclose(disk.contributions, space.contributions)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_disk_grow(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        coords = (self.coords[0] + 2, ) + self.coords[1:]
+        other = binoculars.space.Space.from_image(self.resolutions, self.labels, coords, self.intensity, self.weights, self.variances)
+        total = binoculars.space.Multiverse((binoculars.space.DiskSpace(space.axes, cachesize=0.01), ))
+        total += binoculars.space.Multiverse((space, ))
+        first = total.spaces[0].filename
+        moved = binoculars.space.DiskSpace(other.axes, cachesize=0.01)
+        moved += other
+        total += binoculars.space.Multiverse((moved, ))  # does not fit: grows into a new DiskSpace
+        result = total.spaces[0]
+        self.assertTrue(isinstance(result, binoculars.space.DiskSpace))
+        self.assertEqual(result.axes, (space + other).axes)
+        numpy.testing.assert_allclose(result.photons, (space + other).photons)
+        self.assertFalse(os.path.exists(first))
+        filename = result.filename
+        del total, result
+        self.assertFalse(os.path.exists(filename))
+
+    def test_lazy(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        space.tofile('test_lazy.hdf5')
+        try:
+            lazy = binoculars.space.Space.fromfile('test_lazy.hdf5', lazy=True)
+            self.assertTrue(isinstance(lazy, binoculars.space.LazySpace))
+            numpy.testing.assert_allclose(lazy.project('h').photons, space.project('h').photons)
+            numpy.testing.assert_allclose(lazy.slice('l', slice(0.5, 1)).variances, space.slice('l', slice(0.5, 1)).variances)
+            numpy.testing.assert_allclose(lazy.get_norm_intensity().filled(0), space.get_norm_intensity().filled(0))
+
+            key = (slice(0.2, 0.6), slice(None), slice(0.5, 1.0))
+            lazy = binoculars.space.Space.fromfile('test_lazy.hdf5', key=key, lazy=True)
+            self.assertEqual(lazy.axes, space[key].axes)
+            numpy.testing.assert_allclose(lazy.project('k').contributions, space[key].project('k').contributions)
+            lazy.close()
+            self.assertRaises(Exception, lambda: lazy.photons)
+
+            with binoculars.space.Space.fromfile('test_lazy.hdf5', lazy=True) as lazy:
+                numpy.testing.assert_allclose(lazy.photons, space.photons)
+            self.assertRaises(Exception, lambda: lazy.photons)
+            lazy.close()  # closing twice is fine
+        finally:
+            os.remove('test_lazy.hdf5')
+
+    def test_storage(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        space.tofile('test_storage.hdf5', compression='lzf', shuffle=True, chunks=(4, 4, 0))
+        try:
+            lazy = binoculars.space.Space.fromfile('test_storage.hdf5', lazy=True)
+            self.assertEqual(lazy.chunks, (4, 4, len(space.axes[2])))
+            numpy.testing.assert_allclose(lazy.photons, space.photons)
+        finally:
+            os.remove('test_storage.hdf5')
+        self.assertRaises(ValueError, binoculars.space.dataset_options, (10, 10), compression='zip')
+        self.assertRaises(ValueError, binoculars.space.dataset_options, (10, 10), compression='gzip:12')
+        self.assertEqual(binoculars.space.dataset_options((10, 10), compression='gzip:9')['compression_opts'], 9)
+
+    def test_addtofile(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        space.metadata.add_dataset(binoculars.util.MetaBase('job', {'scan': 1}))
+        space.tofile('test_addtofile.hdf5')
+        try:
+            # within the axes in the file: updated in place
+            part = space[0.2:0.5, :, :]
+            part.addtofile('test_addtofile.hdf5')
+            result = binoculars.space.Space.fromfile('test_addtofile.hdf5')
+            self.assertEqual(result.axes, space.axes)
+            numpy.testing.assert_allclose(result.photons, (space + part).photons)
+            self.assertEqual(len(result.metadata.metas), 2)
+
+            # beyond: the axes grow
+            coords = (self.coords[0] + 0.5, ) + self.coords[1:]
+            other = binoculars.space.Space.from_image(self.resolutions, self.labels, coords, self.intensity, self.weights, self.variances)
+            other.addtofile('test_addtofile.hdf5')
+            grown = binoculars.space.Space.fromfile('test_addtofile.hdf5')
+            self.assertEqual(grown.axes, (result + other).axes)
+            numpy.testing.assert_allclose(grown.contributions, (result + other).contributions)
+        finally:
+            os.remove('test_addtofile.hdf5')
+
+    def test_precision(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        binoculars.space.set_precision('single')
+        try:
+            single = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+            self.assertEqual(single.photons.dtype, numpy.float32)
+            self.assertEqual(single.contributions.dtype, numpy.uint32)
+            self.assertTrue(single.memory_size < space.memory_size)
+            numpy.testing.assert_allclose(single.photons, space.photons, rtol=1e-6)
+            numpy.testing.assert_array_equal(single.contributions, space.contributions)
+
+            # photons are rounded to float32, contributions are promoted before they overflow
+            single += single * 2**24
+            self.assertEqual(single.photons.dtype, numpy.float32)
+            numpy.testing.assert_allclose(single.photons, space.photons * (2**24 + 1), rtol=1e-6)
+            self.assertEqual(single.contributions.dtype, numpy.uint32)
+            single.contributions[single.contributions > 0] = 2**32 - 1
+            single += single
+            self.assertEqual(single.contributions.dtype, numpy.float64)
+            self.assertEqual(single.contributions.max(), 2**33 - 2)
+
+            # non-unit weights give non-integral contributions
+            weighted = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights * 0.5, self.variances)
+            self.assertEqual(weighted.contributions.dtype, numpy.float64)
+        finally:
+            binoculars.space.set_precision('double')
+        self.assertRaises(ValueError, binoculars.space.set_precision, 'half')
+
+    def test_rebin(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        rebinned = space.rebin_factors((3, 1, 5))
+        self.assertEqual(tuple(ax.res for ax in rebinned.axes), (0.03, 0.02, 0.25))
+        self.assertAlmostEqual(rebinned.photons.sum(), space.photons.sum())
+
+        # reference: scatter every grid point to the new grid (odd factors: no ties)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            reference = binoculars.space.Space.from_image((0.03, 0.02, 0.25), self.labels, space.get_grid(), space.photons / space.contributions, space.contributions, space.variances / space.contributions**2)
+        reference.trim()
+        rebinned.trim()
+        self.assertEqual(rebinned.axes, reference.axes)
+        numpy.testing.assert_allclose(rebinned.photons, reference.photons)
+        numpy.testing.assert_allclose(rebinned.variances, reference.variances)
+        self.assertRaises(ValueError, space.rebin_factors, (2, 0, 1))
+
+    def test_transform_coordinates(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        transformation = binoculars.util.transformation_from_expressions(space, ('sqrt(h**2 + k**2)', 'l'))
+        whole = space.transform_coordinates((0.01, 0.05), ('q', 'l'), transformation)
+        self.assertAlmostEqual(whole.photons.sum(), space.photons.sum())
+        for source in (space, binoculars.space.SparseSpace.fromdense(space)):
+            slabs = source.transform_coordinates((0.01, 0.05), ('q', 'l'), transformation, slabsize=100)
+            self.assertEqual(slabs.axes, whole.axes)
+            numpy.testing.assert_allclose(slabs.photons, whole.photons)
+            numpy.testing.assert_allclose(slabs.contributions, whole.contributions)
+
+    def test_parallel_sum(self):
+        spaces = []
+        for offset in (0, 0.13, 0.57):
+            coords = (self.coords[0] + offset, ) + self.coords[1:]
+            spaces.append(binoculars.space.Space.from_image(self.resolutions, self.labels, coords, self.intensity, self.weights, self.variances))
+        serial = binoculars.space.sum(spaces, threads=1)
+        size, binoculars.space._parallel_size = binoculars.space._parallel_size, 0
+        try:
+            parallel = binoculars.space.sum(spaces, threads=3)
+        finally:
+            binoculars.space._parallel_size = size
+        self.assertEqual(parallel.axes, serial.axes)
+        numpy.testing.assert_allclose(parallel.photons, serial.photons)
+        numpy.testing.assert_allclose(parallel.variances, serial.variances)
+        numpy.testing.assert_array_equal(parallel.contributions, serial.contributions)
+
+    def test_parallel_sum_verses(self):
+        spaces = []
+        for offset in (0, 0.13, 0.57, 0.91, 1.3):
+            coords = (self.coords[0] + offset, ) + self.coords[1:]
+            spaces.append(binoculars.space.Space.from_image(self.resolutions, self.labels, coords, self.intensity, self.weights, self.variances))
+        merged = []
+        verse_sum = binoculars.space.verse_sum
+
+        def counting_sum(verses):
+            verses = list(verses)
+            merged.append(len(verses))
+            return verse_sum(verses)
+        binoculars.space.verse_sum = counting_sum
+        try:
+            result = binoculars.space.parallel_sum(binoculars.space.Multiverse((sp, )) for sp in spaces)
+        finally:
+            binoculars.space.verse_sum = verse_sum
+        self.assertEqual(merged, [2, 2, 2, 2])  # pairs while arriving, then the 4 + 1 remaining
+        serial = binoculars.space.sum(spaces, threads=1)
+        self.assertEqual(result.spaces[0].axes, serial.axes)
+        numpy.testing.assert_allclose(result.spaces[0].photons, serial.photons)
+        numpy.testing.assert_array_equal(result.spaces[0].contributions, serial.contributions)
+        self.assertIsInstance(binoculars.space.parallel_sum(iter(())), binoculars.space.EmptyVerse)
+
+        chunked = binoculars.space.chunked_sum([binoculars.space.Multiverse((sp, )) for sp in spaces], chunksize=2)
+        self.assertEqual(chunked.spaces[0].axes, serial.axes)
+        numpy.testing.assert_allclose(chunked.spaces[0].photons, serial.photons)
+        self.assertIsInstance(binoculars.space.chunked_sum([]), binoculars.space.EmptyVerse)
+
+    @unittest.skipIf(binoculars.space.shared_memory is None, 'requires python 3.8+')
+    def test_shared(self):
+        space = binoculars.space.Space.from_image(self.resolutions, self.labels, self.coords, self.intensity, self.weights, self.variances)
+        shared = binoculars.space.SharedSpace(space.axes, nlocks=7)
+        image = self.coords, self.intensity, self.weights, self.variances
+        workers = [multiprocessing.Process(target=shared.bin_image, args=image) for i in range(2)]
+        for worker in workers:
+            worker.start()
+        shared.bin_image(*image)
+        for worker in workers:
+            worker.join()
+        name = shared.name
+        result = shared.tospace()
+        numpy.testing.assert_allclose(result.photons, 3 * space.photons)
+        numpy.testing.assert_allclose(result.contributions, 3 * space.contributions)
+        self.assertFalse(os.path.exists(os.path.join('/dev/shm', name)))
+
+if __name__ == '__main__':
+    unittest.main()